@@ -1,6 +1,113 @@
+import re
+import numpy
 from django import forms
+from tkpweb import settings
 
 
 class MonitoringListForm(forms.Form):
     ra = forms.FloatField()
     dec = forms.FloatField()
+
+
+class MonitoringListUploadForm(forms.Form):
+    """Many monitoring list positions at once, as text or as an uploaded
+    file
+
+    Each line contains an RA and declination in degrees, separated by
+    white space, a comma or a semicolon. Empty lines, lines starting
+    with '#' and a header line (of the text and of the file) are
+    skipped. Invalid lines are reported by their number in the text or
+    in the file.
+    """
+
+    positions = forms.CharField(widget=forms.Textarea, required=False,
+                                help_text="RA and dec. (degrees), one "
+                                "position per line")
+    file = forms.FileField(required=False,
+                           help_text="CSV or text file with the same format")
+
+    # Number of invalid lines reported
+    MAX_ERRORS = 10
+
+    def clean(self):
+        cleaned_data = super(MonitoringListUploadForm, self).clean()
+        # The text and the file are numbered separately, and may each
+        # start with a header line
+        sources = [(u"text", cleaned_data.get('positions') or u"")]
+        upload = cleaned_data.get('file')
+        if upload is not None:
+            maxsize = getattr(settings, 'MONITORINGLIST_MAX_UPLOAD_BYTES',
+                              10*1024*1024)
+            if upload.size > maxsize:
+                raise forms.ValidationError(
+                    "File too large (%d bytes); the maximum is %d bytes" %
+                    (upload.size, maxsize))
+            sources.append((u"file", upload.read(maxsize).decode(
+                'utf-8-sig', 'replace')))
+        positions, numbers, errors = [], [], []
+        for source, (_, text) in enumerate(sources):
+            lines = [(number, line.strip()) for number, line in
+                     enumerate(text.splitlines(), 1)]
+            lines = [(number, line) for number, line in lines
+                     if line and not line.startswith('#')]
+            for i, (number, line) in enumerate(lines):
+                fields = re.split(r"[\s,;]+", line)
+                try:
+                    ra, dec = float(fields[0]), float(fields[1])
+                except (IndexError, ValueError):
+                    if i == 0:  # Header line
+                        continue
+                    errors.append((source, number))
+                    continue
+                positions.append((ra, dec))
+                numbers.append((source, number))
+        if positions:
+            # Validate all positions at once
+            array = numpy.array(positions)
+            valid = ((array[:, 0] >= 0) & (array[:, 0] < 360) &
+                     (array[:, 1] >= -90) & (array[:, 1] <= 90))
+            errors.extend(number for number, ok in zip(numbers, valid)
+                          if not ok)
+        if errors:
+            errors.sort()
+            raise forms.ValidationError(
+                "Invalid position on %s%s" % (
+                    ", ".join("%s line %d" % (sources[source][0], number)
+                              for source, number in
+                              errors[:self.MAX_ERRORS]),
+                    " and %d more" % (len(errors) - self.MAX_ERRORS)
+                    if len(errors) > self.MAX_ERRORS else ""))
+        if not positions:
+            raise forms.ValidationError("No positions given")
+        maximum = getattr(settings, 'MONITORINGLIST_MAX_UPLOAD', 100000)
+        if len(positions) > maximum:
+            raise forms.ValidationError(
+                "Too many positions (%d); the maximum is %d" %
+                (len(positions), maximum))
+        cleaned_data['positions'] = positions
+        return cleaned_data
+
+
+class ConeSearchForm(forms.Form):
+    """A cone search in the sources or monitoring list of a dataset"""
+
+    ra = forms.FloatField(min_value=0, help_text="degrees")
+    dec = forms.FloatField(min_value=-90, max_value=90, help_text="degrees")
+    radius = forms.FloatField(min_value=0, initial=60, help_text="arcsec")
+    table = forms.ChoiceField(choices=(('source', "Sources"),
+                                       ('monitoringlist', "Monitoring list")),
+                              initial='source')
+
+    def clean_ra(self):
+        ra = self.cleaned_data['ra']
+        if ra >= 360:
+            raise forms.ValidationError("Ensure this value is less than 360.")
+        return ra
+
+    def clean_radius(self):
+        radius = self.cleaned_data['radius']
+        maximum = getattr(settings, 'CONE_SEARCH_MAX_RADIUS', 36000)
+        if radius > maximum:
+            raise forms.ValidationError(
+                "Ensure this value is less than or equal to %g." % maximum)
+        return radius
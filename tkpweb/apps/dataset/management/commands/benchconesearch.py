@@ -0,0 +1,77 @@
+import time
+from optparse import make_option
+import numpy
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb.apps.dataset.tools import dbase
+from tkpweb.apps.dataset.tools import conesearch
+
+
+class Command(BaseCommand):
+    args = '<dataset id>'
+    help = ("Time cone searches over the running catalog of a dataset: "
+            "building the in-process index, searching it, and the SQL "
+            "query used for datasets that are still being processed")
+    option_list = BaseCommand.option_list + (
+        make_option('--searches', type='int', default=100,
+                    help="Number of searches, around random sources of "
+                    "the dataset [default: %default]"),
+        make_option('--radius', type='float', default=60.,
+                    help="Search radius in arcsec [default: %default]"),
+        make_option('--host', help="Database host"),
+        make_option('--port', type='int', help="Database port"),
+        make_option('--name', help="Database name"),
+        make_option('--user', help="Database user"),
+        make_option('--password', help="Database password"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give a single dataset id")
+        try:
+            dataset = int(args[0])
+        except ValueError:
+            raise CommandError("The dataset id should be an integer")
+        # Use the default (tkp.cfg) database unless specified otherwise
+        dblogin = dict(
+            (key, options[key])
+            for key in ('host', 'port', 'name', 'user', 'password')
+            if options[key] is not None)
+        if dblogin:
+            dblogin.setdefault('user', dblogin.get('name'))
+            dblogin.setdefault('password', dblogin.get('name'))
+        database = dbase.DataBase(dblogin=dblogin)
+        radius = options['radius'] / 3600.
+        start = time.time()
+        sources = database.columns("""\
+SELECT xtrsrc_id, wm_ra, wm_decl FROM runningcatalog WHERE ds_id = %s""",
+                                   dataset)
+        fetched = time.time() - start
+        if not len(sources['xtrsrc_id']):
+            raise CommandError("Dataset %d has no sources" % dataset)
+        start = time.time()
+        index = conesearch.ConeIndex(sources['xtrsrc_id'], sources['wm_ra'],
+                                     sources['wm_decl'])
+        built = time.time() - start
+        self.stdout.write(
+            "%d sources: fetched in %.2fs, index (%d bytes) built in %.2fs\n"
+            % (len(index), fetched, index.nbytes, built))
+        random = numpy.random.RandomState(42)
+        centres = random.randint(len(index), size=options['searches'])
+        self.stdout.write("%6s %12s %12s %10s\n" % (
+            "method", "mean", "max", "results"))
+        for method in ('index', 'sql'):
+            times, results = [], 0
+            for i in centres:
+                ra, dec = index.ra[i], index.dec[i]
+                start = time.time()
+                if method == 'index':
+                    found = index.search(ra, dec, radius)
+                else:
+                    found = conesearch.sql_search(database, dataset,
+                                                  ra, dec, radius)
+                times.append(time.time() - start)
+                results += len(found['id'])
+            self.stdout.write("%6s %10.2fms %10.2fms %10d\n" % (
+                method, numpy.mean(times) * 1000, numpy.max(times) * 1000,
+                results))
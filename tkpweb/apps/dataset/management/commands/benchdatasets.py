@@ -0,0 +1,76 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb.apps.dataset.tools import dbase
+from tkpweb.apps.dataset.tools import querylog
+
+
+class Command(BaseCommand):
+    help = ("Time the extra_info counts of the dataset listing for the "
+            "first N datasets of a database: one query per dataset per "
+            "item (as before) against one grouped query per item")
+    option_list = BaseCommand.option_list + (
+        make_option('--counts', default='10,100,1000',
+                    help="Comma separated numbers of datasets "
+                    "[default: %default]"),
+        make_option('--repeat', type='int', default=3,
+                    help="Number of runs per measurement; the fastest "
+                    "is reported [default: %default]"),
+        make_option('--host', help="Database host"),
+        make_option('--port', type='int', help="Database port"),
+        make_option('--name', help="Database name"),
+        make_option('--user', help="Database user"),
+        make_option('--password', help="Database password"),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(count) for count in options['counts'].split(',')]
+        except ValueError:
+            raise CommandError("Dataset counts should be integers")
+        # Use the default (tkp.cfg) database unless specified otherwise
+        dblogin = dict(
+            (key, options[key])
+            for key in ('host', 'port', 'name', 'user', 'password')
+            if options[key] is not None)
+        if dblogin:
+            dblogin.setdefault('user', dblogin.get('name'))
+            dblogin.setdefault('password', dblogin.get('name'))
+        database = dbase.DataBase(dblogin=dblogin)
+        ids = [id for (id,) in database.db.get(
+            "SELECT dsid FROM datasets ORDER BY dsid")]
+        self.stdout.write("%d datasets in the database\n" % len(ids))
+        self.stdout.write("%10s %20s %20s\n" % (
+            "datasets", "per dataset", "grouped"))
+        for count in counts:
+            if count > len(ids):
+                self.stdout.write("%10d %41s\n" % (
+                    count, "(not enough datasets)"))
+                continue
+            selection = ids[:count]
+            per_dataset = self.time(options['repeat'], lambda: [
+                database._count_per_dataset(key, dataset=id)
+                for id in selection for key in dbase.DATASET_COUNTS])
+            # The grouped queries cover all datasets of the database
+            grouped = self.time(options['repeat'], lambda: [
+                database._count_per_dataset(key)
+                for key in dbase.DATASET_COUNTS])
+            self.stdout.write("%10d %s\n" % (count, " ".join(
+                "%9.3fs %4d queries" % result
+                for result in (per_dataset, grouped))))
+
+    def time(self, repeat, function):
+        """Return the fastest time of repeat calls to function, and the
+        number of queries of a call"""
+
+        times = []
+        for i in range(repeat):
+            log = querylog.start()
+            start = time.time()
+            try:
+                function()
+            finally:
+                times.append(time.time() - start)
+                querylog.stop()
+        return min(times), log.count
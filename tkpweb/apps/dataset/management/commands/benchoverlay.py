@@ -0,0 +1,83 @@
+import time
+from optparse import make_option
+import numpy
+import pyfits
+import pywcs
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb.apps.dataset.tools import plot
+
+
+class ShowEllipsesPlot(plot.ImagePlot):
+    """The source overlay as before: one patch per source, through
+    aplpy.show_ellipses()"""
+
+    def plot_sources(self, image, sources, overlay='auto'):
+        ra, dec, semimajor, semiminor, pa = self.source_arrays(sources)
+        image.show_ellipses(list(ra), list(dec), list(semimajor/900),
+                            list(semiminor/900), list(pa+90),
+                            facecolor='none', edgecolor='green')
+
+
+class Command(BaseCommand):
+    args = '<FITS image>'
+    help = ("Time the rendering of an image with source overlays of "
+            "random sources, for each overlay mode")
+    option_list = BaseCommand.option_list + (
+        make_option('--counts', default='1000,10000,100000',
+                    help="Comma separated numbers of sources "
+                    "[default: %default]"),
+        make_option('--max-show-ellipses', type='int', default=10000,
+                    help="Largest number of sources to time with "
+                    "aplpy.show_ellipses() [default: %default]"),
+        make_option('--repeat', type='int', default=3,
+                    help="Number of renders per measurement; the fastest "
+                    "is reported [default: %default]"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give a single FITS image")
+        filename = args[0]
+        try:
+            counts = [int(count) for count in options['counts'].split(',')]
+        except ValueError:
+            raise CommandError("Source counts should be integers")
+        header = pyfits.getheader(filename)
+        wcs = pywcs.WCS(header, naxis=2)
+        random = numpy.random.RandomState(42)
+        dbimage = {'url': filename}
+        self.stdout.write("%10s %12s %12s %12s %12s\n" % (
+            "sources", "no overlay", "ellipses", "points", "show_ellipses"))
+        base = self.time(plot.ImagePlot(), options['repeat'], dbimage)
+        for count in counts:
+            x = random.uniform(0, header['NAXIS1'], count)
+            y = random.uniform(0, header['NAXIS2'], count)
+            ra, dec = wcs.wcs_pix2sky(x, y, 0)
+            sources = {
+                'ra': ra, 'decl': dec,
+                'semimajor': random.uniform(5, 50, count),
+                'semiminor': random.uniform(5, 50, count),
+                'pa': random.uniform(-90, 90, count)}
+            results = [base]
+            for overlay in ('ellipses', 'points'):
+                results.append(self.time(
+                    plot.ImagePlot(), options['repeat'], dbimage,
+                    plotsources=sources, overlay=overlay))
+            if count <= options['max_show_ellipses']:
+                results.append(self.time(
+                    ShowEllipsesPlot(), options['repeat'], dbimage,
+                    plotsources=sources))
+            else:
+                results.append(None)
+            self.stdout.write("%10d %s\n" % (count, " ".join(
+                "%11.2fs" % result if result is not None else "%12s" % "-"
+                for result in results)))
+
+    def time(self, imageplot, repeat, *args, **kwargs):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            imageplot.render(*args, **kwargs)
+            times.append(time.time() - start)
+        return min(times)
@@ -0,0 +1,86 @@
+import gc
+import time
+import resource
+import multiprocessing
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from tkpweb.apps.dataset.tools import rows
+
+
+# Aliases as for the extracted sources
+ALIASES = (('xtrsrcid', 'id'), ('xtrsrc_id', 'assoc_id'),
+           ('image_id', 'image'))
+
+
+class Cursor(object):
+    """Stand-in for a database cursor, with nrows rows of ncolumns
+    float values; the last columns are those of ALIASES"""
+
+    def __init__(self, nrows, ncolumns):
+        names = ['c%d' % i for i in range(ncolumns - len(ALIASES))]
+        names.extend(column for column, alias in ALIASES)
+        self.description = [(name,) for name in names]
+        self.results = [tuple(float(i) for i in range(ncolumns))
+                        for _ in xrange(nrows)]
+
+    def fetchall(self):
+        return self.results
+
+
+def dict_rows(cursor, aliases=()):
+    """The previous DataBase._iterrows(): a dict per row, with a copy of
+    the aliased values"""
+
+    description = dict(
+        [(d[0], i) for i, d in enumerate(cursor.description)])
+    for row in cursor.fetchall():
+        result = dict([(key, row[column])
+                       for key, column in description.iteritems()])
+        for key1, key2 in aliases:
+            result[key2] = result[key1]
+        yield result
+
+
+def measure(mode, nrows, ncolumns):
+    """Return the time (s) and the increase of the peak memory use (MB)
+    for converting the rows of a Cursor in the given mode"""
+
+    cursor = Cursor(nrows, ncolumns)
+    gc.collect()
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if mode == 'dict':
+        results = list(dict_rows(cursor, ALIASES))
+    else:
+        results = list(rows.rows(cursor, ALIASES))
+    duration = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del results
+    return duration, (peak - base) / 1024.
+
+
+class Command(BaseCommand):
+    help = ("Time and measure the memory use of converting a large "
+            "synthetic cursor result to dicts (as before) and to row "
+            "objects")
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000000,
+                    help="Number of rows [default: %default]"),
+        make_option('--columns', type='int', default=40,
+                    help="Number of columns [default: %default]"),
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d rows, %d columns, %d aliases\n" % (
+            options['rows'], options['columns'], len(ALIASES)))
+        for mode in ('dict', 'row'):
+            # A fresh process per mode, as the peak memory use only grows
+            pool = multiprocessing.Pool(1)
+            try:
+                duration, memory = pool.apply(
+                    measure, (mode, options['rows'], options['columns']))
+            finally:
+                pool.close()
+                pool.join()
+            self.stdout.write("%-5s %8.1f s %8d MB\n" % (
+                mode, duration, memory))
@@ -0,0 +1,72 @@
+import time
+import shutil
+import tempfile
+from optparse import make_option
+import numpy
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb import settings
+from tkpweb.apps.dataset.tools import plot
+from tkpweb.apps.dataset.tools import tiles
+
+
+class Command(BaseCommand):
+    args = '<FITS image>'
+    help = ("Time building the tile pyramid of a (large) FITS image, "
+            "rendering and serving its tiles, and rendering the single "
+            "image as ImagePlotView does")
+    option_list = BaseCommand.option_list + (
+        make_option('--tiles', type='int', default=20,
+                    help="Number of random tiles per level "
+                    "[default: %default]"),
+        make_option('--no-single', action='store_false', dest='single',
+                    default=True,
+                    help="Don't time the single image rendering"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give a single FITS image")
+        filename = args[0]
+        random = numpy.random.RandomState(42)
+        # Build in an empty cache, so the pyramid is cold
+        tiledir = getattr(settings, 'TILE_CACHE_DIR', None)
+        settings.TILE_CACHE_DIR = tempfile.mkdtemp()
+        try:
+            pyramid = tiles.Pyramid(filename)
+            start = time.time()
+            meta = pyramid.meta
+            self.stdout.write(
+                "%d x %d pixels, %d levels: pyramid built in %.2fs\n" %
+                (meta['width'], meta['height'], meta['levels'],
+                 time.time() - start))
+            self.stdout.write("%6s %8s %12s %12s\n" % (
+                "level", "tiles", "rendered", "from disk"))
+            size = meta['tilesize']
+            for z in range(meta['levels']):
+                factor = 2**(meta['levels'] - 1 - z)
+                nx = -(-meta['width'] // (size * factor))
+                ny = -(-meta['height'] // (size * factor))
+                positions = set(
+                    (random.randint(nx), random.randint(ny))
+                    for i in range(min(options['tiles'], nx * ny)))
+                times = []
+                for attempt in range(2):
+                    start = time.time()
+                    for x, y in positions:
+                        pyramid.tile(z, x, y)
+                    times.append((time.time() - start) / len(positions))
+                self.stdout.write("%6d %8d %11.3fs %11.4fs\n" % (
+                    z, len(positions), times[0], times[1]))
+        finally:
+            shutil.rmtree(settings.TILE_CACHE_DIR, ignore_errors=True)
+            if tiledir is None:
+                del settings.TILE_CACHE_DIR
+            else:
+                settings.TILE_CACHE_DIR = tiledir
+        if options['single']:
+            imageplot = plot.ImagePlot(size=(12, 12))
+            start = time.time()
+            imageplot.render({'url': filename})
+            self.stdout.write("single image rendered in %.2fs (%d bytes)\n" %
+                              (time.time() - start, len(imageplot.data)))
@@ -0,0 +1,49 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb.apps.dataset.tools import dbase
+from tkpweb.apps.dataset.tools import headers
+
+
+class Command(BaseCommand):
+    args = '<dataset id> [<dataset id> ...]'
+    help = ("Add the header information of all images in the given "
+            "dataset(s) to the image header index")
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh', action='store_true', default=False,
+                    help="Reread all images, including those already "
+                    "indexed"),
+        make_option('--host', help="Database host"),
+        make_option('--port', type='int', help="Database port"),
+        make_option('--name', help="Database name"),
+        make_option('--user', help="Database user"),
+        make_option('--password', help="Database password"),
+        )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("No dataset given")
+        try:
+            datasets = [int(arg) for arg in args]
+        except ValueError:
+            raise CommandError("Dataset ids should be integers")
+        # Use the default (tkp.cfg) database unless specified otherwise
+        dblogin = dict(
+            (key, options[key])
+            for key in ('host', 'port', 'name', 'user', 'password')
+            if options[key] is not None)
+        if dblogin:
+            dblogin.setdefault('user', dblogin.get('name'))
+            dblogin.setdefault('password', dblogin.get('name'))
+        database = dbase.DataBase(dblogin=dblogin)
+        for dataset in datasets:
+            urls = [url for (url,) in database.db.get(
+                "SELECT url FROM images WHERE ds_id = %s", dataset)]
+            centres = headers.phase_centres(
+                urls, database=database.db, validate=True,
+                refresh=options['refresh'])
+            unreadable = len([url for url, centre in centres.iteritems()
+                              if centre == (None, None)])
+            self.stdout.write(
+                "Dataset %d: indexed %d images (%d without phase centre)\n" %
+                (dataset, len(centres), unreadable))
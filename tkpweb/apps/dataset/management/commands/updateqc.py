@@ -0,0 +1,40 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkpweb.apps.dataset.tools import dbase
+from tkpweb.apps.dataset.tools import qcsummary
+
+
+class Command(BaseCommand):
+    args = '<dataset id> [<dataset id> ...]'
+    help = ("Bring the quality control summaries of the given dataset(s) "
+            "up to date, for example periodically during a pipeline run")
+    option_list = BaseCommand.option_list + (
+        make_option('--host', help="Database host"),
+        make_option('--port', type='int', help="Database port"),
+        make_option('--name', help="Database name"),
+        make_option('--user', help="Database user"),
+        make_option('--password', help="Database password"),
+        )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("No dataset given")
+        try:
+            datasets = [int(arg) for arg in args]
+        except ValueError:
+            raise CommandError("Dataset ids should be integers")
+        # Use the default (tkp.cfg) database unless specified otherwise
+        dblogin = dict(
+            (key, options[key])
+            for key in ('host', 'port', 'name', 'user', 'password')
+            if options[key] is not None)
+        if dblogin:
+            dblogin.setdefault('user', dblogin.get('name'))
+            dblogin.setdefault('password', dblogin.get('name'))
+        database = dbase.DataBase(dblogin=dblogin)
+        for dataset in datasets:
+            summary = qcsummary.get(database, dataset)
+            self.stdout.write(
+                "Dataset %d: summarized %d images (%d sources)\n" %
+                (dataset, len(summary.imageid), summary.nsources.sum()))
@@ -0,0 +1,38 @@
+from django.template.loader import render_to_string
+from tkpweb import settings
+from .tools import querylog
+
+
+class QueryLogMiddleware(object):
+    """Account for the TKP database queries made during a request
+
+    Adds the number of queries and their total time (in ms) as the
+    X-DB-Queries and X-DB-Time response headers. If the DB_QUERY_PANEL
+    setting is true, HTML responses for requests with a 'querylog' GET
+    parameter get a panel listing all queries, with duplicates and
+    repeated (N+1) query patterns.
+    """
+
+    def process_request(self, request):
+        querylog.start()
+
+    def process_response(self, request, response):
+        log = querylog.stop()
+        if log is None:
+            return response
+        response['X-DB-Queries'] = str(log.count)
+        response['X-DB-Time'] = "%.1f" % (log.total_time * 1000)
+        if (getattr(settings, 'DB_QUERY_PANEL', False) and
+            'querylog' in request.GET and
+            response.get('Content-Type', '').startswith('text/html')):
+            panel = render_to_string('dataset/querylog.html', {
+                'log': log, 'duplicates': log.duplicates(),
+                'repeated': log.repeated(),
+                'total_time': log.total_time * 1000})
+            content = response.content
+            position = content.rfind('</body>')
+            if position == -1:
+                position = len(content)
+            response.content = (content[:position] + panel.encode('utf-8') +
+                                content[position:])
+        return response
@@ -1,3 +1,44 @@
 from django.db import models
 
-# Create your models here.
+
+class ImageHeader(models.Model):
+    """Index of the image header information needed for the listings
+
+    Obtaining the phase centre of an image requires opening the image
+    file; this index stores the relevant header values, so image
+    listings don't need to read every file on every request. An entry
+    is only valid as long as the modification time and size of the file
+    match those stored.
+    """
+
+    url = models.CharField(max_length=255, unique=True)
+    mtime = models.FloatField()
+    size = models.BigIntegerField()
+    ra = models.FloatField(null=True)
+    dec = models.FloatField(null=True)
+
+    def __unicode__(self):
+        return self.url
+
+
+class QCSummary(models.Model):
+    """Precomputed quality control summary of a dataset
+
+    The summary arrays (see tools.qcsummary) are stored as JSON in data.
+    They include the images up to last_image; newer images are added
+    incrementally. The version is that of the dataset (its processing
+    time stamp and rerun number); a reprocessed dataset is summarized
+    anew.
+    """
+
+    database = models.CharField(max_length=255)
+    dataset = models.IntegerField()
+    version = models.CharField(max_length=64)
+    last_image = models.IntegerField()
+    data = models.TextField()
+
+    class Meta:
+        unique_together = ('database', 'dataset')
+
+    def __unicode__(self):
+        return "%s: %d" % (self.database, self.dataset)
@@ -1,13 +1,13 @@
 $(function ()
 {
-    $("img#sourceplot_0").load(function(){$("div#lightcurve").css('height', $(this).height())});
-    $("img.thumbnail").hover(
+    $("div#lightcurve").css('min-height', $("div#sourceplot_0").height());
+    $("div.thumbnail").hover(
         function ()
 	{
-	    $("img#sourceplot_" + $(this).attr("number")).css('display', 'block');
+	    $("div#sourceplot_" + $(this).attr("number")).css('display', 'block');
 	},
 	function ()
 	{
-	    $("img#sourceplot_" + $(this).attr("number")).css('display', 'none');
+	    $("div#sourceplot_" + $(this).attr("number")).css('display', 'none');
 	});
 });
@@ -0,0 +1,28 @@
+// Fill in plots that are still being rendered, once they are ready
+$(function ()
+{
+    $("img.rendering").each(function ()
+    {
+	var img = $(this);
+	var delay = 500;
+	var tries = 0;
+
+	function poll()
+	{
+	    $.getJSON(img.attr("data-status"), function (data)
+	    {
+		if (data.status == "done") {
+		    img.attr("src", data.url).removeClass("rendering");
+		} else if (data.status == "failed" || data.status == "unknown" ||
+			   ++tries > 60) {
+		    img.attr("alt", "The plot could not be rendered").removeClass("rendering");
+		} else {
+		    // Back off to polling every few seconds
+		    delay = Math.min(delay * 1.5, 5000);
+		    setTimeout(poll, delay);
+		}
+	    });
+	}
+	setTimeout(poll, delay);
+    });
+});
@@ -0,0 +1,160 @@
+// Pan and zoom viewer for the tile pyramid of an image
+$(function ()
+{
+    var viewer = $("div#tileviewer");
+    if (!viewer.length) {
+	return;
+    }
+    var base = viewer.attr("data-tiles");
+    var layer = $('<div style="position: absolute; left: 0; top: 0;"></div>').appendTo(viewer);
+    var overlay = null;
+    var meta = null;
+    var ellipses = [];
+    var z = 0;
+    var offset = {x: 0, y: 0};
+    var svgns = "http://www.w3.org/2000/svg";
+
+    function scale()
+    {
+	return Math.pow(2, z - (meta.levels - 1));
+    }
+
+    function update()
+    {
+	// Add the tiles that are (partly) visible, and drop the others
+	var size = meta.tilesize;
+	var width = Math.ceil(meta.width * scale());
+	var height = Math.ceil(meta.height * scale());
+	var xmin = Math.max(0, Math.floor(-offset.x / size));
+	var ymin = Math.max(0, Math.floor(-offset.y / size));
+	var xmax = Math.min(Math.ceil(width / size), Math.ceil((viewer.width() - offset.x) / size));
+	var ymax = Math.min(Math.ceil(height / size), Math.ceil((viewer.height() - offset.y) / size));
+	layer.css({left: offset.x, top: offset.y});
+	layer.children("img").each(function ()
+	{
+	    var tile = $(this);
+	    var x = tile.data("x"), y = tile.data("y");
+	    if (tile.data("z") != z || x < xmin || x >= xmax || y < ymin || y >= ymax) {
+		tile.remove();
+	    }
+	});
+	for (var y = ymin; y < ymax; y++) {
+	    for (var x = xmin; x < xmax; x++) {
+		if (!layer.children("img#tile_" + z + "_" + x + "_" + y).length) {
+		    $('<img id="tile_' + z + '_' + x + '_' + y + '" />')
+			.data({z: z, x: x, y: y})
+			.css({position: "absolute", left: x * size, top: y * size})
+			.attr("src", base + z + "/" + x + "/" + y + ".png")
+			.appendTo(layer);
+		}
+	    }
+	}
+	if (overlay) {
+	    overlay.setAttribute("width", width);
+	    overlay.setAttribute("height", height);
+	    layer.append(overlay);
+	}
+    }
+
+    function drawOverlay()
+    {
+	if (!overlay) {
+	    return;
+	}
+	while (overlay.firstChild) {
+	    overlay.removeChild(overlay.firstChild);
+	}
+	var s = scale();
+	$.each(ellipses, function (i, e)
+	{
+	    var ellipse = document.createElementNS(svgns, "ellipse");
+	    ellipse.setAttribute("cx", e[0] * s);
+	    ellipse.setAttribute("cy", e[1] * s);
+	    ellipse.setAttribute("rx", Math.max(e[2] * s / 2, 1));
+	    ellipse.setAttribute("ry", Math.max(e[3] * s / 2, 1));
+	    ellipse.setAttribute("transform", "rotate(" + (-e[4]) + " " + e[0] * s + " " + e[1] * s + ")");
+	    ellipse.setAttribute("fill", "none");
+	    ellipse.setAttribute("stroke", "green");
+	    overlay.appendChild(ellipse);
+	});
+    }
+
+    function zoom(dz, cx, cy)
+    {
+	// Zoom around the point (cx, cy) of the viewer
+	var znew = Math.max(0, Math.min(meta.levels - 1, z + dz));
+	if (znew == z) {
+	    return;
+	}
+	var factor = Math.pow(2, znew - z);
+	offset.x = cx - (cx - offset.x) * factor;
+	offset.y = cy - (cy - offset.y) * factor;
+	z = znew;
+	drawOverlay();
+	update();
+    }
+
+    $.getJSON(base + "meta.json", function (data)
+    {
+	meta = data;
+	// Start at the coarsest level that fills the viewer
+	while (z < meta.levels - 1 && Math.max(meta.width, meta.height) * scale() < viewer.width()) {
+	    z++;
+	}
+	update();
+	$.getJSON(viewer.attr("data-overlay"), function (data)
+	{
+	    ellipses = data.ellipses;
+	    overlay = document.createElementNS(svgns, "svg");
+	    overlay.setAttribute("style", "position: absolute; left: 0; top: 0; pointer-events: none;");
+	    drawOverlay();
+	    update();
+	    $("input#showsources").change(function ()
+	    {
+		$(overlay).toggle(this.checked);
+	    });
+	});
+    });
+
+    var drag = null;
+    viewer.mousedown(function (event)
+    {
+	drag = {x: event.pageX - offset.x, y: event.pageY - offset.y};
+	event.preventDefault();
+    });
+    $(document).mouseup(function ()
+    {
+	drag = null;
+    });
+    $(document).mousemove(function (event)
+    {
+	if (drag && meta) {
+	    offset.x = event.pageX - drag.x;
+	    offset.y = event.pageY - drag.y;
+	    update();
+	}
+    });
+    viewer.bind("mousewheel DOMMouseScroll", function (event)
+    {
+	if (!meta) {
+	    return;
+	}
+	var original = event.originalEvent;
+	var delta = original.wheelDelta ? original.wheelDelta : -original.detail;
+	var position = viewer.offset();
+	zoom(delta > 0 ? 1 : -1, event.pageX - position.left, event.pageY - position.top);
+	event.preventDefault();
+    });
+    $("button#zoomin").click(function ()
+    {
+	if (meta) {
+	    zoom(1, viewer.width() / 2, viewer.height() / 2);
+	}
+    });
+    $("button#zoomout").click(function ()
+    {
+	if (meta) {
+	    zoom(-1, viewer.width() / 2, viewer.height() / 2);
+	}
+    });
+});
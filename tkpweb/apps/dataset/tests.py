@@ -1,11 +1,33 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests for the dataset app; the tools are tested without a TKP database,
+with small stand-ins for the connections and cursors where needed.
 """
 
+import os
+import shutil
+import tempfile
+import datetime
+import StringIO
+import cPickle as pickle
+import numpy
 from django.test import TestCase
+from django.test import SimpleTestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from tkpweb import settings
+from .tools import pool
+from .tools import rows
+from .tools import cache
+from .tools import querylog
+from .tools import cutout
+from .tools import tiles
+from .tools import qcsummary
+from .tools import qcengine
+from .tools import export
+from .tools import conesearch
+from .forms import MonitoringListUploadForm
+from .views import StreamingContent
+from .views import json_list
+from .views import LightcurveDataView
 
 
 class SimpleTest(TestCase):
@@ -14,3 +36,829 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class FakeConnection(object):
+    """Stand-in for a tkp.database.database.DataBase"""
+
+    def __init__(self, fail_rollback=False):
+        self.connection = self
+        self.fail_rollback = fail_rollback
+        self.closed = False
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise RuntimeError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(pool.ConnectionPool):
+
+    def connect(self, dblogin):
+        return FakeConnection()
+
+    def check(self, connection):
+        return not connection.closed
+
+
+class ConnectionPoolTest(SimpleTestCase):
+
+    dblogin = {'host': 'localhost', 'port': 50000, 'name': 'tkp',
+               'user': 'tkp', 'password': 'tkp'}
+
+    def test_reuse(self):
+        connections = FakePool(maxsize=2)
+        first = connections.acquire(self.dblogin)
+        connections.release(self.dblogin, first)
+        self.assertIs(connections.acquire(self.dblogin), first)
+        self.assertEqual(connections.counters['misses'], 1)
+        self.assertEqual(connections.counters['hits'], 1)
+
+    def test_logins_are_kept_apart(self):
+        connections = FakePool(maxsize=2)
+        first = connections.acquire(self.dblogin)
+        connections.release(self.dblogin, first)
+        other = dict(self.dblogin, name='other')
+        self.assertIsNot(connections.acquire(other), first)
+
+    def test_timeout(self):
+        connections = FakePool(maxsize=1, timeout=0.01)
+        connections.acquire(self.dblogin)
+        self.assertRaises(pool.PoolTimeout, connections.acquire, self.dblogin)
+        self.assertEqual(connections.counters['waits'], 1)
+        self.assertEqual(connections.counters['timeouts'], 1)
+
+    def test_failed_rollback_discards(self):
+        connections = FakePool(maxsize=1, timeout=0.01)
+        connection = FakeConnection(fail_rollback=True)
+        connections.size[connections.key(self.dblogin)] = 1
+        connections.release(self.dblogin, connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(connections.counters['discarded'], 1)
+        # The slot is free again
+        self.assertIsNot(connections.acquire(self.dblogin), connection)
+
+    def test_idle_timeout(self):
+        connections = FakePool(maxsize=1, idle_timeout=-1)
+        first = connections.acquire(self.dblogin)
+        connections.release(self.dblogin, first)
+        self.assertIsNot(connections.acquire(self.dblogin), first)
+        self.assertTrue(first.closed)
+
+
+class FakeCursor(object):
+    """Stand-in for a DB-API cursor, with fetchmany()"""
+
+    def __init__(self, columns, results):
+        self.description = [(column, 'int', None, None, None, None, None)
+                            for column in columns]
+        self.results = list(results)
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+    def fetchmany(self, size):
+        results, self.results = self.results[:size], self.results[size:]
+        return results
+
+
+class RowTest(SimpleTestCase):
+
+    columns = ('xtrsrc_id', 'ds_id', 'wm_ra')
+    aliases = (('xtrsrc_id', 'id'), ('ds_id', 'dataset'))
+
+    def row(self, values=(1, 2, 10.5)):
+        return rows.row_class(self.columns, self.aliases)(values)
+
+    def test_columns_and_aliases(self):
+        row = self.row()
+        self.assertEqual(row['xtrsrc_id'], 1)
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(row.dataset, 2)
+        self.assertEqual(row.get('missing', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: row['missing'])
+        self.assertEqual(sorted(row.keys()),
+                         ['dataset', 'ds_id', 'id', 'wm_ra', 'xtrsrc_id'])
+
+    def test_shared_class(self):
+        self.assertIs(type(self.row()), type(self.row((3, 4, 5.))))
+
+    def test_assignment(self):
+        row = self.row()
+        row['npoints'] = 7
+        self.assertEqual(row['npoints'], 7)
+        self.assertIn('npoints', row)
+        self.assertEqual(dict(row.items())['npoints'], 7)
+
+    def test_alias_sync(self):
+        row = self.row()
+        row['id'] = 5
+        self.assertEqual(row['xtrsrc_id'], 5)
+        row['ds_id'] = 6
+        self.assertEqual(row['dataset'], 6)
+        self.assertEqual(row['wm_ra'], 10.5)
+
+    def test_pickle(self):
+        row = self.row()
+        row['npoints'] = 7
+        copy = pickle.loads(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(dict(copy.items()), dict(row.items()))
+        self.assertIs(type(copy), type(row))
+
+    def test_rows_in_chunks(self):
+        cursor = FakeCursor(self.columns, [(i, 1, 0.) for i in range(5)])
+        result = list(rows.rows(cursor, self.aliases, chunksize=2))
+        self.assertEqual([row.id for row in result], range(5))
+
+
+class LocalCacheTest(SimpleTestCase):
+
+    def test_lru_eviction(self):
+        local = cache.LocalCache(max_bytes=10)
+        local.set('a', 'xxxx')
+        local.set('b', 'xxxx')
+        local.get('a')
+        local.set('c', 'xxxx')
+        self.assertEqual(local.get('a'), 'xxxx')
+        self.assertIsNone(local.get('b'))
+        self.assertEqual(local.get('c'), 'xxxx')
+        self.assertEqual(local.size, 8)
+
+    def test_too_large(self):
+        local = cache.LocalCache(max_bytes=3)
+        local.set('a', 'xxxx')
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(local.size, 0)
+
+
+class DiskCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_get_set(self):
+        disk = cache.DiskCache(self.path)
+        disk.set('a', 'value')
+        self.assertEqual(disk.get('a'), 'value')
+        self.assertIsNone(disk.get('b'))
+
+    def test_eviction(self):
+        disk = cache.DiskCache(self.path, max_bytes=10)
+        disk.set('a', 'xxxx')
+        disk.set('b', 'xxxx')
+        disk.set('c', 'xxxx')
+        self.assertLessEqual(disk.size, 10)
+        self.assertEqual(
+            len([name for name in os.listdir(self.path)
+                 if name.endswith('.cache')]), 2)
+
+    def test_evict_interval(self):
+        disk = cache.DiskCache(self.path, max_bytes=100, evict_interval=2)
+        disk.set('a', 'xxxx')
+        # A write by another process is noticed at the next scan
+        with open(disk.filename('other'), 'wb') as outfile:
+            outfile.write('x' * 50)
+        disk.set('b', 'xxxx')
+        self.assertEqual(disk.size, 8)
+        disk.set('c', 'xxxx')
+        self.assertEqual(disk.size, 62)
+
+
+class FakeDataBase(object):
+    """Stand-in for a dbase.DataBase with a result cache"""
+
+    def __init__(self, versions):
+        self.cache = cache.ResultCache(cache.LocalCache())
+        self.versions = versions
+        self.calls = 0
+
+    def login_key(self):
+        return ('localhost', 50000, 'tkp', 'tkp')
+
+    def dataset_version(self, dataset):
+        return self.versions.get(dataset)
+
+    @cache.cached()
+    def sources(self, dataset, ids=None, after=None):
+        self.calls += 1
+        return [dataset, ids, after]
+
+
+class CachedTest(SimpleTestCase):
+
+    def test_cached(self):
+        database = FakeDataBase({1: ('2012-01-01', 0)})
+        self.assertEqual(database.sources(1), [1, None, None])
+        self.assertEqual(database.sources(dataset=1), [1, None, None])
+        self.assertEqual(database.calls, 1)
+
+    def test_normalized_arguments(self):
+        database = FakeDataBase({1: ('2012-01-01', 0)})
+        database.sources('1', ids=[3, 2, 2])
+        database.sources(1, ids=set([2, 3]))
+        self.assertEqual(database.calls, 1)
+        # The order of paging keys matters
+        database.sources(1, after=(2, 3))
+        database.sources(1, after=(3, 2))
+        self.assertEqual(database.calls, 3)
+
+    def test_unprocessed_dataset(self):
+        database = FakeDataBase({})
+        database.sources(1)
+        database.sources(1)
+        self.assertEqual(database.calls, 2)
+
+    def test_invalidate(self):
+        database = FakeDataBase({1: ('2012-01-01', 0)})
+        database.sources(1)
+        database.cache.invalidate(database.login_key(), 1)
+        database.sources(1)
+        self.assertEqual(database.calls, 2)
+
+    def test_new_version(self):
+        database = FakeDataBase({1: ('2012-01-01', 0)})
+        database.sources(1)
+        database.versions[1] = ('2012-01-01', 1)
+        database.sources(1)
+        self.assertEqual(database.calls, 2)
+
+
+class QueryLogTest(SimpleTestCase):
+
+    def tearDown(self):
+        querylog.stop()
+
+    def test_shape(self):
+        self.assertEqual(
+            querylog.shape("SELECT *\n  FROM images WHERE ds_id = 12 "
+                           "AND url = 'a''b' AND x > 1.5e3"),
+            "SELECT * FROM images WHERE ds_id = ? AND url = ? AND x > ?")
+
+    def test_record(self):
+        log = querylog.start()
+        querylog.record("SELECT 1", (), 1, 0.5)
+        self.assertIs(querylog.stop(), log)
+        querylog.record("SELECT 2", (), 1, 0.5)
+        self.assertEqual(log.count, 1)
+        self.assertEqual(log.total_time, 0.5)
+
+    def test_duplicates(self):
+        log = querylog.QueryLog()
+        for dataset in (1, 1, 1, 2):
+            log.add("SELECT * FROM images WHERE ds_id = %s", (dataset,),
+                    1, 0.1)
+        self.assertEqual(log.duplicates(), [
+            ("SELECT * FROM images WHERE ds_id = %s", repr((1,)), 3)])
+
+    def test_repeated(self):
+        log = querylog.QueryLog()
+        for image in range(5):
+            log.add("SELECT * FROM extractedsources WHERE image_id = %d" %
+                    image, (), 1, 0.1)
+        log.add("SELECT * FROM images", (), 5, 0.1)
+        repeated = log.repeated(threshold=5)
+        self.assertEqual(len(repeated), 1)
+        shape, count, duration = repeated[0]
+        self.assertEqual(shape,
+                         "SELECT * FROM extractedsources WHERE image_id = ?")
+        self.assertEqual(count, 5)
+        self.assertAlmostEqual(duration, 0.5)
+        self.assertEqual(log.repeated(threshold=6), [])
+
+
+class override(object):
+    """Temporarily change (or add) tkpweb settings"""
+
+    def __init__(self, **values):
+        self.values = values
+        self.saved = {}
+
+    def __enter__(self):
+        for name, value in self.values.iteritems():
+            if hasattr(settings, name):
+                self.saved[name] = getattr(settings, name)
+            setattr(settings, name, value)
+
+    def __exit__(self, *exc_info):
+        for name in self.values:
+            if name in self.saved:
+                setattr(settings, name, self.saved[name])
+            else:
+                delattr(settings, name)
+
+
+class MonitoringListUploadFormTest(SimpleTestCase):
+
+    def form(self, text=u"", upload=None):
+        files = {}
+        if upload is not None:
+            files['file'] = SimpleUploadedFile('positions.csv', upload)
+        return MonitoringListUploadForm(data={'positions': text}, files=files)
+
+    def test_positions(self):
+        form = self.form(u"ra,dec\n# comment\n\n10.5,-20\n11 21\n12;22\n")
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['positions'],
+                         [(10.5, -20.), (11., 21.), (12., 22.)])
+
+    def test_invalid_lines(self):
+        form = self.form(u"ra dec\n10 20\nten twenty\n400 0\n10 -91\n")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), [
+            "Invalid position on text line 3, text line 4, text line 5"])
+
+    def test_upload(self):
+        form = self.form(u"1 2", upload="\xef\xbb\xbf10 20\r\n30 40\r\n")
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['positions'],
+                         [(1., 2.), (10., 20.), (30., 40.)])
+
+    def test_upload_header(self):
+        form = self.form(u"1 2", upload="ra,dec\n10,20\n")
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['positions'],
+                         [(1., 2.), (10., 20.)])
+
+    def test_upload_invalid_lines(self):
+        form = self.form(u"1 2\nthree four",
+                         upload="ra,dec\n10,20\nbad line\n400,0\n")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), [
+            "Invalid position on text line 2, file line 3, file line 4"])
+        # Without text, the file lines are numbered from 1
+        form = self.form(upload="400 0\n10 20\n")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(),
+                         ["Invalid position on file line 1"])
+
+    def test_upload_too_large(self):
+        with override(MONITORINGLIST_MAX_UPLOAD_BYTES=8):
+            form = self.form(upload="10 20\n30 40\n")
+            self.assertFalse(form.is_valid())
+        self.assertIn("File too large", form.non_field_errors()[0])
+
+    def test_too_many(self):
+        with override(MONITORINGLIST_MAX_UPLOAD=2):
+            form = self.form(u"1 2\n3 4\n5 6")
+            self.assertFalse(form.is_valid())
+        self.assertIn("Too many positions", form.non_field_errors()[0])
+
+    def test_empty(self):
+        form = self.form(u"ra dec\n")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), ["No positions given"])
+
+
+class CutoutTest(SimpleTestCase):
+
+    data = numpy.arange(100, dtype=numpy.float32).reshape(10, 10)
+
+    def test_inside(self):
+        result = cutout._cut(self.data, 5, 4, (2, 3))
+        self.assertEqual(result.shape, (6, 4))
+        self.assertTrue((result == self.data[1:7, 3:7]).all())
+
+    def test_rounding(self):
+        self.assertTrue((cutout._cut(self.data, 4.6, 3.6, (2, 3)) ==
+                         cutout._cut(self.data, 5, 4, (2, 3))).all())
+
+    def test_edge(self):
+        result = cutout._cut(self.data, 0, 9, (2, 2))
+        self.assertTrue(numpy.isnan(result[:, :2]).all())
+        self.assertTrue(numpy.isnan(result[3:]).all())
+        self.assertTrue((result[:3, 2:] == self.data[7:, :2]).all())
+
+    def test_outside(self):
+        self.assertTrue(numpy.isnan(
+            cutout._cut(self.data, 20, 20, (2, 2))).all())
+
+    def test_sprite_layout(self):
+        self.assertEqual(cutout.sprite_layout(0), (1, 1))
+        self.assertEqual(cutout.sprite_layout(1), (1, 1))
+        self.assertEqual(cutout.sprite_layout(5), (3, 2))
+        self.assertEqual(cutout.sprite_layout(9), (3, 3))
+        self.assertEqual(cutout.sprite_layout(10), (4, 3))
+
+
+class DownsampleTest(SimpleTestCase):
+
+    def downsample(self, data, chunk_rows=tiles.CHUNK_ROWS):
+        height, width = data.shape
+        out = numpy.empty(((height + 1) // 2, (width + 1) // 2))
+        tiles._downsample(data, out, chunk_rows=chunk_rows)
+        return out
+
+    def test_mean(self):
+        data = numpy.arange(16.).reshape(4, 4)
+        self.assertTrue((self.downsample(data) ==
+                         [[2.5, 4.5], [10.5, 12.5]]).all())
+
+    def test_chunks(self):
+        data = numpy.arange(80.).reshape(8, 10)
+        self.assertTrue((self.downsample(data, chunk_rows=2) ==
+                         self.downsample(data)).all())
+
+    def test_odd_shape(self):
+        data = numpy.arange(9.).reshape(3, 3)
+        self.assertTrue((self.downsample(data) ==
+                         [[2., 3.5], [6.5, 8.]]).all())
+
+    def test_nan(self):
+        data = numpy.arange(16.).reshape(4, 4)
+        data[0, 0] = numpy.nan
+        data[2:, 2:] = numpy.nan
+        out = self.downsample(data)
+        self.assertAlmostEqual(out[0, 0], 10 / 3.)
+        self.assertTrue(numpy.isnan(out[1, 1]))
+
+
+class SummaryTest(SimpleTestCase):
+
+    def summary(self):
+        summary = qcsummary.Summary()
+        summary.add_rms_distance(numpy.array([0.05, 1.05, 1.05]),
+                                 numpy.array([0.5, 5., 5.]))
+        summary.add_images(numpy.array([3, 1]),
+                           [datetime.datetime(2012, 1, 1, 12), None],
+                           numpy.array([10, 20]))
+        summary.add_offsets(numpy.array([1., 3., 40., 5.]),
+                            numpy.array([0., 2., 0., numpy.nan]))
+        return summary
+
+    def assertSummaryEqual(self, first, second):
+        for name in ('rms_distance', 'imageid', 'nsources', 'offsets',
+                     'offset_moments'):
+            self.assertTrue((getattr(first, name) ==
+                             getattr(second, name)).all(), name)
+        self.assertTrue((first.taustart.astype(numpy.int64) ==
+                         second.taustart.astype(numpy.int64)).all())
+
+    def test_json(self):
+        summary = self.summary()
+        copy = qcsummary.Summary.from_json(summary.to_json())
+        self.assertSummaryEqual(copy, summary)
+        self.assertEqual(copy.digest(), summary.digest())
+
+    def test_incremental(self):
+        summary = qcsummary.Summary()
+        summary.add_rms_distance(numpy.array([0.05]), numpy.array([0.5]))
+        summary.add_rms_distance(numpy.array([1.05, 1.05]),
+                                 numpy.array([5., 5.]))
+        summary.add_images(numpy.array([3]),
+                           [datetime.datetime(2012, 1, 1, 12)],
+                           numpy.array([10]))
+        summary.add_images(numpy.array([1]), [None], numpy.array([20]))
+        summary.add_offsets(numpy.array([1., 3.]), numpy.array([0., 2.]))
+        summary.add_offsets(numpy.array([40., 5.]),
+                            numpy.array([0., numpy.nan]))
+        self.assertSummaryEqual(summary, self.summary())
+        self.assertEqual(summary.imageid.tolist(), [1, 3])
+        self.assertEqual(summary.nsources.tolist(), [20, 10])
+        self.assertEqual(summary.rms_distance.sum(), 3)
+        self.assertEqual(summary.rms_distance[10].sum(), 2)
+
+    def test_offset_stats(self):
+        self.assertIsNone(qcsummary.Summary().offset_stats())
+        stats = self.summary().offset_stats()
+        self.assertEqual(stats['n'], 3)
+        self.assertAlmostEqual(stats['dec_mean'], 2 / 3.)
+
+
+class QCEngineTest(SimpleTestCase):
+
+    def test_angular_distance(self):
+        xyz = qcengine.unit_vectors([0., 10.], [0., 89.9])
+        other = qcengine.unit_vectors([90., 190.], [0., 89.9])
+        self.assertTrue(numpy.allclose(
+            qcengine.angular_distance(xyz, other), [90., 0.2]))
+
+    def test_profile(self):
+        distance = numpy.array([0.5, 0.5, 0.5, 1.5, numpy.nan, 5.])
+        values = numpy.array([3., 1., 2., 10., 7., 8.])
+        result = qcengine.profile(distance, values, [0., 1., 2., 3.],
+                                  percentiles=(0, 50, 100))
+        self.assertTrue((result[:, 0] == [1., 2., 3.]).all())
+        self.assertTrue((result[:, 1] == 10.).all())
+        # Empty bin
+        self.assertTrue(numpy.isnan(result[:, 2]).all())
+
+    def test_histogram_profile(self):
+        counts = numpy.array([[0, 10, 10, 0], [0, 0, 0, 0]])
+        result = qcengine.histogram_profile(counts, numpy.arange(5.),
+                                            percentiles=(25, 50, 75))
+        self.assertTrue(numpy.allclose(result[:, 0], [1.5, 2., 2.5]))
+        self.assertTrue(numpy.isnan(result[:, 1]).all())
+
+    def test_histogram_profile_logarithmic(self):
+        counts = numpy.array([[0, 10, 0]])
+        result = qcengine.histogram_profile(
+            counts, numpy.array([1., 10., 100., 1000.]), percentiles=(50,))
+        self.assertAlmostEqual(result[0, 0], 10**1.5)
+
+
+class FakeOffsetDataBase(object):
+    """Stand-in for a dbase.DataBase, for the counterpart offsets"""
+
+    def __init__(self, ra, dec):
+        self.ra, self.dec = ra, dec
+
+    def iter_columns(self, query, *args, **kwargs):
+        chunksize = kwargs['chunksize']
+        for start in range(0, len(self.ra), chunksize):
+            yield {'ra_dist_arcsec': self.ra[start:start+chunksize],
+                   'decl_dist_arcsec': self.dec[start:start+chunksize]}
+
+
+class OffsetSummaryTest(SimpleTestCase):
+
+    def test_chunks(self):
+        ra = numpy.linspace(-40, 40, 9)
+        dec = numpy.zeros(9)
+        database = FakeOffsetDataBase(ra, dec)
+        summary = qcsummary.Summary()
+        for chunk in qcsummary.iter_counterpart_offsets(database, 1, 0, 10,
+                                                         chunksize=4):
+            summary.add_offsets(*chunk)
+        whole = qcsummary.Summary()
+        whole.add_offsets(ra, dec)
+        self.assertTrue((summary.offsets == whole.offsets).all())
+        self.assertTrue(numpy.allclose(summary.offset_moments,
+                                       whole.offset_moments))
+
+    def test_outside(self):
+        summary = qcsummary.Summary()
+        summary.add_offsets(numpy.linspace(-40, 40, 9), numpy.zeros(9))
+        stats = summary.offset_stats()
+        self.assertEqual(stats['n'], 9)
+        self.assertEqual(stats['outside'], 2)
+
+
+class FakeExportCursor(object):
+
+    description = (('imageid', 'int', None, 4, None, None, None),
+                   ('url', 'varchar', None, 1024, None, None, None),
+                   ('taustart_ts', 'timestamp', None, 8, None, None, None))
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.results = []
+
+    def execute(self, query, args=None):
+        self.results = [] if "LIMIT 0" in query else list(self.rows)
+
+    def fetchmany(self, size):
+        results, self.results = self.results[:size], self.results[size:]
+        return results
+
+    def close(self):
+        pass
+
+
+class FakeExportDataBase(object):
+    """Stand-in for a dbase.DataBase with an images table"""
+
+    def __init__(self, rows):
+        self.db = self.connection = self
+        self.rows = rows
+
+    def cursor(self):
+        return FakeExportCursor(self.rows)
+
+    def getone(self, query, *args):
+        if "MAX(LENGTH(" in query:
+            # As SQL, skipping NULLs; NULL without any values
+            lengths = [len(row[1]) for row in self.rows if row[1] is not None]
+            return (max(lengths) if lengths else None,)
+        return (len(self.rows),)
+
+
+class ExportTest(SimpleTestCase):
+
+    rows = [(1, 'image1.fits', datetime.datetime(1970, 1, 2)),
+            (2, 'images/image2.fits', None),
+            (None, None, datetime.datetime(1970, 1, 3, 12))]
+
+    def export(self, rows=None, chunksize=2):
+        return export.Export(FakeExportDataBase(rows or self.rows), 'image',
+                             1, chunksize=chunksize)
+
+    def test_string_width(self):
+        dtype = self.export().dtype()
+        self.assertEqual(dtype['url'], numpy.dtype('S18'))
+
+    def test_null_width(self):
+        widths = self.export(rows=[(1, None, None)]).widths()
+        self.assertEqual(widths, {'url': 0})
+        self.assertEqual(self.export(rows=[(1, None, None)]).dtype()['url'],
+                         numpy.dtype('S1'))
+
+    def test_npy(self):
+        array = numpy.load(StringIO.StringIO("".join(self.export().npy())))
+        self.assertEqual(array['imageid'].tolist(), [1, 2, export.NULL_INT])
+        self.assertEqual(array['url'].tolist(),
+                         ['image1.fits', 'images/image2.fits', ''])
+        self.assertEqual(array['taustart_ts'].astype(numpy.int64)[1],
+                         numpy.iinfo(numpy.int64).min)
+
+    def test_fits(self):
+        data = "".join(self.export().fits())
+        self.assertEqual(len(data) % export.FITS_BLOCK, 0)
+        self.assertIn(export._card('NAXIS2', 3, 'number of rows'), data)
+        self.assertIn(export._card('TFORM2', '18A'), data)
+        start = data.index("END" + " " * 77, export.FITS_BLOCK)
+        start += -start % export.FITS_BLOCK
+        dtype = self.export().dtype(fits=True)
+        table = numpy.frombuffer(data[start:start + 3 * dtype.itemsize],
+                                 dtype=dtype)
+        self.assertEqual(table['taustart_ts'][0], 40588.)
+        self.assertEqual(table['taustart_ts'][2], 40589.5)
+        self.assertTrue(numpy.isnan(table['taustart_ts'][1]))
+
+    def test_value_too_long(self):
+        export_ = self.export()
+        dtype = export_.dtype()
+        self.assertRaises(export.ExportError, export_.array,
+                          [(3, 'x' * 19, None)], dtype)
+
+    def test_card(self):
+        card = export._card('SIMPLE', True)
+        self.assertEqual(len(card), 80)
+        self.assertEqual(card[:30], "SIMPLE  = " + " " * 19 + "T")
+        self.assertEqual(export._card('NAXIS1', 42)[10:30], "%20d" % 42)
+        self.assertEqual(export._card('TTYPE1', "it's", 'name')[:33],
+                         "TTYPE1  = 'it''s   '           / ")
+        self.assertEqual(len(export._card('TTYPE1', 'x' * 100)), 80)
+
+    def test_header(self):
+        header = export._header([export._card('SIMPLE', True)])
+        self.assertEqual(len(header), export.FITS_BLOCK)
+        self.assertEqual(header[80:160], "END" + " " * 77)
+        self.assertEqual(header[160:].strip(), "")
+
+
+class StreamingContentTest(SimpleTestCase):
+
+    def setUp(self):
+        self.released = 0
+
+    def release(self):
+        self.released += 1
+
+    def test_close(self):
+        content = StreamingContent(iter(["a", "b"]), self.release)
+        self.assertEqual(list(content), ["a", "b"])
+        content.close()
+        content.close()
+        self.assertEqual(self.released, 1)
+
+    def test_close_unread(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield "a"
+                yield "b"
+            finally:
+                closed.append(True)
+
+        content = StreamingContent(chunks(), self.release)
+        self.assertEqual(next(iter(content)), "a")
+        content.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(self.released, 1)
+
+    def test_garbage_collected(self):
+        content = StreamingContent(["a"], self.release)
+        del content
+        self.assertEqual(self.released, 1)
+
+
+class LightcurveJSONTest(SimpleTestCase):
+
+    def test_json_list(self):
+        self.assertEqual(json_list(numpy.array([1., numpy.nan, numpy.inf])),
+                         [1., None, None])
+        self.assertEqual(json_list(numpy.array([1, 2])), [1, 2])
+
+    def test_seconds(self):
+        times = numpy.array([datetime.datetime(1970, 1, 1, 0, 0, 1), None],
+                            dtype='datetime64[us]')
+        seconds = LightcurveDataView.seconds(times)
+        self.assertEqual(seconds[0], 1.)
+        self.assertTrue(numpy.isnan(seconds[1]))
+
+
+class ConeIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = conesearch.ConeIndex(
+            numpy.array([1, 2, 3, 4, 5]),
+            [359.995, 0.01, 180., 10., 0.],
+            [0., 0., 89.99, 89.99, 1.])
+
+    def test_search(self):
+        result = self.index.search(0., 0., 60 / 3600.)
+        self.assertEqual(result['id'].tolist(), [1, 2])
+        self.assertTrue(numpy.allclose(result['distance'], [18., 36.]))
+
+    def test_limit(self):
+        result = self.index.search(0., 0., 60 / 3600., limit=1)
+        self.assertEqual(result['id'].tolist(), [1])
+
+    def test_pole(self):
+        result = self.index.search(0., 90., 60 / 3600.)
+        self.assertEqual(sorted(result['id'].tolist()), [3, 4])
+        self.assertTrue(numpy.allclose(result['distance'], [36., 36.]))
+        # Across the pole
+        result = self.index.search(90., 89.995, 60 / 3600.)
+        self.assertEqual(sorted(result['id'].tolist()), [3, 4])
+
+    def test_empty(self):
+        self.assertEqual(len(self.index.search(90., -45., 1.)['id']), 0)
+        empty = conesearch.ConeIndex(numpy.zeros(0, dtype=numpy.int64),
+                                     [], [])
+        self.assertEqual(len(empty.search(0., 0., 1.)['id']), 0)
+
+
+class FakeConeDataBase(object):
+    """Stand-in for a dbase.DataBase, for the cone searches"""
+
+    def __init__(self, version=('2012-01-01', 0)):
+        self.cache = cache.ResultCache(cache.LocalCache())
+        self.version = version
+        self.queries = []
+        self.calls = 0
+
+    def login_key(self):
+        return ('localhost', 50000, 'tkp', 'tkp')
+
+    def dataset_version(self, dataset):
+        return self.version
+
+    def columns(self, query, *args):
+        self.queries.append((query, args))
+        return {'xtrsrc_id': numpy.zeros(0, dtype=numpy.int64),
+                'wm_ra': numpy.zeros(0), 'wm_decl': numpy.zeros(0)}
+
+    def monitoringlist(self, dataset):
+        self.calls += 1
+        return [{'id': 1, 'ra': 10., 'decl': 20.},
+                {'id': 2, 'ra': 10.01, 'decl': 20.}]
+
+
+class ConeSearchTest(SimpleTestCase):
+
+    def setUp(self):
+        conesearch._indexes.clear()
+
+    def test_sql_ra_wrap(self):
+        database = FakeConeDataBase(version=None)
+        conesearch.sql_search(database, 1, 0.001, 0., 0.01)
+        query, args = database.queries[0]
+        self.assertIn("zone BETWEEN %s AND %s", query)
+        self.assertEqual(args[:3], (1, -1, 0))
+        self.assertIn("(wm_ra >= %s OR wm_ra <= %s)", query)
+        self.assertAlmostEqual(args[5], 359.991)
+
+    def test_sql_pole(self):
+        database = FakeConeDataBase(version=None)
+        conesearch.sql_search(database, 1, 0., 89.5, 1.)
+        query, args = database.queries[0]
+        self.assertNotIn("wm_ra", query.split("ORDER BY")[0].split(
+            "WHERE")[1])
+        self.assertEqual(args[1:3], (88, 90))
+
+    def test_search_methods(self):
+        database = FakeConeDataBase(version=None)
+        self.assertEqual(conesearch.search(database, 1, 0., 0., 1.)[1], 'sql')
+        database = FakeConeDataBase()
+        self.assertEqual(conesearch.search(database, 1, 0., 0., 1.)[1],
+                         'index')
+        # The index is built once
+        conesearch.search(database, 1, 0., 0., 1.)
+        self.assertEqual(len(database.queries), 1)
+
+    def test_monitoringlist_index(self):
+        database = FakeConeDataBase()
+        result, method = conesearch.search(database, 1, 10., 20., 0.1,
+                                           table='monitoringlist')
+        self.assertEqual(result['id'].tolist(), [1, 2])
+        conesearch.search(database, 1, 10., 20., 0.1, table='monitoringlist')
+        self.assertEqual(database.calls, 1)
+        # A change to the monitoring list
+        database.cache.invalidate(database.login_key(), 1)
+        conesearch.search(database, 1, 10., 20., 0.1, table='monitoringlist')
+        self.assertEqual(database.calls, 2)
+
+    def test_monitoringlist_unprocessed(self):
+        database = FakeConeDataBase(version=None)
+        for i in range(2):
+            conesearch.search(database, 1, 10., 20., 0.1,
+                              table='monitoringlist')
+        self.assertEqual(database.calls, 2)
@@ -0,0 +1,282 @@
+"""
+Result cache for the read-only DataBase queries
+
+Pipeline datasets don't change once they are processed, so the results
+of queries on a dataset can be reused between requests. Cache keys
+contain the database login, the method and its arguments, as well as
+the dataset version (its process_ts and rerun) and a generation counter
+that is increased when the dataset is changed through the web
+application (e.g., its monitoring list). Datasets that are still being
+processed are not cached.
+
+Two backends are available: an in-process LRU cache, and an on-disk
+cache that can be shared between processes. Both are bounded in size;
+values are stored pickled, so callers can't modify the cached results.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import inspect
+import tempfile
+import functools
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from tkpweb import settings
+
+
+class LocalCache(object):
+    """In-process cache, evicting the least recently used entries
+
+    Kwargs:
+
+        max_bytes (int): maximum total size of the (pickled) values
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return None
+            # Reinsert, to mark as most recently used
+            self.entries[key] = value
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+
+class DiskCache(object):
+    """On-disk cache, evicting the least recently used entries
+
+    Each entry is a file in path; its modification time is updated
+    whenever it is used.
+
+    Scanning the cache directory takes a stat() per entry, so entries
+    are only evicted when the estimated total size (from the last scan
+    plus the writes of this process since) exceeds max_bytes, or every
+    evict_interval writes, to account for the writes of other
+    processes.
+
+    Args:
+
+        path (string): cache directory
+
+    Kwargs:
+
+        max_bytes (int): maximum total size of the cache files
+
+        evict_interval (int): maximum number of writes between scans
+    """
+
+    def __init__(self, path, max_bytes=1024*1024*1024, evict_interval=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.size = None
+        self.writes = 0
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".cache")
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as infile:
+                value = infile.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        # Write to a temporary file first, so other processes never see
+        # a partially written entry
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(value)
+        os.rename(tmpname, self.filename(key))
+        with self.lock:
+            self.writes += 1
+            if self.size is not None:
+                self.size += len(value)
+            scan = (self.size is None or self.size > self.max_bytes or
+                    self.writes >= self.evict_interval)
+            if scan:
+                self.writes = 0
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        max_bytes"""
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".cache"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+        with self.lock:
+            self.size = total
+
+
+class ResultCache(object):
+    """Cache for DataBase results, on top of a LocalCache or DiskCache"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.backend.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def generation(self, login, dataset):
+        generation = self.get(self.key('generation', login, dataset))
+        return generation if generation is not None else 0
+
+    def invalidate(self, login, dataset):
+        """Invalidate all cached results for a dataset"""
+
+        # Make sure the new generation differs from any previous one,
+        # even if the counter itself was evicted
+        self.set(self.key('generation', login, dataset),
+                 max(self.generation(login, dataset) + 1, time.time()))
+
+
+def create_cache(config):
+    """Create a ResultCache from a DATASET_CACHE setting
+
+    Returns None if the config is empty (no caching).
+    """
+
+    if not config:
+        return None
+    config = dict(config)
+    backend = config.pop('backend', 'local')
+    if backend == 'local':
+        return ResultCache(LocalCache(**config))
+    elif backend == 'disk':
+        return ResultCache(DiskCache(**config))
+    raise ValueError("unknown cache backend %r" % backend)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Obtain the process-wide ResultCache, as configured by the
+    DATASET_CACHE setting (None if not configured)"""
+
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_cache(getattr(settings, 'DATASET_CACHE', None))
+            if _cache is None:
+                _cache = False
+    return _cache or None
+
+
+def _normalize(value):
+    """Normalize an argument value for the cache key: ids given as
+    strings become ints, and the order of lists and sets (of ids or
+    extra_info items) is ignored; tuples (such as paging keys) keep
+    their order"""
+
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, tuple):
+        return tuple(_normalize(item) for item in value)
+    if isinstance(value, (list, set, frozenset)):
+        return tuple(sorted(set(_normalize(item) for item in value)))
+    return value
+
+
+def cached(dataset_arg='dataset'):
+    """Cache the results of a DataBase method
+
+    Only calls for a single, processed dataset are cached; the dataset
+    id is given by the dataset_arg argument of the method.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+            callargs = inspect.getcallargs(method, self, *args, **kwargs)
+            del callargs['self']
+            dataset = callargs[dataset_arg]
+            if dataset is None:
+                return method(self, *args, **kwargs)
+            dataset = int(dataset)
+            version = self.dataset_version(dataset)
+            if version is None:
+                return method(self, *args, **kwargs)
+            login = self.login_key()
+            key = self.cache.key(
+                login, method.__name__,
+                sorted((name, _normalize(value))
+                       for name, value in callargs.iteritems()),
+                version, self.cache.generation(login, dataset))
+            result = self.cache.get(key)
+            if result is None:
+                result = method(self, *args, **kwargs)
+                self.cache.set(key, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,207 @@
+"""
+Cone searches over the sources of a dataset
+
+Searches in the running catalog of a processed dataset use an
+in-process index: the source positions of the dataset sorted by
+declination, where the declination zone is found with a binary search.
+The index is built on first use and kept per dataset version. Datasets
+that are still being processed change with every image, so they are
+searched with a single SQL query instead. That query is restricted to
+the (indexed, 1 degree) zone column of the running catalog and the RA
+range around the position, before comparing the x, y, z unit vectors.
+
+Monitoring list searches always use an index, built from the (cached)
+monitoring list and kept until the monitoring list changes.
+"""
+
+import math
+import threading
+import numpy
+from collections import OrderedDict
+from tkpweb import settings
+from .qcengine import unit_vectors
+from .qcengine import angular_distance
+
+
+class ConeIndex(object):
+    """Positions sorted by declination, for cone searches
+
+    Args:
+
+        ids, ra, dec (arrays): source ids and positions (degrees)
+    """
+
+    def __init__(self, ids, ra, dec):
+        order = numpy.argsort(dec, kind='mergesort')
+        self.ids = numpy.asarray(ids)[order]
+        self.ra = numpy.asarray(ra, dtype=numpy.float64)[order]
+        self.dec = numpy.asarray(dec, dtype=numpy.float64)[order]
+        self.xyz = unit_vectors(self.ra, self.dec)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return (self.ids.nbytes + self.ra.nbytes + self.dec.nbytes +
+                self.xyz.nbytes)
+
+    def search(self, ra, dec, radius, limit=None):
+        """Return the sources within radius (degrees) of (ra, dec)
+
+        Returns an OrderedDict of id, ra, decl and distance (arcsec)
+        arrays, sorted by distance; at most limit sources.
+        """
+
+        # Binary search for the declination zone of the cone
+        start = numpy.searchsorted(self.dec, dec - radius, side='left')
+        end = numpy.searchsorted(self.dec, dec + radius, side='right')
+        centre = unit_vectors([ra], [dec])
+        distance = angular_distance(self.xyz[start:end], centre)
+        inside = numpy.flatnonzero(distance <= radius)
+        inside = inside[numpy.argsort(distance[inside], kind='mergesort')]
+        if limit is not None:
+            inside = inside[:limit]
+        return OrderedDict((
+            ('id', self.ids[start:end][inside]),
+            ('ra', self.ra[start:end][inside]),
+            ('decl', self.dec[start:end][inside]),
+            ('distance', distance[inside] * 3600)))
+
+
+# Indexes of the running catalogs and monitoring lists, least recently
+# used first. At most CONE_INDEX_CACHE_SIZE indexes (default 4) are kept.
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _lookup(key):
+    with _indexes_lock:
+        index = _indexes.pop(key, None)
+        if index is not None:
+            _indexes[key] = index
+        return index
+
+
+def _keep(key, index):
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > getattr(settings, 'CONE_INDEX_CACHE_SIZE', 4):
+            _indexes.popitem(last=False)
+
+
+def get_index(database, dataset):
+    """Return the cone search index of the running catalog of dataset,
+    or None for datasets that are still being processed"""
+
+    version = database.dataset_version(dataset)
+    if version is None:
+        return None
+    key = (database.login_key(), dataset, version)
+    index = _lookup(key)
+    if index is not None:
+        return index
+    sources = database.columns("""\
+SELECT xtrsrc_id, wm_ra, wm_decl FROM runningcatalog WHERE ds_id = %s""",
+                               dataset)
+    index = ConeIndex(sources['xtrsrc_id'], sources['wm_ra'],
+                      sources['wm_decl'])
+    _keep(key, index)
+    return index
+
+
+def get_monitoringlist_index(database, dataset):
+    """Return the cone search index of the monitoring list of dataset
+
+    The monitoring list is changed through the web app, so the index is
+    kept under the generation of the result cache, which changes with
+    every change to the monitoring list (see DataBase.invalidate()).
+    Without a result cache, or for datasets that are still being
+    processed, the index is built for every search.
+    """
+
+    key = None
+    version = database.dataset_version(dataset)
+    if version is not None and database.cache is not None:
+        login = database.login_key()
+        key = (login, dataset, version, 'monitoringlist',
+               database.cache.generation(login, dataset))
+        index = _lookup(key)
+        if index is not None:
+            return index
+    entries = database.monitoringlist(dataset)
+    index = ConeIndex(
+        numpy.array([entry['id'] for entry in entries], dtype=numpy.int64),
+        [entry['ra'] for entry in entries],
+        [entry['decl'] for entry in entries])
+    if key is not None:
+        _keep(key, index)
+    return index
+
+
+def sql_search(database, dataset, ra, dec, radius, limit=None):
+    """Cone search in the running catalog of dataset with a single
+    query; returns the same as ConeIndex.search()"""
+
+    x, y, z = unit_vectors([ra], [dec])[0]
+    # zone is the (indexed) floor of the declination
+    conditions = ["ds_id = %s", "zone BETWEEN %s AND %s",
+                  "wm_decl BETWEEN %s AND %s"]
+    args = [dataset, int(math.floor(dec - radius)),
+            int(math.floor(dec + radius)), dec - radius, dec + radius]
+    if abs(dec) + radius < 89:
+        # RA range of the cone; a wider range only at the poles
+        alpha = math.degrees(math.asin(
+            math.sin(math.radians(radius)) / math.cos(math.radians(dec))))
+        ramin, ramax = ra - alpha, ra + alpha
+        if ramin < 0:
+            conditions.append("(wm_ra >= %s OR wm_ra <= %s)")
+            args.extend([ramin + 360, ramax])
+        elif ramax >= 360:
+            conditions.append("(wm_ra >= %s OR wm_ra <= %s)")
+            args.extend([ramin, ramax - 360])
+        else:
+            conditions.append("wm_ra BETWEEN %s AND %s")
+            args.extend([ramin, ramax])
+    conditions.append("x * %s + y * %s + z * %s >= %s")
+    args.extend([x, y, z, math.cos(math.radians(radius))])
+    query = """\
+SELECT xtrsrc_id, wm_ra, wm_decl
+  FROM runningcatalog
+ WHERE %s
+ORDER BY x * %%s + y * %%s + z * %%s DESC""" % "\n   AND ".join(conditions)
+    args.extend([x, y, z])
+    if limit is not None:
+        query += "\nLIMIT %d" % limit
+    sources = database.columns(query, *args)
+    distance = angular_distance(
+        unit_vectors(sources['wm_ra'], sources['wm_decl']),
+        unit_vectors([ra], [dec])) * 3600
+    return OrderedDict((
+        ('id', sources['xtrsrc_id']),
+        ('ra', sources['wm_ra']),
+        ('decl', sources['wm_decl']),
+        ('distance', distance)))
+
+
+def search(database, dataset, ra, dec, radius, table='source', limit=None):
+    """Return the sources of dataset within radius (degrees) of (ra, dec)
+
+    table is 'source' (the running catalog) or 'monitoringlist'.
+    Running catalog searches use the in-process index if the
+    CONE_SEARCH_INDEX setting is true (the default) and the dataset has
+    been processed, and SQL (sql_search()) otherwise.
+
+    Returns the results (as ConeIndex.search()), and the method used:
+    'index' or 'sql'.
+    """
+
+    if table == 'monitoringlist':
+        index = get_monitoringlist_index(database, dataset)
+        return index.search(ra, dec, radius, limit=limit), 'index'
+    index = None
+    if getattr(settings, 'CONE_SEARCH_INDEX', True):
+        index = get_index(database, dataset)
+    if index is not None:
+        return index.search(ra, dec, radius, limit=limit), 'index'
+    return sql_search(database, dataset, ra, dec, radius, limit=limit), 'sql'
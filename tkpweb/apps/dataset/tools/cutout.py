@@ -0,0 +1,179 @@
+"""
+Batch cutouts around sky positions, for lightcurve thumbnails
+
+All cutouts from the same image file are made in one go: FITS files
+are opened once, memory-mapped, so only the cutout regions are read,
+and their WCS is kept between calls. The cutouts are returned as a
+single array stack, which can be turned into one sprite-sheet image.
+"""
+
+import os
+import math
+import threading
+import StringIO
+import numpy
+import pyfits
+import pywcs
+import matplotlib.cm
+import matplotlib.image
+from collections import OrderedDict
+from tkp.utility import accessors
+
+
+# Number of WCS objects kept between calls
+WCS_CACHE_SIZE = 128
+
+# Increase when a change alters the cutouts or sprite sheets, to avoid
+# reusing cached sprite sheets
+VERSION = 1
+
+_wcs_cache = OrderedDict()
+_wcs_lock = threading.Lock()
+
+
+def _fits_wcs(filename, header):
+    """Obtain the (celestial) WCS for a FITS file, reusing the WCS
+    of earlier calls if the file hasn't changed"""
+
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime, stat.st_size)
+    with _wcs_lock:
+        try:
+            wcs = _wcs_cache.pop(key)
+        except KeyError:
+            wcs = None
+        if wcs is not None:
+            _wcs_cache[key] = wcs
+            return wcs
+    wcs = pywcs.WCS(header, naxis=2)
+    with _wcs_lock:
+        _wcs_cache[key] = wcs
+        while len(_wcs_cache) > WCS_CACHE_SIZE:
+            _wcs_cache.popitem(last=False)
+    return wcs
+
+
+def _cut(data, x, y, boxsize):
+    """Cut a (2*boxsize[1], 2*boxsize[0]) region from data[y, x],
+    padded with NaN where it extends beyond the data"""
+
+    cutout = numpy.empty((2*boxsize[1], 2*boxsize[0]), dtype=numpy.float32)
+    cutout.fill(numpy.nan)
+    x, y = int(round(x)), int(round(y))
+    x0, x1 = x - boxsize[0], x + boxsize[0]
+    y0, y1 = y - boxsize[1], y + boxsize[1]
+    sx0, sx1 = max(x0, 0), min(x1, data.shape[1])
+    sy0, sy1 = max(y0, 0), min(y1, data.shape[0])
+    if sx0 < sx1 and sy0 < sy1:
+        cutout[sy0-y0:sy1-y0, sx0-x0:sx1-x0] = data[sy0:sy1, sx0:sx1]
+    return cutout
+
+
+def _fits_cutouts(filename, positions, boxsize):
+    hdulist = pyfits.open(filename, memmap=True)
+    try:
+        header = hdulist[0].header
+        data = hdulist[0].data
+        # Reduce any degenerate frequency/Stokes axes
+        while data.ndim > 2:
+            data = data[0]
+        wcs = _fits_wcs(filename, header)
+        ra = numpy.array([position[0] for position in positions])
+        dec = numpy.array([position[1] for position in positions])
+        x, y = wcs.wcs_sky2pix(ra, dec, 0)
+        return [_cut(data, xx, yy, boxsize) for xx, yy in zip(x, y)]
+    finally:
+        hdulist.close()
+
+
+def _casa_cutouts(filename, positions, boxsize):
+    image = accessors.CASAImage(filename)
+    # The accessor data is indexed as [x, y]
+    data = numpy.asarray(image.data).T
+    cutouts = []
+    for position in positions:
+        x, y = image.wcs.s2p(position)
+        cutouts.append(_cut(data, x, y, boxsize))
+    return cutouts
+
+
+def cutouts(positions, boxsize=(40, 40)):
+    """Make cutouts around sky positions
+
+    Args:
+
+        positions (list): (ra, dec, filename) tuples
+
+    Kwargs:
+
+        boxsize (tuple): half-width and half-height of the cutouts, in
+            pixels
+
+    Returns:
+
+        (numpy.ndarray): float32 array of shape (len(positions),
+            2*boxsize[1], 2*boxsize[0]), in the order of the positions,
+            with north (increasing y) at the end of the second axis.
+            Cutouts that can't be made (for example, missing files) are
+            all NaN.
+    """
+
+    stack = numpy.empty((len(positions), 2*boxsize[1], 2*boxsize[0]),
+                        dtype=numpy.float32)
+    stack.fill(numpy.nan)
+    byfile = OrderedDict()
+    for i, (ra, dec, filename) in enumerate(positions):
+        byfile.setdefault(filename, []).append((i, (ra, dec)))
+    for filename, items in byfile.iteritems():
+        indices = [i for i, position in items]
+        filepositions = [position for i, position in items]
+        try:
+            if filename.lower().endswith(".fits"):
+                results = _fits_cutouts(filename, filepositions, boxsize)
+            else:  # CASA does not really have default extensions
+                results = _casa_cutouts(filename, filepositions, boxsize)
+        except (IOError, OSError, AttributeError):
+            # File doesn't exist or can't be read; leave empty
+            continue
+        for i, cutout in zip(indices, results):
+            stack[i] = cutout
+    return stack
+
+
+def sprite_layout(n):
+    """Return the number of columns and rows of a sprite sheet with n
+    cutouts"""
+
+    ncols = max(1, int(math.ceil(math.sqrt(n))))
+    nrows = max(1, int(math.ceil(n / float(ncols))))
+    return ncols, nrows
+
+
+def sprite(stack, cmap=None, format='png'):
+    """Combine an array stack of cutouts into a single sprite-sheet image
+
+    The cutouts are placed row by row on a grid given by
+    sprite_layout(); each cutout is scaled to its own minimum and
+    maximum. NaN values are transparent.
+
+    Returns the image data.
+    """
+
+    n, height, width = stack.shape
+    ncols, nrows = sprite_layout(n)
+    cmap = matplotlib.cm.get_cmap(cmap)
+    sheet = numpy.zeros((nrows*height, ncols*width, 4), dtype=numpy.float32)
+    for i, cutout in enumerate(stack):
+        finite = numpy.isfinite(cutout)
+        if not finite.any():
+            continue
+        vmin, vmax = cutout[finite].min(), cutout[finite].max()
+        scaled = (cutout - vmin) / ((vmax - vmin) or 1)
+        rgba = cmap(numpy.where(finite, scaled, 0))
+        rgba[..., 3] = finite
+        row, col = divmod(i, ncols)
+        # Image rows run from top to bottom
+        sheet[row*height:(row+1)*height, col*width:(col+1)*width] = rgba[::-1]
+    output = StringIO.StringIO()
+    matplotlib.image.imsave(output, sheet, format=format)
+    return output.getvalue()
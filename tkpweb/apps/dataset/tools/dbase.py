@@ -1,17 +1,114 @@
 from tkp.database import database
 from tkp.database.dataset import ExtractedSource
 from scipy.stats import chisqprob
-from .image import open_image
+from . import headers
+from . import rows
+from . import cache
+from . import querylog
+from .cache import cached
+from tkp.config import config
 from tkpweb import settings
+import time
 import datetime
+import numpy
+from collections import OrderedDict
+
+
+# Grouped count queries for the extra_info of DataBase.dataset(): each
+# item is the dataset id column and a query returning (dataset id,
+# count) rows, with room for an optional restriction to a single dataset
+DATASET_COUNTS = {
+    'ntransients': ('rc.ds_id', """\
+SELECT rc.ds_id, COUNT(*) FROM transients tr, runningcatalog rc
+WHERE tr.xtrsrc_id = rc.xtrsrc_id {restrict}
+GROUP BY rc.ds_id"""),
+    'nimages': ('ds_id', """\
+SELECT ds_id, COUNT(*) FROM images
+WHERE 1 = 1 {restrict}
+GROUP BY ds_id"""),
+    'nsources': ('ds_id', """\
+SELECT ds_id, COUNT(*) FROM runningcatalog
+WHERE 1 = 1 {restrict}
+GROUP BY ds_id"""),
+    'ntotalsources': ('im.ds_id', """\
+SELECT im.ds_id, COUNT(*) FROM extractedsources ex, images im
+WHERE ex.image_id = im.imageid {restrict}
+GROUP BY im.ds_id"""),
+    }
+
+
+# (column name, nicer name) pairs: the column values of the query
+# results are also available under their nicer name
+DATASET_ALIASES = (('dsid', 'id'), ('process_ts', 'processdate'))
+IMAGE_ALIASES = (
+    ('imageid', 'id'), ('taustart_ts', 'obsstart'), ('tau_time', 'inttime'),
+    ('freq_eff', 'frequency'), ('freq_bw', 'bandwidth'), ('ds_id', 'dataset'))
+TRANSIENT_ALIASES = (('transientid', 'id'), ('t_start', 'startdate'))
+SOURCE_ALIASES = (('xtrsrc_id', 'id'), ('ds_id', 'dataset'))
+EXTRACTEDSOURCE_ALIASES = (
+    ('xtrsrcid', 'id'), ('xtrsrc_id', 'assoc_id'), ('image_id', 'image'))
+MONITORINGLIST_ALIASES = (('monitorid', 'id'), ('ds_id', 'dataset'))
+
+# Maximum number of source ids in a single DataBase.lightcurves() query
+LIGHTCURVE_CHUNKSIZE = 1000
+
+# NumPy dtypes for the database column types, used by
+# DataBase.columns(). Other types result in object arrays.
+COLUMN_DTYPES = {
+    'tinyint': numpy.int64, 'smallint': numpy.int64, 'int': numpy.int64,
+    'bigint': numpy.int64, 'wrd': numpy.int64, 'oid': numpy.int64,
+    'boolean': numpy.bool_,
+    'real': numpy.float64, 'double': numpy.float64, 'float': numpy.float64,
+    'decimal': numpy.float64,
+    'timestamp': 'datetime64[us]', 'date': 'datetime64[D]',
+    }
 
 
 class DataBase(object):
 
-    def __init__(self, dblogin=None):
+    def __init__(self, dblogin=None, db=None):
+        """Set up access to the database given by dblogin
+
+        If db (a tkp.database.database.DataBase instance, for example
+        obtained from the connection pool) is given, that connection is
+        used instead of opening a new one.
+        """
+
         self.dblogin = dblogin
-        self.db = database.DataBase(**dblogin) if dblogin else database.DataBase()
+        if db is None:
+            db = database.DataBase(**dblogin) if dblogin else database.DataBase()
+        self.db = querylog.instrument(db)
+        self.cache = cache.get_cache()
+        self._versions = {}
+
+    def login_key(self):
+        """Identification of the database, for the result cache"""
+
+        dblogin = self.dblogin if self.dblogin else config['database']
+        return tuple(dblogin.get(item) for item in
+                     ('host', 'port', 'name', 'user'))
+
+    def dataset_version(self, dataset):
+        """Return the version of a dataset, for the result cache
 
+        The version consists of the processing time stamp and the
+        rerun number. None is returned for datasets that are still
+        being processed (or don't exist); these should not be cached.
+        """
+
+        try:
+            return self._versions[dataset]
+        except KeyError:
+            pass
+        result = self.db.get(
+            "SELECT process_ts, rerun FROM datasets WHERE dsid = %s", dataset)
+        version = None
+        if result and result[0][0] is not None:
+            version = tuple(result[0])
+        self._versions[dataset] = version
+        return version
+
+    @cached('id')
     def dataset(self, id=None, extra_info=()):
         """Get information on one or more datasets form the database
 
@@ -53,43 +150,35 @@ class DataBase(object):
             self.db.execute("""SELECT * FROM datasets WHERE dsid = %s""", id)
         else:
             self.db.execute("""SELECT * FROM datasets""")
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        datasets = []
-        for row in self.db.cursor.fetchall():
-            datasets.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into slightly nicer keys
-            for key1, key2 in zip(
-                ['dsid', 'process_ts'],
-                ['id', 'processdate']):
-                datasets[-1][key2] = datasets[-1][key1]
-            if 'ntransients' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM transients tr, runningcatalog rc
-WHERE tr.xtrsrc_id = rc.xtrsrc_id AND rc.ds_id = %s"""
-                datasets[-1]['ntransients'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'nimages' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM images WHERE ds_id = %s"""
-                datasets[-1]['nimages'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'nsources' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM runningcatalog WHERE ds_id = %s"""
-                datasets[-1]['nsources'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'ntotalsources' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM extractedsources ex, images im
-WHERE ex.image_id = im.imageid and im.ds_id = %s"""
-                datasets[-1]['ntotalsources'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
+        datasets = list(rows.rows(self.db.cursor, DATASET_ALIASES))
+        # Obtain the extra information for all datasets at once: one
+        # grouped query per requested item, instead of one query per
+        # dataset per item
+        for key in DATASET_COUNTS:
+            if key not in extra_info:
+                continue
+            counts = self._count_per_dataset(key, dataset=id)
+            for dataset in datasets:
+                dataset[key] = counts.get(dataset['id'], 0)
         return datasets
 
+    def _count_per_dataset(self, key, dataset=None):
+        """Obtain one of the DATASET_COUNTS for all datasets at once
+
+        Returns a dict mapping the dataset id to its count; datasets
+        without any rows are absent from the returned dict.
+        """
+
+        column, query = DATASET_COUNTS[key]
+        if dataset is not None:
+            results = self.db.get(
+                query.format(restrict="AND %s = %%s" % column), dataset)
+        else:
+            results = self.db.get(query.format(restrict=""))
+        return dict(results)
+
 
+    @cached()
     def image(self, id=None, dataset=None, extra_info=()):
         """Get information on one or more datasets form the database
 
@@ -136,37 +225,23 @@ SELECT * FROM images WHERE dsid = %s""", id)
                 self.db.execute("""SELECT * FROM images WHERE ds_id = %s""", dataset)
             else:
                 self.db.execute("""SELECT * FROM images""")
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        images = []
-        for row in self.db.cursor.fetchall():
-            images.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into slightly nicer keys
-            for key1, key2 in zip(
-                ['imageid', 'taustart_ts', 'tau_time', 'freq_eff', 'freq_bw',
-                 'ds_id'],
-                ['id', 'obsstart', 'inttime', 'frequency', 'bandwidth',
-                 'dataset']):
-                images[-1][key2] = images[-1][key1]
-            # Open image to obtain phase center
-            img = open_image(images[-1]['url'], database=self.db)
-            try:
-                header = img.get_header()
-                images[-1]['ra'] = header['phasera']
-                images[-1]['dec'] = header['phasedec']
-            except (KeyError, AttributeError):
-                images[-1]['ra'] = None
-                images[-1]['dec'] = None
-            if 'ntotalsources' in extra_info:
-                query = """\
+        images = list(rows.rows(self.db.cursor, IMAGE_ALIASES))
+        if 'ntotalsources' in extra_info:
+            query = """\
 SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
-                images[-1]['ntotalsources'] = self.db.getone(
-                    query, images[-1]['id'])[0]
+            for image in images:
+                image['ntotalsources'] = self.db.getone(
+                    query, image['id'])[0]
+        # Obtain the phase centres from the header index; only images
+        # not yet indexed are opened
+        centres = headers.phase_centres(
+            [image['url'] for image in images], database=self.db)
+        for image in images:
+            image['ra'], image['dec'] = centres[image['url']]
         return images
 
 
+    @cached()
     def transient(self, id=None, dataset=None):
         """Get information on one or more datasets form the database
 
@@ -205,32 +280,43 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
     WHERE tr.xtrsrc_id = rc.xtrsrc_id AND ds_id = %s""", dataset)
             else:
                 self.db.execute("""SELECT * FROM transients""")
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        transients = []
-        for row in self.db.cursor.fetchall():
-            transients.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into somewhat nicer keys
-            for key1, key2 in zip(
-                ['transientid', 't_start'],
-                ['id', 'startdate']):
-                transients[-1][key2] = transients[-1][key1]
-            # Obtain the actual number of datapoints, including those from
-            # sub-detection level monitoring observations
-            transients[-1]['npoints'] = self.db.getone(
-                "SELECT COUNT(*) FROM assocxtrsources WHERE xtrsrc_id = %s",
-                transients[-1]['xtrsrc_id'])[0]
-            # Calculate the significance level (note: here we do need rc.datapoints,
-            # instead of the above npoints)
-            n = transients[-1]['datapoints']
-            transients[-1]['siglevel'] = chisqprob(
-                transients[-1]['siglevel'] * n, n)
+        transients = list(rows.rows(self.db.cursor, TRANSIENT_ALIASES))
+        if not transients:
+            return transients
+        # Obtain the actual number of datapoints, including those from
+        # sub-detection level monitoring observations, for all
+        # transients at once; the transients are selected as above
+        # within the query, so the number of arguments stays constant
+        conditions, args = [], []
+        if id is not None:
+            conditions.append("tr.transientid = %s")
+            args.append(id)
+        if dataset is not None:
+            conditions.append("rc.ds_id = %s")
+            args.append(dataset)
+        npoints = dict(self.db.get("""\
+SELECT xtrsrc_id, COUNT(*) FROM assocxtrsources
+WHERE xtrsrc_id IN (
+  SELECT tr.xtrsrc_id FROM transients tr, runningcatalog rc
+  WHERE %s)
+GROUP BY xtrsrc_id""" % " AND ".join(
+            ["tr.xtrsrc_id = rc.xtrsrc_id"] + conditions), *args))
+        # Calculate the significance levels (note: here we do need
+        # rc.datapoints, instead of the above npoints)
+        n = numpy.array([transient['datapoints'] for transient in transients],
+                        dtype=float)
+        siglevel = numpy.array(
+            [transient['siglevel'] for transient in transients],
+            dtype=float)
+        siglevel = chisqprob(siglevel * n, n)
+        for transient, level in zip(transients, siglevel):
+            transient['npoints'] = npoints.get(transient['xtrsrc_id'], 0)
+            transient['siglevel'] = float(level)
         return transients
 
 
-    def source(self, id=None, dataset=None):
+    @cached()
+    def source(self, id=None, dataset=None, after=None, limit=None):
         """Get information on one or sources from the database
 
         The sources obtained are those in the runningcatalog; these are the
@@ -245,6 +331,13 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
             dataset (int or None): limit image(s) to given dataset, if
                 any.
 
+            after (int or None): only obtain sources with an id larger
+                than this value. Together with limit, this allows to page
+                through the sources, using the id of the last source of
+                the previous page.
+
+            limit (int or None): maximum number of sources returned.
+
          Returns:
 
             (list): A list of dicts; each list item corresponds to a
@@ -252,39 +345,45 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
-                single-element list.
+                single-element list. Sources are ordered by their id.
         """
 
-        if id is not None:  # id = 0 could be valid for some databases
-            if dataset is not None:
-                self.db.execute("""
-    SELECT * FROM runningcatalog
-    WHERE xtrsrc_id = %s AND ds_id = %s""", id, dataset)
-            else:
-                self.db.execute("""\
-    SELECT * FROM runningcatalog WHERE xtrsrc_id = %s""", id)
-        else:
-            if dataset is not None:
-                self.db.execute("""\
-    SELECT * FROM runningcatalog WHERE ds_id = %s""", dataset)
-            else:
-                self.db.execute("""SELECT * FROM runningcatalog""")
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        sources = []
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into somewhat nicer keys
-            for key1, key2 in zip(
-                ['xtrsrc_id', 'ds_id'],
-                ['id', 'dataset']):
-                sources[-1][key2] = sources[-1][key1]
-        return sources
+        self.db.execute(*self._source_query(id, dataset, after, limit))
+        return list(rows.rows(self.db.cursor, SOURCE_ALIASES))
+
+    def iter_source(self, dataset=None, after=None, chunksize=1000):
+        """Iterate over all sources, optionally of a single dataset
 
+        Like source(), but the rows are fetched from the database
+        chunksize rows at a time. This uses a separate cursor, so other
+        queries can be made while iterating.
+        """
 
-    def extractedsource(self, id=None, dataset=None, image=None):
+        query, args = self._source_query(None, dataset, after, None)
+        return self._iter_rows(query, args, SOURCE_ALIASES, chunksize)
+
+    def _source_query(self, id=None, dataset=None, after=None, limit=None):
+        conditions, args = [], []
+        if id is not None:  # id = 0 could be valid for some databases
+            conditions.append("xtrsrc_id = %s")
+            args.append(id)
+        if dataset is not None:
+            conditions.append("ds_id = %s")
+            args.append(dataset)
+        if after is not None:
+            conditions.append("xtrsrc_id > %s")
+            args.append(after)
+        query = "SELECT * FROM runningcatalog"
+        if conditions:
+            query += "\nWHERE " + " AND ".join(conditions)
+        query += "\nORDER BY xtrsrc_id"
+        if limit is not None:
+            query += "\nLIMIT %d" % limit
+        return query, args
+
+    @cached()
+    def extractedsource(self, id=None, dataset=None, image=None,
+                        after=None, limit=None):
         """Get information on one or more extractedsources from the
         database
 
@@ -301,6 +400,15 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
                 image is not in the dataset, an empty list will be
                 returned.
 
+            after (int, tuple or None): only obtain sources with an id
+                larger than this value, or, given an (id, assoc_id)
+                pair, the rows following that pair. Together with
+                limit, this allows to page through the sources, using
+                the id and assoc_id of the last row of the previous
+                page.
+
+            limit (int or None): maximum number of rows returned.
+
          Returns:
 
             (list): A list of dicts; each list item corresponds to a
@@ -308,7 +416,9 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
-                single-element list.
+                single-element list. Rows are ordered by their id and
+                assoc_id; a source with several associations has a row
+                for each.
 
             Note important keys:
             'id' : extracted source id
@@ -316,126 +426,90 @@ SELECT COUNT(*) FROM extractedsources WHERE image_id = %s"""
             'image': if of image from which source extracted
         """
 
-        if id is not None:  # id = 0 could be valid for some databases
-            if dataset is not None:
-                if image is not None:
-                    self.db.execute("""
-    SELECT ex.*, im.*, ax.xtrsrc_id
-    FROM extractedsources ex, images im, assocxtrsources ax
-    WHERE ex.xtrsrcid = %s AND ex.image_id = im.imageid AND
-    im.ds_id = %s and ex.image_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, id, dataset, image)
-                else:
-                    self.db.execute("""
-    SELECT ex.*, im.*, ax.xtrsrc_id
-    FROM extractedsources ex, images im, assocxtrsources ax
-    WHERE ex.xtrsrcid = %s AND ex.image_id = im.imageid AND
-    im.ds_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, id, dataset)
-            else: #id is not none, dataset is none
-                if image is not None:
-                    self.db.execute("""\
-    SELECT ex.*, ax.xtrsrc_id
-    FROM extractedsources ex, assocxtrsources ax
-    WHERE ex.xtrsrcid = %s
-    AND ex.image_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid""", id, image)
-                else:
-                    self.db.execute("""\
-    SELECT ex.*, ax.xtrsrc_id
-    FROM extractedsources ex, assocxtrsources ax
-    WHERE ex.xtrsrcid = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, id)
-        else: #id is None
-            if dataset is not None:
-                if image is not None:
-                    self.db.execute("""\
-    SELECT ex.*, im.*, ax.xtrsrc_id
-    FROM extractedsources ex, images im, assocxtrsources ax
-    WHERE ex.image_id = im.imageid AND im.ds_id = %s
-    AND ex.image_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, dataset, image)
-                else:
-                    self.db.execute("""\
-    SELECT ex.*, im.*, ax.xtrsrc_id
-    FROM extractedsources ex, images im, assocxtrsources ax
-    WHERE ex.image_id = im.imageid AND im.ds_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, dataset)
-            else:#id is none, dataset is none
-                if image is not None:
-                    self.db.execute("""\
-    SELECT ex.*, ax.xtrsrc_id
-    FROM extractedsources ex, assocxtrsources ax
-    WHERE ex.image_id = %s
-    AND ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """, image)
-                else:
-                    self.db.execute("""\
-    SELECT ex.*, ax.xtrsrc_id
-    FROM extractedsources ex, assocxtrsources ax
-    WHERE ax.assoc_xtrsrc_id = ex.xtrsrcid
-    """)
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        sources = []
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into somewhat nicer keys
-            for key1, key2 in zip(
-                ['xtrsrcid', 'xtrsrc_id', 'image_id'],
-                ['id', 'assoc_id', 'image']):
-                sources[-1][key2] = sources[-1][key1]
-            #sources[-1]['flux'] = {'peak': {}, 'int': {}}
-            #    for fluxtype in ('peak', 'int'):
-            #        sources[-1]['flux'][fluxtype].append(
-            #            {'stokes': stokes,
-            #             'value': sources[-1][stokes+"_"+fluxtype],
-            #             'error': sources[-1][stokes+"_"+fluxtype+"_err"]}
-            #            )
-        return sources
+        self.db.execute(
+            *self._extractedsource_query(id, dataset, image, after, limit))
+        return list(rows.rows(self.db.cursor, EXTRACTEDSOURCE_ALIASES))
+
+    def iter_extractedsource(self, dataset=None, image=None, after=None,
+                             chunksize=1000):
+        """Iterate over all extractedsources, optionally of a single
+        dataset or image
 
+        Like extractedsource(), but the rows are fetched from the
+        database chunksize rows at a time. This uses a separate cursor,
+        so other queries can be made while iterating.
+        """
 
+        query, args = self._extractedsource_query(
+            None, dataset, image, after, None)
+        return self._iter_rows(query, args, EXTRACTEDSOURCE_ALIASES,
+                               chunksize)
+
+    def _iter_rows(self, query, args, aliases, chunksize):
+        """Iterate over the rows of query, chunksize rows at a time, on a
+        separate cursor that is closed when done"""
+
+        start = time.time()
+        nrows = 0
+        cursor = self.db.connection.cursor()
+        try:
+            cursor.execute(query, args)
+            for row in rows.rows(cursor, aliases, chunksize=chunksize):
+                nrows += 1
+                yield row
+        finally:
+            cursor.close()
+            querylog.record(query, args, nrows, time.time() - start)
+
+    def _extractedsource_query(self, id=None, dataset=None, image=None,
+                               after=None, limit=None):
+        conditions, args = ["ax.assoc_xtrsrc_id = ex.xtrsrcid"], []
+        if dataset is not None:
+            columns = "ex.*, im.*, ax.xtrsrc_id"
+            tables = "extractedsources ex, images im, assocxtrsources ax"
+            conditions.extend(["ex.image_id = im.imageid", "im.ds_id = %s"])
+            args.append(dataset)
+        else:
+            columns = "ex.*, ax.xtrsrc_id"
+            tables = "extractedsources ex, assocxtrsources ax"
+        if id is not None:  # id = 0 could be valid for some databases
+            conditions.append("ex.xtrsrcid = %s")
+            args.append(id)
+        if image is not None:
+            conditions.append("ex.image_id = %s")
+            args.append(image)
+        if isinstance(after, tuple):
+            # An extracted source can have several associations; page
+            # on the unique (source, association) pair
+            conditions.append(
+                "(ex.xtrsrcid > %s OR (ex.xtrsrcid = %s AND ax.xtrsrc_id > %s))")
+            args.extend([after[0], after[0], after[1]])
+        elif after is not None:
+            conditions.append("ex.xtrsrcid > %s")
+            args.append(after)
+        query = ("SELECT %s\nFROM %s\nWHERE %s\n"
+                 "ORDER BY ex.xtrsrcid, ax.xtrsrc_id" % (
+                     columns, tables, "\n  AND ".join(conditions)))
+        if limit is not None:
+            query += "\nLIMIT %d" % limit
+        return query, args
+
+    @cached()
     def monitoringlist(self, dataset):
         # Get all user defined entries
         query = """\
 SELECT * FROM monitoringlist WHERE userentry = true AND ds_id = %s"""
         self.db.execute(query, dataset)
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        sources = []
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into somewhat nicer keys;
-            for key1, key2 in zip(
-                ['monitorid', 'ds_id'],
-                ['id', 'dataset']):
-                sources[-1][key2] = sources[-1][key1]
+        sources = list(rows.rows(self.db.cursor, MONITORINGLIST_ALIASES))
         # Get all non-user entries belonging to this dataset
         query = """\
 SELECT * FROM monitoringlist ml, runningcatalog rc
 WHERE ml.userentry = false AND ml.xtrsrc_id = rc.xtrsrc_id AND rc.ds_id = %s"""
         self.db.execute(query, dataset)
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into somewhat nicer keys;
-            # replace ra, dec by values from runningcatalog
-            for key1, key2 in zip(
-                ['monitorid', 'ds_id', 'wm_ra', 'wm_decl'],
-                ['id', 'dataset', 'ra', 'decl']):
-                sources[-1][key2] = sources[-1][key1]
+        # Replace ra, dec by the values from the runningcatalog
+        sources.extend(rows.rows(
+            self.db.cursor, MONITORINGLIST_ALIASES + (
+                ('wm_ra', 'ra'), ('wm_decl', 'decl'))))
         return sources
 
     def update_monitoringlist(self, ra, dec, ds_id):
@@ -445,18 +519,142 @@ INSERT INTO monitoringlist
 VALUES (-1, %s, %s, %s, TRUE)"""
         self.db.execute(query, ra, dec, ds_id)
         self.db.commit()
+        self.invalidate(ds_id)
+
+    def bulk_update_monitoringlist(self, positions, ds_id, chunksize=1000):
+        """Add many user entries to the monitoring list at once
+
+        positions is a sequence of (ra, dec) pairs. The positions are
+        inserted chunksize at a time with executemany, and committed
+        together: either all or none of the positions are added.
+        """
 
-    def delete_monitoringlist(self, sources):
-        for source in sources:
+        query = """\
+INSERT INTO monitoringlist
+(xtrsrc_id, ra, decl, ds_id, userentry)
+VALUES (-1, %s, %s, %s, TRUE)"""
+        start = time.time()
+        cursor = self.db.cursor
+        try:
+            for i in range(0, len(positions), chunksize):
+                cursor.executemany(
+                    query, [(float(ra), float(dec), ds_id) for ra, dec in
+                            positions[i:i+chunksize]])
+            self.db.commit()
+        except Exception:
+            self.db.connection.rollback()
+            raise
+        querylog.record(query, ("%d positions" % len(positions),),
+                        len(positions), time.time() - start)
+        self.invalidate(ds_id)
+
+    def delete_monitoringlist(self, sources, dataset=None):
+        """Delete entries from the monitoring list, in a single
+        transaction
+
+        dataset is the dataset the entries belong to; if not given, it
+        is obtained from the entries themselves.
+        """
+
+        sources = [int(source) for source in sources]
+        if not sources:
+            return
+        placeholders = ", ".join(["%s"] * len(sources))
+        if dataset is not None:
+            datasets = [dataset]
+        elif self.cache is not None:
+            datasets = [ds_id for (ds_id,) in self.db.get("""\
+SELECT DISTINCT ds_id FROM monitoringlist WHERE monitorid IN (%s)""" %
+                placeholders, *sources)]
+        else:
+            datasets = []
+        try:
             self.db.execute(
-                "DELETE FROM monitoringlist WHERE monitorid = %s", source)
+                "DELETE FROM monitoringlist WHERE monitorid IN (%s)" %
+                placeholders, *sources)
             self.db.commit()
+        except Exception:
+            self.db.connection.rollback()
+            raise
+        for dataset in datasets:
+            self.invalidate(dataset)
+
+    def invalidate(self, dataset):
+        """Invalidate the cached results for a dataset"""
+
+        if self.cache is not None:
+            self.cache.invalidate(self.login_key(), int(dataset))
 
     def lightcurve(self, srcid):
         lc = ExtractedSource(id=srcid, database=self.db).lightcurve()
         return lc
 
 
+    @cached()
+    def lightcurves(self, dataset, srcids=None):
+        """Get the lightcurves of all running catalog sources of a
+        dataset, or of the sources with the given ids
+
+        The points of all lightcurves are fetched with a single query
+        (per LIGHTCURVE_CHUNKSIZE sources), ordered by source and time.
+
+        Returns:
+
+            (OrderedDict): srcid, the sorted source ids (with at least
+                one point); offsets, the start of the lightcurve of each
+                source in the point arrays, plus the total number of
+                points; and the point arrays taustart_ts, tau_time,
+                i_peak, i_peak_err and xtrsrcid. The lightcurve of
+                srcid[i] is given by the slice offsets[i]:offsets[i+1].
+        """
+
+        query = """\
+SELECT ax.xtrsrc_id AS srcid
+      ,im.taustart_ts
+      ,im.tau_time
+      ,ex.i_peak
+      ,ex.i_peak_err
+      ,ex.xtrsrcid
+  FROM runningcatalog rc
+      ,assocxtrsources ax
+      ,extractedsources ex
+      ,images im
+ WHERE rc.ds_id = %s
+   AND ax.xtrsrc_id = rc.xtrsrc_id
+   AND ex.xtrsrcid = ax.assoc_xtrsrc_id
+   AND ex.image_id = im.imageid
+{restrict}
+ORDER BY ax.xtrsrc_id
+        ,im.taustart_ts
+"""
+        if srcids is None:
+            chunks = [self.columns(query.format(restrict=""), dataset)]
+        else:
+            srcids = sorted(set(int(srcid) for srcid in srcids))
+            chunks = []
+            for i in range(0, len(srcids), LIGHTCURVE_CHUNKSIZE):
+                ids = srcids[i:i+LIGHTCURVE_CHUNKSIZE]
+                chunks.append(self.columns(query.format(
+                    restrict="   AND rc.xtrsrc_id IN (%s)" %
+                    ", ".join(["%s"] * len(ids))), dataset, *ids))
+            if not chunks:
+                # Only for the column types
+                chunks = [self.columns(
+                    query.format(restrict="   AND 1 = 0"), dataset)]
+        columns = OrderedDict(
+            (name, numpy.concatenate([chunk[name] for chunk in chunks]))
+            for name in chunks[0])
+        srcid = columns.pop('srcid')
+        # Start of each new source in the (sorted) points
+        starts = numpy.flatnonzero(numpy.r_[True, srcid[1:] != srcid[:-1]]) \
+            if len(srcid) else numpy.zeros(0, dtype=numpy.int64)
+        lightcurves = OrderedDict()
+        lightcurves['srcid'] = srcid[starts].astype(numpy.int64)
+        lightcurves['offsets'] = numpy.r_[starts, len(srcid)].astype(
+            numpy.int64)
+        lightcurves.update(columns)
+        return lightcurves
+
     def image_times(self, dataset):
         image_times = self.db.get(
             "SELECT taustart_ts, tau_time FROM images WHERE ds_id = %s",
@@ -479,3 +677,134 @@ WHERE ex.xtrsrcid = %s
   AND ex.image_id = im.imageid
 """, srcid)
         return ra, dec, filename
+
+    def thumbnails(self, srcids):
+        """Get thumbnail information for many sources at once
+
+        Returns a list of (ra, dec, image filename) tuples, in the order
+        of srcids; sources that are not found have None for all three.
+        """
+
+        if not srcids:
+            return []
+        srcids = [int(srcid) for srcid in srcids]
+        results = self.db.get("""\
+SELECT ex.xtrsrcid, ex.ra, ex.decl, im.url
+FROM extractedsources ex, images im
+WHERE ex.xtrsrcid IN (%s)
+  AND ex.image_id = im.imageid
+""" % ", ".join(["%s"] * len(srcids)), *srcids)
+        thumbnails = dict((row[0], tuple(row[1:])) for row in results)
+        return [thumbnails.get(srcid, (None, None, None)) for srcid in srcids]
+
+    def columns(self, query, *args, **kwargs):
+        """Run a query and obtain the results per column, as NumPy
+        arrays
+
+        The array types follow the database column types: integer,
+        boolean, float and timestamp columns result in int64, bool,
+        float64 and datetime64 arrays; other columns are object arrays.
+        NULL values become NaN (and NaT) in float (and timestamp)
+        columns; integer columns with NULL values are returned as
+        float64.
+
+        Kwargs:
+
+            dtypes (dict): column name: dtype, to override the default
+                type for some columns
+
+            structured (bool): return a single structured array instead
+                of a dict of arrays
+
+            chunksize (int): number of rows fetched and converted at a
+                time
+
+        Returns:
+
+            (OrderedDict or numpy.ndarray): the columns by column name,
+                in the order of the query, or a structured array.
+        """
+
+        dtypes = kwargs.pop('dtypes', {})
+        structured = kwargs.pop('structured', False)
+        chunksize = kwargs.pop('chunksize', 10000)
+        if kwargs:
+            raise TypeError("unexpected keyword argument(s) %s" %
+                            ", ".join(kwargs))
+        self.db.execute(query, *args)
+        cursor = self.db.cursor
+        # Convert the rows chunk by chunk, so the full result never
+        # exists as a list of row tuples
+        chunks = []
+        while True:
+            results = cursor.fetchmany(chunksize)
+            if not results:
+                break
+            chunks.append(self._columns(cursor.description, results, dtypes))
+        if len(chunks) == 1:
+            columns = chunks[0]
+        elif chunks:
+            columns = OrderedDict(
+                (name, numpy.concatenate([chunk[name] for chunk in chunks]))
+                for name in chunks[0])
+        else:
+            columns = self._columns(cursor.description, [], dtypes)
+        chunks = None
+        if structured:
+            array = numpy.empty(
+                len(columns.values()[0]) if columns else 0,
+                dtype=[(name, column.dtype) for name, column in
+                       columns.iteritems()])
+            for name, column in columns.iteritems():
+                array[name] = column
+            return array
+        return columns
+
+    def iter_columns(self, query, *args, **kwargs):
+        """Run a query and iterate over the results per column, in
+        chunks of at most chunksize rows
+
+        Like columns(), but yields an OrderedDict of arrays for every
+        chunk, so that only a single chunk is in memory at a time. This
+        uses a separate cursor, so other queries can be made while
+        iterating.
+
+        Kwargs:
+
+            chunksize (int): maximum number of rows per chunk
+
+            dtypes (dict): as for columns()
+        """
+
+        chunksize = kwargs.pop('chunksize', 10000)
+        dtypes = kwargs.pop('dtypes', {})
+        if kwargs:
+            raise TypeError("unexpected keyword argument(s) %s" %
+                            ", ".join(kwargs))
+        start = time.time()
+        nrows = 0
+        cursor = self.db.connection.cursor()
+        try:
+            cursor.execute(query, args)
+            while True:
+                results = cursor.fetchmany(chunksize)
+                if not results:
+                    break
+                nrows += len(results)
+                yield self._columns(cursor.description, results, dtypes)
+        finally:
+            cursor.close()
+            querylog.record(query, args, nrows, time.time() - start)
+
+    @staticmethod
+    def _columns(description, results, dtypes):
+        values = zip(*results) if results else [()] * len(description)
+        columns = OrderedDict()
+        for d, column in zip(description, values):
+            dtype = dtypes.get(d[0], COLUMN_DTYPES.get(d[1], object))
+            try:
+                columns[d[0]] = numpy.array(column, dtype=dtype)
+            except (TypeError, ValueError):
+                # NULL values in an integer column
+                columns[d[0]] = numpy.array(column, dtype=numpy.float64)
+        return columns
@@ -0,0 +1,346 @@
+"""
+Streaming export of dataset tables
+
+The rows of a table are read from the database in chunks, on their own
+cursor, and written out as CSV, a FITS binary table or a NumPy .npy
+structured array while they come in; only a single chunk is in memory
+at a time.
+
+The FITS and .npy formats need the number of rows up front, which is
+counted first. Should rows be added to the dataset in between (while
+it is still being processed), the export is cut off at (or padded with
+empty rows up to) that number.
+"""
+
+import csv
+import StringIO
+import numpy
+from collections import OrderedDict
+from .dbase import COLUMN_DTYPES
+
+
+# Tables per dataset: the (alias, table) pairs, join and dataset
+# conditions, and the order column. Columns with the same name in
+# several tables are taken from the first table.
+TABLES = OrderedDict((
+    ('source', {
+        'tables': (('rc', 'runningcatalog'),),
+        'where': "rc.ds_id = %s",
+        'order': "rc.xtrsrc_id"}),
+    ('extractedsource', {
+        'tables': (('ex', 'extractedsources'), ('ax', 'assocxtrsources'),
+                   ('im', 'images')),
+        'where': ("ax.assoc_xtrsrc_id = ex.xtrsrcid"
+                  " AND ex.image_id = im.imageid AND im.ds_id = %s"),
+        'order': "ex.xtrsrcid"}),
+    ('transient', {
+        'tables': (('tr', 'transients'), ('rc', 'runningcatalog')),
+        'where': "tr.xtrsrc_id = rc.xtrsrc_id AND rc.ds_id = %s",
+        'order': "tr.transientid"}),
+    ('image', {
+        'tables': (('im', 'images'),),
+        'where': "im.ds_id = %s",
+        'order': "im.imageid"}),
+    ))
+
+FORMATS = OrderedDict((
+    ('csv', "text/csv"),
+    ('fits', "application/fits"),
+    ('npy', "application/octet-stream"),
+    ))
+
+# Value of NULLs in integer columns (declared as TNULL in FITS tables)
+NULL_INT = -2**63
+
+# Modified Julian Date of 1970-01-01, for timestamps in FITS tables
+MJD_EPOCH = 40587.0
+TIME_DTYPES = ('datetime64[us]', 'datetime64[D]')
+
+FITS_BLOCK = 2880
+
+# Database types of string columns; their width in FITS and .npy output
+# is the longest value in the export
+STRING_TYPES = ('char', 'varchar', 'clob', 'string')
+
+
+class ExportError(Exception):
+    """Raised for unknown tables or columns"""
+    pass
+
+
+class Export(object):
+    """Export of a table of a dataset
+
+    Args:
+
+        database (dbase.DataBase): the database
+
+        table (str): one of TABLES
+
+        dataset (int): the dataset id
+
+    Kwargs:
+
+        columns (list or None): the column names to export, in order;
+            by default all columns
+
+        chunksize (int): number of rows read at a time
+    """
+
+    def __init__(self, database, table, dataset, columns=None,
+                 chunksize=10000):
+        try:
+            self.table = TABLES[table]
+        except KeyError:
+            raise ExportError("unknown table %s" % table)
+        self.database = database
+        self.dataset = dataset
+        self.chunksize = chunksize
+        self.available = self.table_columns()
+        if not columns:
+            columns = self.available.keys()
+        unknown = [column for column in columns
+                   if column not in self.available]
+        if unknown:
+            raise ExportError("unknown column(s) %s" % ", ".join(unknown))
+        self.columns = list(columns)
+        self._widths = None
+
+    def table_columns(self):
+        """Return the columns of the tables: name: (expression, database
+        type, size), in table order"""
+
+        columns = OrderedDict()
+        for alias, table in self.table['tables']:
+            cursor = self.database.db.connection.cursor()
+            try:
+                cursor.execute("SELECT * FROM %s LIMIT 0" % table)
+                for d in cursor.description:
+                    if d[0] not in columns:
+                        columns[d[0]] = ("%s.%s" % (alias, d[0]), d[1], d[3])
+            finally:
+                cursor.close()
+        return columns
+
+    def from_clause(self):
+        return "FROM %s\nWHERE %s" % (
+            ", ".join("%s %s" % (table, alias)
+                      for alias, table in self.table['tables']),
+            self.table['where'])
+
+    def count(self):
+        return self.database.db.getone(
+            "SELECT COUNT(*)\n" + self.from_clause(), self.dataset)[0]
+
+    def widths(self):
+        """Return the length of the longest value of each exported
+        string column; the size reported by the database driver is
+        that of the declaration at most (and 0 for unbounded columns)"""
+
+        if self._widths is None:
+            names = [column for column in self.columns
+                     if self.available[column][1] in STRING_TYPES]
+            self._widths = {}
+            if names:
+                row = self.database.db.getone("SELECT %s\n%s" % (
+                    ", ".join("MAX(LENGTH(%s))" % self.available[name][0]
+                              for name in names),
+                    self.from_clause()), self.dataset)
+                self._widths = dict((name, int(width or 0))
+                                    for name, width in zip(names, row))
+        return self._widths
+
+    def chunks(self):
+        """Iterate over the rows, as lists of tuples"""
+
+        query = "SELECT %s\n%s\nORDER BY %s" % (
+            ", ".join("%s AS %s" % (self.available[column][0], column)
+                      for column in self.columns),
+            self.from_clause(), self.table['order'])
+        cursor = self.database.db.connection.cursor()
+        try:
+            cursor.execute(query, [self.dataset])
+            while True:
+                rows = cursor.fetchmany(self.chunksize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def dtype(self, fits=False):
+        """Structured array type of the exported rows; big-endian, and
+        with timestamps as MJD, for FITS"""
+
+        fields = []
+        widths = self.widths()
+        for column in self.columns:
+            _, type, size = self.available[column]
+            dtype = numpy.dtype(COLUMN_DTYPES.get(
+                type, 'S%d' % max(widths.get(column, size), 1)))
+            if dtype.kind == 'M':
+                dtype = numpy.dtype(numpy.float64) if fits else dtype
+            elif dtype.kind == 'b' and fits:
+                dtype = numpy.dtype('S1')
+            if fits and dtype.kind in 'if':
+                dtype = dtype.newbyteorder('>')
+            fields.append((column, dtype))
+        return numpy.dtype(fields)
+
+    def array(self, rows, dtype, fits=False):
+        """Convert rows to a structured array of dtype"""
+
+        array = numpy.zeros(len(rows), dtype=dtype)
+        for column, values in zip(self.columns, zip(*rows)):
+            kind = dtype[column].kind
+            source = COLUMN_DTYPES.get(self.available[column][1])
+            if source in TIME_DTYPES:
+                times = numpy.array(values, dtype='datetime64[us]')
+                if kind == 'M':
+                    array[column] = times
+                else:
+                    mjd = times.astype(numpy.int64) / 86400e6 + MJD_EPOCH
+                    mjd[numpy.array([value is None for value in values])] = \
+                        numpy.nan
+                    array[column] = mjd
+            elif source is numpy.bool_ and fits:
+                array[column] = ['\0' if value is None else
+                                 ('T' if value else 'F') for value in values]
+            elif kind in 'iu':
+                array[column] = [NULL_INT if value is None else value
+                                 for value in values]
+            elif kind == 'f':
+                array[column] = [numpy.nan if value is None else value
+                                 for value in values]
+            elif kind == 'b':
+                array[column] = [bool(value) for value in values]
+            else:
+                values = ['' if value is None else
+                          unicode(value).encode('utf-8') for value in values]
+                # Don't let numpy silently truncate longer values
+                # (non-ASCII text, or rows added during the export)
+                width = dtype[column].itemsize
+                if any(len(value) > width for value in values):
+                    raise ExportError(
+                        "value of column %s longer than %d bytes" %
+                        (column, width))
+                array[column] = values
+        return array
+
+    def sized_chunks(self, count):
+        """Iterate over the rows as chunks, stopping after count rows,
+        and padding with empty rows up to count"""
+
+        remaining = count
+        for rows in self.chunks():
+            if remaining <= 0:
+                break
+            rows = rows[:remaining]
+            remaining -= len(rows)
+            yield rows
+        while remaining > 0:
+            n = min(remaining, self.chunksize)
+            remaining -= n
+            yield [(None,) * len(self.columns)] * n
+
+    def csv(self):
+        """Iterate over the CSV output"""
+
+        output = StringIO.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(self.columns)
+        yield output.getvalue()
+        for rows in self.chunks():
+            output = StringIO.StringIO()
+            writer = csv.writer(output)
+            writer.writerows(
+                [['' if value is None else
+                  (value.isoformat() if hasattr(value, 'isoformat') else
+                   unicode(value).encode('utf-8'))
+                  for value in row] for row in rows])
+            yield output.getvalue()
+
+    def npy(self):
+        """Return an iterator over the .npy output
+
+        The number of rows and the column widths are obtained right
+        away, so that errors show before the output starts.
+        """
+
+        return self._npy(self.count(), self.dtype())
+
+    def _npy(self, count, dtype):
+        header = StringIO.StringIO()
+        numpy.lib.format.write_array_header_1_0(header, {
+            'descr': numpy.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False, 'shape': (count,)})
+        yield header.getvalue()
+        for rows in self.sized_chunks(count):
+            yield self.array(rows, dtype).tostring()
+
+    def fits(self):
+        """Return an iterator over the FITS output: an empty primary HDU
+        and a binary table extension
+
+        As for npy(), the number of rows and the column widths are
+        obtained right away.
+        """
+
+        return self._fits(self.count(), self.dtype(fits=True))
+
+    def _fits(self, count, dtype):
+        cards = [_card('SIMPLE', True), _card('BITPIX', 8),
+                 _card('NAXIS', 0), _card('EXTEND', True)]
+        yield _header(cards)
+        cards = [_card('XTENSION', 'BINTABLE', 'binary table extension'),
+                 _card('BITPIX', 8), _card('NAXIS', 2),
+                 _card('NAXIS1', dtype.itemsize, 'bytes per row'),
+                 _card('NAXIS2', count, 'number of rows'),
+                 _card('PCOUNT', 0), _card('GCOUNT', 1),
+                 _card('TFIELDS', len(self.columns))]
+        for i, column in enumerate(self.columns):
+            n = i + 1
+            type = self.available[column][1]
+            field = dtype[column]
+            cards.append(_card('TTYPE%d' % n, column))
+            if COLUMN_DTYPES.get(type) in TIME_DTYPES:
+                cards.append(_card('TFORM%d' % n, 'D'))
+                cards.append(_card('TUNIT%d' % n, 'd', 'MJD'))
+            elif field.kind == 'i':
+                cards.append(_card('TFORM%d' % n, 'K'))
+                cards.append(_card('TNULL%d' % n, NULL_INT))
+            elif field.kind == 'f':
+                cards.append(_card('TFORM%d' % n, 'D'))
+            elif COLUMN_DTYPES.get(type) is numpy.bool_:
+                cards.append(_card('TFORM%d' % n, 'L'))
+            else:
+                cards.append(_card('TFORM%d' % n, '%dA' % field.itemsize))
+        cards.append(_card('DATASET', self.dataset))
+        yield _header(cards)
+        for rows in self.sized_chunks(count):
+            yield self.array(rows, dtype, fits=True).tostring()
+        size = count * dtype.itemsize
+        if size % FITS_BLOCK:
+            yield '\0' * (FITS_BLOCK - size % FITS_BLOCK)
+
+
+def _card(key, value, comment=''):
+    """A FITS header card"""
+
+    if isinstance(value, bool):
+        value = "%20s" % ('T' if value else 'F')
+    elif isinstance(value, (int, long)):
+        value = "%20d" % value
+    else:
+        value = "%-20s" % ("'%-8s'" % str(value).replace("'", "''"))
+    card = "%-8s= %s" % (key, value)
+    if comment:
+        card += " / " + comment
+    return "%-80s" % card[:80]
+
+
+def _header(cards):
+    """A FITS header from cards, padded to a whole block"""
+
+    header = "".join(cards) + "%-80s" % "END"
+    return header + " " * (-len(header) % FITS_BLOCK)
@@ -0,0 +1,240 @@
+"""
+Persistent index of image header information
+
+The index is stored through the Django ImageHeader model, keyed by the
+image url, and validated against the file modification time and size.
+"""
+
+import os
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from django.db import IntegrityError
+from django.db import transaction
+from tkpweb import settings
+from ..models import ImageHeader
+from .image import open_image
+
+
+# Maximum number of urls in a single lookup query, and of entries in a
+# single insert; SQLite does not allow more than 999 query parameters
+LOOKUP_CHUNKSIZE = 500
+STORE_CHUNKSIZE = 100
+
+logger = logging.getLogger(__name__)
+
+# Threads that examine image files, shared by all requests of a process
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def read_phase_centre(url, database=None):
+    """Open an image and obtain its phase centre from the header
+
+    Returns (ra, dec); (None, None) if the image can't be opened or
+    the header doesn't contain the phase centre.
+    """
+
+    img = open_image(url, database=database)
+    try:
+        header = img.get_header()
+        return header['phasera'], header['phasedec']
+    except (KeyError, AttributeError):
+        return None, None
+
+
+def _stat(url):
+    try:
+        stat = os.stat(url)
+    except (OSError, TypeError):
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def lookup(urls):
+    """Return the indexed entries for urls, as a dict url: ImageHeader"""
+
+    urls = list(set(urls))
+    entries = {}
+    for i in range(0, len(urls), LOOKUP_CHUNKSIZE):
+        for entry in ImageHeader.objects.filter(
+            url__in=urls[i:i+LOOKUP_CHUNKSIZE]):
+            entries[entry.url] = entry
+    return entries
+
+
+def _examine(url, entry, validate, database):
+    """Return the phase centre of url, and a new ImageHeader if the
+    image was read; entry is its current index entry or None"""
+
+    if entry is not None and not validate:
+        return (entry.ra, entry.dec), None
+    stat = _stat(url)
+    if stat is None:
+        # Missing file; nothing to read or index
+        return (None, None), None
+    if entry is not None and (entry.mtime, entry.size) == stat:
+        return (entry.ra, entry.dec), None
+    ra, dec = read_phase_centre(url, database=database)
+    return (ra, dec), ImageHeader(url=url, mtime=stat[0], size=stat[1],
+                                  ra=ra, dec=dec)
+
+
+def phase_centres(urls, database=None, validate=None, refresh=False,
+                  threads=None, timeout=None):
+    """Obtain the phase centres for a list of image urls
+
+    Indexed images are not opened; images missing from the index, or
+    changed since they were indexed, are read and (re)indexed. Files
+    are examined (stat() and read) in parallel, as each file access may
+    have a high latency on network file systems.
+
+    Kwargs:
+
+        database (tkp.database.database.DataBase): passed on to
+            open_image()
+
+        validate (bool or None): compare the modification time and
+            size of each file with the indexed values. This requires
+            a stat() call per file, but no file is opened. If None, the
+            IMAGE_HEADER_INDEX_VALIDATE setting is used (default True).
+
+        refresh (bool): ignore the current index and reread all images
+
+        threads (int or None): number of threads of the pool that
+            examines the files, shared by all requests of the process
+            (and fixed once the pool has been created); with 1 or less,
+            files are examined one by one in the calling thread. If
+            None, the IMAGE_HEADER_THREADS setting is used (default
+            16).
+
+        timeout (float or None): number of seconds to wait for a single
+            file, from the moment it is being examined; files taking
+            longer are given (None, None), and are not indexed. If
+            None, the IMAGE_HEADER_TIMEOUT setting is used (default 10).
+
+    Returns:
+
+        (dict): url: (ra, dec). Images that can't be read have (None,
+            None).
+    """
+
+    if validate is None:
+        validate = getattr(settings, 'IMAGE_HEADER_INDEX_VALIDATE', True)
+    if threads is None:
+        threads = getattr(settings, 'IMAGE_HEADER_THREADS', 16)
+    if timeout is None:
+        timeout = getattr(settings, 'IMAGE_HEADER_TIMEOUT', 10)
+    entries = {} if refresh else lookup(urls)
+    centres = {}
+    pending = []
+    for url in set(urls):
+        entry = entries.get(url)
+        if entry is not None and not validate:
+            centres[url] = entry.ra, entry.dec
+        else:
+            pending.append(url)
+    if len(pending) <= 1 or threads <= 1:
+        results = [_examine_logged(url, entries.get(url), validate, database)
+                   for url in pending]
+    else:
+        results = _examine_parallel(pending, entries, validate, database,
+                                    threads, timeout)
+    new = []
+    for url, (centre, entry) in zip(pending, results):
+        centres[url] = centre
+        if entry is not None:
+            new.append(entry)
+    store(new)
+    return centres
+
+
+def _examine_logged(url, entry, validate, database, started=None,
+                    abandoned=None):
+    """_examine(), giving (None, None) for files that fail; records the
+    start time in started[url], if given, and skips the file if the
+    abandoned event is set"""
+
+    if abandoned is not None and abandoned.is_set():
+        return (None, None), None
+    if started is not None:
+        started[url] = time.time()
+    try:
+        return _examine(url, entry, validate, database)
+    except Exception:
+        logger.exception("error reading the header of %s", url)
+        return (None, None), None
+
+
+def _get_pool(threads):
+    """Return the shared thread pool, created with threads threads"""
+
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(threads)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _examine_parallel(urls, entries, validate, database, threads, timeout):
+    """_examine() the urls on the shared thread pool; returns the
+    results in the order of urls
+
+    Each file gets timeout seconds from the moment a thread starts on
+    it. Threads stuck on a file keep their place in the pool until the
+    file access returns, so the pool bounds the number of stuck threads
+    in the process; the request as a whole waits no longer than all
+    files would take if every thread hit the timeout.
+    """
+
+    pool = _get_pool(threads)
+    started = {}
+    abandoned = threading.Event()
+    jobs = [pool.apply_async(
+        _examine_logged,
+        (url, entries.get(url), validate, database, started, abandoned))
+        for url in urls]
+    deadline = time.time() + timeout * (len(urls) // threads + 1)
+    results = []
+    for url, job in zip(urls, jobs):
+        while not job.ready():
+            start = started.get(url)
+            limit = deadline if start is None else min(deadline,
+                                                       start + timeout)
+            remaining = limit - time.time()
+            if remaining <= 0:
+                break
+            # While queued, check regularly whether the file was started
+            job.wait(remaining if start is not None else min(remaining, 0.1))
+        if job.ready():
+            results.append(job.get())
+        else:
+            logger.warning("timeout reading the header of %s", url)
+            results.append(((None, None), None))
+    # Files still queued after a timeout are not examined anymore
+    abandoned.set()
+    return results
+
+
+def store(entries):
+    """Add or replace index entries (a list of ImageHeader instances)"""
+
+    if not entries:
+        return
+    urls = [entry.url for entry in entries]
+    try:
+        # Replace the entries in a single transaction, so a failed
+        # insert doesn't leave the old entries deleted
+        with transaction.commit_on_success():
+            for i in range(0, len(urls), LOOKUP_CHUNKSIZE):
+                ImageHeader.objects.filter(
+                    url__in=urls[i:i+LOOKUP_CHUNKSIZE]).delete()
+            for i in range(0, len(entries), STORE_CHUNKSIZE):
+                ImageHeader.objects.bulk_create(entries[i:i+STORE_CHUNKSIZE])
+    except IntegrityError:
+        # Another request indexed (some of) the same images in the
+        # meantime; their entries are kept
+        pass
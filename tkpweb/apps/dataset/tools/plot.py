@@ -1,26 +1,31 @@
 import StringIO
 import base64
 import datetime
-import time
 import numpy
 import aplpy
 from scipy.stats import scoreatpercentile
 import matplotlib
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PolyCollection
+from matplotlib.collections import EllipseCollection
 from tkp.utility import accessors
 from .image import open_image
+from . import plotcache
 import dbase
 
 
 class Plot(object):
 
+    # Code version of the plot; increase when a change in the plotting
+    # code alters the output, to avoid reusing cached plots
+    version = 1
+
     def __init__(self, response=None, size=(5, 5)):
         self.size = size
         self.response = response
         self.image = None
+        self.data = None
 
     def pre(self):
         """Hook for any preprocessing"""
@@ -40,9 +45,10 @@ class Plot(object):
              self.image = self.response
         memfig = StringIO.StringIO()
         self.canvas.print_figure(memfig, format=format, transparent=True)
+        self.data = memfig.getvalue()
         encoded_png = StringIO.StringIO()
         encoded_png.write('data:image/%s;base64,\n' % format)
-        encoded_png.write(base64.b64encode(memfig.getvalue()))
+        encoded_png.write(base64.b64encode(self.data))
         self.image = encoded_png.getvalue()
 
     def render(self, *args, **kwargs):
@@ -58,10 +64,57 @@ class Plot(object):
         """Do the actual plotting work"""
         raise NotImplementedError
 
+    def cached(self, identity, *args, **kwargs):
+        """Render through the plot cache, and return the plot URL
+
+        identity should uniquely identify the input of the plot (the
+        remaining arguments, which are passed on to render()), for
+        example through the file name and modification time of an
+        image, and a digest of the plotted sources. The plot is only
+        rendered if it's not in the cache yet.
+        """
+
+        format = kwargs.get('format', 'png')
+        key = plotcache.key(self, identity, format)
+        if not plotcache.exists(key):
+            self.render(*args, **kwargs)
+            plotcache.store(key, self.data)
+        return plotcache.url(key, format)
+
+    def cached_data(self, identity, *args, **kwargs):
+        """Like cached(), but return the plot data itself"""
+
+        format = kwargs.get('format', 'png')
+        key = plotcache.key(self, identity, format)
+        data = plotcache.get(key)
+        if data is None:
+            self.render(*args, **kwargs)
+            data = self.data
+            plotcache.store(key, data)
+        return data
+
 
 class ImagePlot(Plot):
 
-    def plot(self, dbimage, scale=0.9, plotsources=None, database=None):
+    version = 2
+
+    # Level of detail of the source overlay: sources are drawn as points
+    # instead of ellipses when there are more than max_ellipses of them,
+    # or when the median ellipse would be smaller than min_ellipse_size
+    # pixels on screen
+    max_ellipses = 5000
+    min_ellipse_size = 3.
+
+    def plot(self, dbimage, scale=0.9, plotsources=None, database=None,
+             overlay='auto'):
+        """Plot an image, with optionally the plotsources overlaid
+
+        plotsources is a sequence of rows, or a dict of arrays as
+        returned by DataBase.columns(), with the ra, decl, semimajor,
+        semiminor and pa of the sources. overlay is 'ellipses', 'points'
+        or 'auto' to choose by the level of detail thresholds.
+        """
+
         try:
             image = aplpy.FITSFigure(dbimage['url'], figure=self.figure, auto_refresh=False)
         except IOError:
@@ -70,13 +123,61 @@ class ImagePlot(Plot):
             return
         image.show_grayscale()
         image.tick_labels.set_font(size=5)
-        if plotsources:
-            ra = [source['ra'] for source in plotsources]
-            dec = [source['decl'] for source in plotsources]
-            semimajor = [source['semimajor']/900 for source in plotsources]
-            semiminor = [source['semiminor']/900 for source in plotsources]
-            pa = [source['pa']+90 for source in plotsources]
-            image.show_ellipses(ra, dec, semimajor, semiminor, pa, facecolor='none', edgecolor='green')
+        if plotsources is not None and len(plotsources):
+            self.plot_sources(image, plotsources, overlay=overlay)
+
+    @staticmethod
+    def source_arrays(sources):
+        """Return the ra, decl, semimajor, semiminor and pa of sources
+        as arrays"""
+
+        names = ('ra', 'decl', 'semimajor', 'semiminor', 'pa')
+        if isinstance(sources, dict):
+            return [numpy.asarray(sources[name], dtype=numpy.float64)
+                    for name in names]
+        return [numpy.fromiter((source[name] for source in sources),
+                               dtype=numpy.float64, count=len(sources))
+                for name in names]
+
+    def plot_sources(self, image, sources, overlay='auto'):
+        """Overlay the sources on image (an aplpy.FITSFigure) as a
+        single collection of ellipses, or a single set of points"""
+
+        ra, dec, semimajor, semiminor, pa = self.source_arrays(sources)
+        x, y = image.world2pixel(ra, dec)
+        x, y = numpy.asarray(x), numpy.asarray(y)
+        # Local pixel scale (pixels per degree) at each source, from the
+        # offset of a point 1 arcsec towards the equator (so it never
+        # passes a pole)
+        delta = numpy.where(dec > 0, -1., 1.) / 3600.
+        xn, yn = image.world2pixel(ra, dec + delta)
+        scale = numpy.hypot(numpy.asarray(xn) - x,
+                            numpy.asarray(yn) - y) / numpy.abs(delta)
+        # As aplpy.show_ellipses() with the original overlay
+        widths = semimajor / 900. * scale
+        heights = semiminor / 900. * scale
+        angles = pa + 90
+        # The image axes: public in newer aplpy versions, otherwise the
+        # first axes aplpy added to our figure
+        axes = getattr(image, 'ax', None) or self.figure.axes[0]
+        if overlay == 'auto':
+            xlim = axes.get_xlim()
+            zoom = axes.bbox.width / abs(xlim[1] - xlim[0])
+            if (len(x) > self.max_ellipses or
+                numpy.median(widths) * zoom < self.min_ellipse_size):
+                overlay = 'points'
+            else:
+                overlay = 'ellipses'
+        if overlay == 'points':
+            axes.plot(x, y, linestyle='none', marker='.', markersize=2,
+                      color='green')
+        else:
+            ellipses = EllipseCollection(
+                widths, heights, angles, units='xy',
+                offsets=numpy.column_stack((x, y)),
+                transOffset=axes.transData, facecolors='none',
+                edgecolors='green')
+            axes.add_collection(ellipses)
 
 
 class ThumbnailPlot(Plot):
@@ -102,38 +203,84 @@ class ThumbnailPlot(Plot):
         self.figure.subplots_adjust(bottom=0, left=0, top=1, right=1)
 
 
+def decimate_minmax(times, values, nbins):
+    """Select the points with the minimum and maximum value in each of
+    nbins equal time bins
+
+    Returns the sorted indices of the selected points: at most 2 *
+    nbins, showing the same envelope as the full set of points.
+    """
+
+    if len(times) <= 2 * nbins:
+        return numpy.arange(len(times))
+    tmin, tmax = times.min(), times.max()
+    bins = ((times - tmin) * (nbins / ((tmax - tmin) or 1.))).astype(int)
+    bins = numpy.minimum(bins, nbins - 1)
+    # Sort by bin, and by value within each bin; the first and last
+    # point of each bin are then its minimum and maximum
+    order = numpy.lexsort((values, bins))
+    sortedbins = bins[order]
+    first = numpy.flatnonzero(numpy.r_[True, sortedbins[1:] != sortedbins[:-1]])
+    last = numpy.r_[first[1:] - 1, len(order) - 1]
+    return numpy.unique(numpy.r_[order[first], order[last]])
+
+
 class LightcurvePlot(Plot):
 
-    def plot(self, lc, T0=None, images=None, trigger_index=None):
-        times = numpy.array([time.mktime(point[0].timetuple()) for point in lc])
-        inttimes = [point[1]/2. for point in lc]
-        fluxes = [point[2] for point in lc]
-        errors = [point[3] for point in lc]
+    version = 2
+
+    def plot(self, lc, T0=None, images=None, trigger_index=None,
+             decimate=None):
+        """Plot a lightcurve
+
+        lc is a sequence of (time stamp, integration time, flux, flux
+        error, ...) points; images a sequence of (time stamp,
+        integration time) of the images, shown as bars.
+
+        If decimate is True (or a number of bins), only the minimum and
+        maximum flux per time bin is plotted; by default, there are as
+        many bins as the figure is wide in pixels.
+        """
+
+        if not len(lc):
+            return
+        columns = zip(*lc)
+        timestamps = numpy.array(columns[0], dtype='datetime64[us]')
+        inttimes = numpy.array(columns[1], dtype=numpy.float64) / 2.
+        fluxes = numpy.array(columns[2], dtype=numpy.float64)
+        errors = numpy.array(columns[3], dtype=numpy.float64)
+        if images:
+            images = zip(*images)
+            imagetimes = numpy.array(images[0], dtype='datetime64[us]')
         if T0 is None:
-            tmin = sorted(times)[0]
+            tmin = timestamps.min()
             if images:
-                tmin2 = time.mktime(sorted(zip(*images)[0])[0].timetuple())
-                if tmin2  < tmin:
-                    tmin = tmin2
-            tmin = datetime.datetime.fromtimestamp(tmin)
-            T0 = datetime.datetime(tmin.year, tmin.month, tmin.day, 0, 0, 0)
-        tdiff = T0 - datetime.datetime(1970, 1, 1)
-        tdiff = (tdiff.microseconds + (tdiff.seconds + tdiff.days * 86400) * 1e6) / 1e6
-        times -= tdiff
+                tmin = min(tmin, imagetimes.min())
+            T0 = tmin.astype('datetime64[D]').astype(object)
+            T0 = datetime.datetime(T0.year, T0.month, T0.day, 0, 0, 0)
+        t0 = numpy.datetime64(T0, 'us')
+        times = (timestamps - t0).astype(numpy.int64) / 1e6
         axes = self.figure.add_subplot(1, 1, 1)
-        axes.errorbar(x=times, y=fluxes, yerr=errors, xerr=numpy.array(inttimes)/2., fmt='bo')
+        points = slice(None)
+        if decimate:
+            nbins = decimate
+            if decimate is True:
+                nbins = int(self.figure.get_figwidth() * self.figure.get_dpi())
+            points = decimate_minmax(times, fluxes, nbins)
+        axes.errorbar(x=times[points], y=fluxes[points], yerr=errors[points],
+                      xerr=inttimes[points]/2., fmt='bo')
         if trigger_index is not None:
             axes.errorbar(x=times[trigger_index], y=fluxes[trigger_index], fmt='o', mec='r', ms=15., mfc='None')
         ylimits = axes.get_ylim()
         if images:
-            images = zip(*images)
-            x = numpy.array([time.mktime(x.timetuple()) for x in images[0]]) - tdiff
-            xerr = numpy.array(images[1])/2.
-            patches = [Rectangle((xx - xxerr, ylimits[0]), xxerr, ylimits[1]-ylimits[0])
-                    for xx, xxerr in zip(x, xerr)]
-            patches = PatchCollection(patches, alpha=0.3, linewidth=0, visible=True, color='r')
-            axes.add_collection(patches)
+            x = (imagetimes - t0).astype(numpy.int64) / 1e6
+            xerr = numpy.array(images[1], dtype=numpy.float64) / 2.
+            # All bars as a single collection of rectangles
+            left = x - xerr
+            verts = numpy.empty((len(x), 4, 2))
+            verts[:, :, 0] = numpy.column_stack((left, left, x, x))
+            verts[:, :, 1] = [ylimits[0], ylimits[1], ylimits[1], ylimits[0]]
+            bars = PolyCollection(verts, alpha=0.3, linewidth=0, color='r')
+            axes.add_collection(bars)
         axes.set_xlabel('Seconds since %s' % T0.strftime('%Y-%m-%dT%H:%M:%S'))
         axes.set_ylabel('Flux (Jy)')
-
-
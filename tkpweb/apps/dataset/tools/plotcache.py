@@ -0,0 +1,132 @@
+"""
+On-disk cache of rendered plots
+
+Plots are stored under a content address: a hash of the plot class and
+its code version, the identity of the plot input, the figure size and
+the output format. Pages refer to cached plots by URL (see
+Plot.cached()), so the HTML stays small and browsers can cache the
+images. The cache is bounded in size, evicting the least recently used
+plots first.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import threading
+from django.core.urlresolvers import reverse
+from tkpweb import settings
+from .cache import DiskCache
+
+
+MIMETYPES = {
+    'png': "image/png",
+    'svg': "image/svg+xml",
+    'pdf': "application/pdf",
+    }
+
+
+def digest(*parts):
+    """Return a hash for (the repr of) parts"""
+
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def file_identity(filename):
+    """Identify the contents of a file by its name, modification time
+    and size, without reading it"""
+
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return (filename, None, None)
+    return (filename, stat.st_mtime, stat.st_size)
+
+
+def key(plot, identity, format):
+    """Cache key for a plot instance, its input identity and format"""
+
+    cls = plot.__class__
+    return digest(cls.__module__, cls.__name__, cls.version, identity,
+                  tuple(plot.size), format)
+
+
+def url(key, format):
+    return reverse('dataset:plot', kwargs={'key': key, 'format': format})
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Obtain the plot cache, as configured by the PLOT_CACHE_DIR and
+    PLOT_CACHE_MAX_BYTES settings"""
+
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache(
+                getattr(settings, 'PLOT_CACHE_DIR',
+                        os.path.join(settings.BASE_DIR, 'cache', 'plots')),
+                max_bytes=getattr(settings, 'PLOT_CACHE_MAX_BYTES',
+                                  1024*1024*1024))
+    return _cache
+
+
+def get(key):
+    """Return the cached plot data for key, or None"""
+
+    return get_cache().get(key)
+
+
+def exists(key):
+    """Return whether key is in the cache, marking it as recently used"""
+
+    try:
+        os.utime(get_cache().filename(key), None)
+    except OSError:
+        return False
+    return True
+
+
+def store(key, data):
+    get_cache().set(key, data)
+
+
+# Render states of plots that are not in the cache yet, recorded as
+# marker files next to the cache entries, so every process can see them
+STATES = ('pending', 'failed')
+
+
+def _marker(key, state):
+    return os.path.join(get_cache().path, "%s.%s" % (key, state))
+
+
+def set_state(key, state=None):
+    """Record the render state of key: 'pending', 'failed', or None to
+    clear it"""
+
+    for name in STATES:
+        if name == state:
+            continue
+        try:
+            os.remove(_marker(key, name))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+    if state is not None:
+        open(_marker(key, state), 'w').close()
+
+
+def get_state(key):
+    """Return the recorded render state of key and its age (seconds),
+    or (None, None)"""
+
+    for state in STATES:
+        try:
+            mtime = os.stat(_marker(key, state)).st_mtime
+        except OSError:
+            continue
+        return state, time.time() - mtime
+    return None, None
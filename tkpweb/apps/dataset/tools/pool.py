@@ -0,0 +1,170 @@
+"""
+Process-wide pool of TKP database connections
+
+Connections are kept per database login (host, port, name, user), so
+that requests don't have to set up a new connection every time.
+"""
+
+import os
+import time
+import threading
+from tkp.database import database
+from tkpweb import settings
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available in time"""
+    pass
+
+
+class ConnectionPool(object):
+    """Pool of tkp.database.database.DataBase connections
+
+    Kwargs:
+
+        maxsize (int): maximum number of open connections per login
+
+        timeout (float): number of seconds to wait for a connection
+            when all connections for a login are in use
+
+        idle_timeout (float): connections idle for longer than this
+            number of seconds are closed instead of reused
+    """
+
+    def __init__(self, maxsize=4, timeout=30, idle_timeout=300):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """Forget all connections (without closing them)"""
+
+        self.pid = os.getpid()
+        self.idle = {}   # key: list of (connection, time of release)
+        self.size = {}   # key: number of open connections
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0,
+                         'discarded': 0}
+
+    @staticmethod
+    def key(dblogin):
+        if not dblogin:
+            return None
+        return tuple(dblogin.get(item) for item in
+                     ('host', 'port', 'name', 'user'))
+
+    def connect(self, dblogin):
+        return database.DataBase(**dblogin) if dblogin else database.DataBase()
+
+    def acquire(self, dblogin=None):
+        """Obtain a connection for dblogin (None for the default database)
+
+        The connection should be given back with release() when done.
+        """
+
+        key = self.key(dblogin)
+        deadline = time.time() + self.timeout
+        waited = False
+        while True:
+            connection = None
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Connections can't be shared with a parent process
+                    self.reset()
+                idle = self.idle.setdefault(key, [])
+                if idle:
+                    connection, released = idle.pop()
+                elif self.size.get(key, 0) < self.maxsize:
+                    self.size[key] = self.size.get(key, 0) + 1
+                    self.counters['misses'] += 1
+                    break
+                else:
+                    if not waited:
+                        self.counters['waits'] += 1
+                        waited = True
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        raise PoolTimeout(
+                            "no database connection available after %s "
+                            "seconds" % self.timeout)
+                    self.lock.wait(remaining)
+                    continue
+            # Check the idle connection outside the lock
+            if (time.time() - released <= self.idle_timeout and
+                self.check(connection)):
+                with self.lock:
+                    self.counters['hits'] += 1
+                return connection
+            with self.lock:
+                self.discard(key, connection)
+        # Set up the new connection outside the lock
+        try:
+            return self.connect(dblogin)
+        except Exception:
+            with self.lock:
+                self.size[key] -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, dblogin, connection):
+        """Give a connection back to the pool
+
+        Any open transaction is rolled back; connections for which that
+        fails are closed.
+        """
+
+        key = self.key(dblogin)
+        try:
+            connection.connection.rollback()
+        except Exception:
+            with self.lock:
+                self.discard(key, connection)
+                self.lock.notify()
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.idle.setdefault(key, []).append((connection, time.time()))
+            self.lock.notify()
+
+    def check(self, connection):
+        """Verify that a connection is still usable"""
+
+        try:
+            cursor = connection.connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        except Exception:
+            return False
+        return True
+
+    def discard(self, key, connection):
+        # Should be called with the lock held
+        self.size[key] = self.size.get(key, 1) - 1
+        self.counters['discarded'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """Return the pool counters, and the number of open and idle
+        connections per login"""
+
+        with self.lock:
+            stats = dict(self.counters)
+            stats['connections'] = [
+                {'host': key[0], 'port': key[1], 'name': key[2],
+                 'user': key[3], 'open': self.size.get(key, 0),
+                 'idle': len(self.idle.get(key, []))}
+                if key else
+                {'open': self.size.get(key, 0),
+                 'idle': len(self.idle.get(key, []))}
+                for key in self.size]
+            stats['pid'] = self.pid
+        return stats
+
+
+pool = ConnectionPool(**getattr(settings, 'DATABASE_POOL', {}))
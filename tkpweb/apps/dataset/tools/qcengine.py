@@ -0,0 +1,160 @@
+"""
+Quality control computations on the extracted sources of a dataset
+
+Sources and image pointings are each fetched once, with a single query
+over the extracted sources of the dataset, and the quantities are
+computed on the resulting arrays.
+"""
+
+import numpy
+from . import headers
+
+
+def unit_vectors(ra, dec):
+    """Cartesian unit vectors for ra and dec (degrees), as an (N, 3)
+    array"""
+
+    ra, dec = numpy.radians(ra), numpy.radians(dec)
+    return numpy.column_stack((numpy.cos(dec) * numpy.cos(ra),
+                               numpy.cos(dec) * numpy.sin(ra),
+                               numpy.sin(dec)))
+
+
+def angular_distance(xyz1, xyz2):
+    """Angular distance (degrees) between rows of unit vectors"""
+
+    chord = numpy.sqrt(((xyz1 - xyz2)**2).sum(axis=1))
+    return numpy.degrees(2 * numpy.arcsin(numpy.minimum(chord / 2, 1)))
+
+
+def pointings(database, dataset, first=0, last=None):
+    """Return the ids of the images first < id <= last of dataset, and
+    the unit vectors of their pointing (phase) centres
+
+    The phase centres come from the image header index; images without
+    a phase centre get NaN vectors.
+    """
+
+    query = "SELECT imageid, url FROM images WHERE ds_id = %s AND imageid > %s"
+    args = [dataset, first]
+    if last is not None:
+        query += " AND imageid <= %s"
+        args.append(last)
+    images = database.db.get(query + " ORDER BY imageid", *args)
+    imageid = numpy.array([row[0] for row in images], dtype=numpy.int64)
+    urls = [row[1] for row in images]
+    centres = headers.phase_centres(urls, database=database.db)
+    radec = numpy.array([centres.get(url, (None, None)) for url in urls],
+                        dtype=numpy.float64).reshape(-1, 2)
+    return imageid, unit_vectors(radec[:, 0], radec[:, 1])
+
+
+def rms_distance(database, dataset, first=0, last=None):
+    """Return the distance from the pointing centre of their image
+    (degrees) and the rms (mJy/beam) of the sources extracted from the
+    images first < id <= last of dataset"""
+
+    imageid, pointing = pointings(database, dataset, first, last)
+    query = """\
+SELECT ex.image_id
+      ,ex.x
+      ,ex.y
+      ,ex.z
+      ,20000 * ex.i_peak / ex.det_sigma AS rms_mjy
+  FROM extractedsources ex
+      ,images im
+ WHERE ex.image_id = im.imageid
+   AND im.ds_id = %s
+   AND ex.image_id > %s
+"""
+    args = [dataset, first]
+    if last is not None:
+        query += "   AND ex.image_id <= %s\n"
+        args.append(last)
+    sources = database.columns(query, *args)
+    if not len(sources['image_id']) or not len(imageid):
+        return numpy.zeros(0), numpy.zeros(0)
+    # Look up the pointing of each source by its image id
+    index = numpy.searchsorted(imageid, sources['image_id'])
+    index = numpy.minimum(index, len(imageid) - 1)
+    xyz = numpy.column_stack((sources['x'], sources['y'], sources['z']))
+    distance = angular_distance(xyz, pointing[index])
+    distance[imageid[index] != sources['image_id']] = numpy.nan
+    return distance, sources['rms_mjy']
+
+
+def counterpart_offsets(database, dataset, first=0, last=None):
+    """Return the RA and declination offsets (arcsec) of the associated
+    sources extracted from the images first < id <= last of dataset
+    from their running catalog positions, and their RA and declination
+    errors"""
+
+    query = """\
+SELECT 3600 * (x.ra - r.wm_ra) AS ra_dist_arcsec
+      ,3600 * (x.decl - r.wm_decl) AS decl_dist_arcsec
+      ,x.ra_err/2 AS ra_err
+      ,x.decl_err/2 AS decl_err
+  FROM assocxtrsources a
+      ,extractedsources x
+      ,runningcatalog r
+      ,images im1
+ WHERE a.xtrsrc_id <> a.assoc_xtrsrc_id
+   AND a.xtrsrc_id = r.xtrsrc_id
+   AND a.assoc_xtrsrc_id = x.xtrsrcid
+   AND x.image_id = im1.imageid
+   AND im1.ds_id = %s
+   AND x.image_id > %s
+"""
+    args = [dataset, first]
+    if last is not None:
+        query += "   AND x.image_id <= %s\n"
+        args.append(last)
+    results = database.columns(query, *args)
+    return (results['ra_dist_arcsec'], results['decl_dist_arcsec'],
+            results['ra_err'], results['decl_err'])
+
+
+def profile(distance, values, edges, percentiles=(16, 50, 84)):
+    """Binned percentile profile of values against distance
+
+    Returns an array with a row per percentile and a column per
+    distance bin; empty bins are NaN.
+    """
+
+    result = numpy.empty((len(percentiles), len(edges) - 1))
+    result.fill(numpy.nan)
+    finite = numpy.isfinite(distance) & numpy.isfinite(values)
+    distance, values = distance[finite], values[finite]
+    bins = numpy.digitize(distance, edges) - 1
+    inside = (bins >= 0) & (bins < len(edges) - 1)
+    bins, values = bins[inside], values[inside]
+    # Sort by bin, then by value; each bin is then a sorted slice
+    order = numpy.lexsort((values, bins))
+    bins, values = bins[order], values[order]
+    starts = numpy.searchsorted(bins, numpy.arange(len(edges)))
+    for i in numpy.flatnonzero(numpy.diff(starts)):
+        result[:, i] = numpy.percentile(values[starts[i]:starts[i+1]],
+                                        percentiles)
+    return result
+
+
+def histogram_profile(counts, edges, percentiles=(16, 50, 84)):
+    """Percentile profile from a 2D histogram
+
+    counts has a row per distance bin and a column per value bin with
+    the given edges. Percentiles are interpolated within the value
+    bins (in log space for logarithmic edges). Returns an array as
+    profile().
+    """
+
+    result = numpy.empty((len(percentiles), counts.shape[0]))
+    result.fill(numpy.nan)
+    logarithmic = edges[0] > 0 and numpy.allclose(
+        numpy.diff(numpy.log(edges)), numpy.log(edges[1] / edges[0]))
+    scale = numpy.log10(edges) if logarithmic else numpy.asarray(edges)
+    cumulative = numpy.cumsum(counts, axis=1).astype(numpy.float64)
+    for i in numpy.flatnonzero(cumulative[:, -1]):
+        fractions = numpy.r_[0, cumulative[i] / cumulative[i, -1]] * 100
+        values = numpy.interp(percentiles, fractions, scale)
+        result[:, i] = 10**values if logarithmic else values
+    return result
@@ -0,0 +1,243 @@
+"""
+Materialized quality control summaries of datasets
+
+Instead of scanning all extracted sources of a dataset for every view
+of the dataset page, the quality control checks are summarized into a
+few small arrays, stored in the QCSummary model:
+
+- a 2D histogram of the rms of the extracted sources against their
+  distance from the pointing centre of their image
+
+- the number of extracted sources per image
+
+- a 2D histogram of the offsets of the associated sources from their
+  running catalog position, with the moments of the offsets
+
+The histograms have fixed bins, so the summary can be brought up to
+date by adding only the images that were added to the dataset since.
+Offsets are taken relative to the running catalog position at the
+time an image is summarized; they are recomputed when the dataset has
+been (re)processed, as a change in dataset version triggers a fresh
+summary.
+"""
+
+import json
+import numpy
+from django.db import IntegrityError
+from ..models import QCSummary
+from . import plotcache
+from . import qcengine
+
+
+# Increase when a change alters the summary contents, to summarize
+# datasets anew
+VERSION = 2
+
+# Bin edges of the histograms
+DISTANCE_EDGES = numpy.linspace(0, 10, 101)   # degrees
+RMS_EDGES = numpy.logspace(-2, 4, 61)         # mJy/beam
+OFFSET_EDGES = numpy.linspace(-30, 30, 61)    # arcsec
+
+# Number of counterpart offsets read at a time
+OFFSET_CHUNKSIZE = 100000
+
+
+class Summary(object):
+    """Quality control summary arrays of a dataset
+
+    Attributes:
+
+        rms_distance: counts per distance (DISTANCE_EDGES) and rms
+            (RMS_EDGES) bin
+
+        imageid, taustart, nsources: image id, start time and number of
+            extracted sources, per image
+
+        offsets: counts per RA and declination offset (OFFSET_EDGES)
+            bin
+
+        offset_moments: number, sums and sums of squares of the RA and
+            declination offsets, including those outside the bins
+    """
+
+    def __init__(self):
+        self.rms_distance = numpy.zeros(
+            (len(DISTANCE_EDGES) - 1, len(RMS_EDGES) - 1), dtype=numpy.int64)
+        self.imageid = numpy.zeros(0, dtype=numpy.int64)
+        self.taustart = numpy.zeros(0, dtype='datetime64[us]')
+        self.nsources = numpy.zeros(0, dtype=numpy.int64)
+        self.offsets = numpy.zeros(
+            (len(OFFSET_EDGES) - 1, len(OFFSET_EDGES) - 1), dtype=numpy.int64)
+        self.offset_moments = numpy.zeros(5)
+
+    def add_rms_distance(self, distance, rms):
+        counts, _, _ = numpy.histogram2d(
+            distance, rms, bins=(DISTANCE_EDGES, RMS_EDGES))
+        self.rms_distance += counts.astype(numpy.int64)
+
+    def add_images(self, imageid, taustart, nsources):
+        self.imageid = numpy.concatenate((self.imageid, imageid))
+        self.taustart = numpy.concatenate((
+            self.taustart, numpy.asarray(taustart, dtype='datetime64[us]')))
+        self.nsources = numpy.concatenate((self.nsources, nsources))
+        order = numpy.argsort(self.imageid, kind='mergesort')
+        self.imageid = self.imageid[order]
+        self.taustart = self.taustart[order]
+        self.nsources = self.nsources[order]
+
+    def add_offsets(self, ra, dec):
+        finite = numpy.isfinite(ra) & numpy.isfinite(dec)
+        ra, dec = ra[finite], dec[finite]
+        counts, _, _ = numpy.histogram2d(
+            ra, dec, bins=(OFFSET_EDGES, OFFSET_EDGES))
+        self.offsets += counts.astype(numpy.int64)
+        self.offset_moments += [len(ra), ra.sum(), dec.sum(),
+                                (ra**2).sum(), (dec**2).sum()]
+
+    def offset_stats(self):
+        """Return the number of offsets (in total and outside the
+        histogram), and the mean and standard deviation of the RA and
+        declination offsets; None without offsets"""
+
+        n, ra, dec, ra2, dec2 = self.offset_moments
+        if not n:
+            return None
+        ramean, decmean = ra / n, dec / n
+        return {'n': int(n), 'outside': int(n - self.offsets.sum()),
+                'ra_mean': ramean, 'dec_mean': decmean,
+                'ra_std': numpy.sqrt(max(ra2 / n - ramean**2, 0)),
+                'dec_std': numpy.sqrt(max(dec2 / n - decmean**2, 0))}
+
+    def to_json(self):
+        return json.dumps({
+            'rms_distance': self.rms_distance.tolist(),
+            'imageid': self.imageid.tolist(),
+            'taustart': self.taustart.astype(numpy.int64).tolist(),
+            'nsources': self.nsources.tolist(),
+            'offsets': self.offsets.tolist(),
+            'offset_moments': self.offset_moments.tolist()},
+            separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        summary = cls()
+        summary.rms_distance = numpy.array(data['rms_distance'],
+                                           dtype=numpy.int64)
+        summary.imageid = numpy.array(data['imageid'], dtype=numpy.int64)
+        summary.taustart = numpy.array(
+            data['taustart'], dtype=numpy.int64).astype('datetime64[us]')
+        summary.nsources = numpy.array(data['nsources'], dtype=numpy.int64)
+        summary.offsets = numpy.array(data['offsets'], dtype=numpy.int64)
+        summary.offset_moments = numpy.array(data['offset_moments'])
+        return summary
+
+    def digest(self):
+        """Identify the summary contents, for the plot cache"""
+
+        return plotcache.digest(self.to_json())
+
+
+def image_counts(database, dataset, first, last):
+    """Return the id, start time and number of extracted sources of the
+    images first < id <= last"""
+
+    query = """\
+SELECT im.imageid
+      ,im.taustart_ts
+      ,COUNT(ex.xtrsrcid) AS nsources
+  FROM images im
+       LEFT OUTER JOIN extractedsources ex
+       ON ex.image_id = im.imageid
+ WHERE im.ds_id = %s
+   AND im.imageid > %s
+   AND im.imageid <= %s
+GROUP BY im.imageid
+        ,im.taustart_ts
+"""
+    results = database.columns(query, dataset, first, last)
+    return results['imageid'], results['taustart_ts'], results['nsources']
+
+
+def iter_counterpart_offsets(database, dataset, first, last,
+                             chunksize=OFFSET_CHUNKSIZE):
+    """Iterate over the RA and declination offsets (arcsec) of the
+    associated sources extracted from images first < id <= last, from
+    their running catalog positions, in chunks of at most chunksize"""
+
+    query = """\
+SELECT 3600 * (x.ra - r.wm_ra) AS ra_dist_arcsec
+      ,3600 * (x.decl - r.wm_decl) AS decl_dist_arcsec
+  FROM assocxtrsources a
+      ,extractedsources x
+      ,runningcatalog r
+      ,images im1
+ WHERE a.xtrsrc_id <> a.assoc_xtrsrc_id
+   AND a.xtrsrc_id = r.xtrsrc_id
+   AND a.assoc_xtrsrc_id = x.xtrsrcid
+   AND x.image_id = im1.imageid
+   AND im1.ds_id = %s
+   AND x.image_id > %s
+   AND x.image_id <= %s
+"""
+    for chunk in database.iter_columns(query, dataset, first, last,
+                                       chunksize=chunksize):
+        yield chunk['ra_dist_arcsec'], chunk['decl_dist_arcsec']
+
+
+def update(summary, database, dataset, first, last):
+    """Add the images first < id <= last to summary"""
+
+    summary.add_rms_distance(
+        *qcengine.rms_distance(database, dataset, first, last))
+    summary.add_images(*image_counts(database, dataset, first, last))
+    # Associations are by far the largest; accumulate them chunk by chunk
+    for ra, dec in iter_counterpart_offsets(database, dataset, first, last):
+        summary.add_offsets(ra, dec)
+
+
+def get(database, dataset):
+    """Return the up to date Summary of dataset
+
+    Only images added since the stored summary was made are read. For
+    datasets that are still being processed, the newest image is left
+    out, as its sources may still be coming in.
+    """
+
+    key = repr(database.login_key())
+    version = plotcache.digest(VERSION, database.dataset_version(dataset))
+    ids = [imageid for (imageid,) in database.db.get("""\
+SELECT imageid FROM images WHERE ds_id = %s ORDER BY imageid DESC LIMIT 2
+""", dataset)]
+    if database.dataset_version(dataset) is None:
+        ids = ids[1:]
+    last = ids[0] if ids else 0
+    try:
+        stored = QCSummary.objects.get(database=key, dataset=dataset)
+    except QCSummary.DoesNotExist:
+        stored = None
+    if stored is not None and stored.version == version:
+        summary = Summary.from_json(stored.data)
+        first = stored.last_image
+    else:
+        summary = Summary()
+        first = 0
+    if last <= first:
+        return summary
+    update(summary, database, dataset, first, last)
+    if stored is None:
+        try:
+            QCSummary.objects.create(database=key, dataset=dataset,
+                                     version=version, last_image=last,
+                                     data=summary.to_json())
+        except IntegrityError:
+            # Summarized concurrently by another request
+            pass
+    else:
+        # Only replace the summary we started from; if another request
+        # updated it in the meantime, keep theirs
+        QCSummary.objects.filter(
+            pk=stored.pk, version=stored.version,
+            last_image=stored.last_image).update(
+            version=version, last_image=last, data=summary.to_json())
+    return summary
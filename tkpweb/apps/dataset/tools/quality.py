@@ -3,118 +3,181 @@ Quality control checks
 Based on tkp/database/qcplots.py
 """
 
-import StringIO
-import base64
 import numpy
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import cm
+from matplotlib.colors import LogNorm
+from matplotlib.dates import date2num
+from matplotlib.dates import AutoDateLocator
+from matplotlib.dates import AutoDateFormatter
 from .plot import Plot
+from . import qcsummary
+from . import qcengine
 
 
-def plot_rms_distance_from_fieldcentre(
-    database, dsid, dist_arcsec_cutoff=36000, response=None,
-    size=(8, 8)):
-    """Plot the rms of extracted sources in given dataset vs their
-    distance from the field centre."""
-
-    query = """\
-SELECT *
-FROM (SELECT ex.image_id
-            ,ex.xtrsrcid as xtrsrcid1
-            ,3600* DEGREES(2 * ASIN(SQRT( (ex.x - rc.x) * (ex.x - rc.x)
-                                        + (ex.y - rc.y) * (ex.y - rc.y)
-                                        + (ex.z - rc.z) * (ex.z - rc.z)
-                                        ) / 2)) AS centr_img_dist_deg
-            ,20000 * ex.i_peak / ex.det_sigma as rms_mJy
-        FROM extractedsources ex
-            ,images im
-            ,runningcatalog rc
-       WHERE ex.image_id = im.imageid
-         AND im.ds_id = rc.ds_id
-         AND rc.ds_id = %s
-      ) t
-WHERE centr_img_dist_deg < %s
-ORDER BY centr_img_dist_deg
-"""
-    database.db.cursor.execute(query, (dsid, dist_arcsec_cutoff))
-    results = zip(*database.db.get(query, dsid, dist_arcsec_cutoff))
+# Not-a-time (a NULL start time) as int64
+NAT = numpy.iinfo(numpy.int64).min
 
-    if not results:
-        return None
-    dist_deg, rms = results[2], results[3]
-    
-    figure = Figure(figsize=size)
-    canvas = FigureCanvasAgg(figure)
-    axes = figure.add_subplot(1, 1, 1)
-    axes.scatter(dist_deg, rms, c='r', s=20, edgecolor='r')
-    axes.set_xlabel(r'Distance from Pointing Centre (deg)', size='x-large')
-    axes.set_ylabel(r'rms (mJy/beam)', size='x-large')
-    axes.set_xlim(xmin=0)
-    axes.set_ylim(ymin=0)
-    axes.grid(True)
-
-    if response:
-        canvas.print_figure(response, format='png')
-        return response
-    memfig = StringIO.StringIO()
-    canvas.print_figure(memfig, format='png')
-    encoded_png = StringIO.StringIO()
-    encoded_png.write('data:image/png;base64,\n')
-    encoded_png.write(base64.b64encode(memfig.getvalue()))
-    return encoded_png.getvalue()
+
+class RmsDistancePlot(Plot):
+
+    def plot(self, summary, mode='histogram', points=None, database=None,
+             dataset=None, last=None):
+        """Plot the rms of extracted sources in a dataset vs their
+        distance from the pointing centre
+
+        mode is one of:
+
+            'histogram': the 2D histogram of the QC summary, with the
+                median rms per distance bin
+
+            'profile': the median rms per distance bin, with the 16th
+                to 84th percentile range
+
+            'scatter': the individual sources, given as points (a
+                (distance, rms) pair of arrays, see qcengine.rms_distance);
+                if points is None, they are obtained from database for
+                the images up to last of dataset, only when plotting
+        """
+
+        edges = qcsummary.DISTANCE_EDGES
+        centres = (edges[1:] + edges[:-1]) / 2.
+        axes = self.figure.add_subplot(1, 1, 1)
+        if mode == 'scatter':
+            if points is None:
+                points = qcengine.rms_distance(database, dataset, last=last)
+            distance, rms = points
+            if not len(distance):
+                return None
+            axes.plot(distance, rms, linestyle='none', marker='.',
+                      markersize=3, color='r')
+        else:
+            counts = numpy.ma.masked_equal(summary.rms_distance, 0)
+            if not counts.count():
+                return None
+            lower, median, upper = qcengine.histogram_profile(
+                summary.rms_distance, qcsummary.RMS_EDGES)
+            if mode == 'profile':
+                axes.fill_between(centres, numpy.nan_to_num(lower),
+                                  numpy.nan_to_num(upper),
+                                  where=numpy.isfinite(median),
+                                  color='r', alpha=0.3, linewidth=0)
+            else:
+                mesh = axes.pcolormesh(edges, qcsummary.RMS_EDGES, counts.T,
+                                       norm=LogNorm(), cmap=cm.Reds)
+                self.figure.colorbar(mesh, ax=axes).set_label(
+                    'Number of sources')
+            axes.plot(centres, median, color='k', drawstyle='steps-mid')
+        axes.set_yscale('log')
+        axes.set_xlabel(r'Distance from Pointing Centre (deg)', size='x-large')
+        axes.set_ylabel(r'rms (mJy/beam)', size='x-large')
+        axes.set_xlim(xmin=0)
+        axes.grid(True)
 
 
 class HistSourcesPerImagePlot(Plot):
 
-    def plot(self, database, dsid):
-        def autolabel(axes, rects, taustart):
-            i = 0
-            for rect in rects:
-                height = rect.get_height()
-                print height
-                axes.text(rect.get_x()+rect.get_width()/2., 1.05*height, int(height),
-                         rotation='horizontal', ha='center', va='bottom')
-                axes.text(rect.get_x()+rect.get_width()/2., 0.05*height, taustart[i].isoformat(),
-                         rotation='vertical', ha='center', va='bottom')
-                i += 1
-
-        query = """\
-SELECT imageid
-      ,taustart_ts
-      ,nsources
-FROM images
-    ,(SELECT x1.image_id 
-            ,COUNT(*) as nsources
-      FROM extractedsources x1
-          ,images im1
-      WHERE x1.image_id = im1.imageid
-        AND ds_id = %s
-      GROUP BY x1.image_id
-     ) t1
-WHERE t1.image_id = imageid
-"""
-        results = zip(*database.db.get(query, dsid))
-        if not results:
+    version = 3
+
+    # Datasets with at most this number of images are plotted with a
+    # labelled bar per image
+    max_bars = 30
+
+    def plot(self, summary, binby='auto', maxbins=100, maxticks=10):
+        """Plot the number of sources per image
+
+        binby is 'image' for a bar per image; 'id' or 'time' to bin the
+        images by image id (order) or start time into at most maxbins
+        bins, showing the minimum, mean and maximum number of sources
+        per bin; or 'auto' for 'image' with at most max_bars images and
+        'time' otherwise. At most maxticks ticks are labelled.
+        """
+
+        imageid = summary.imageid
+        if not len(imageid):
             return None
-        imageid = results[0]
-        taustart_ts = results[1]
-        nsources = results[2]
+        nsources = summary.nsources
+        if binby == 'auto':
+            binby = 'image' if len(imageid) <= self.max_bars else 'time'
+        axes = self.figure.add_subplot(1, 1, 1)
+        if binby == 'image':
+            self.plot_images(axes, imageid, summary.taustart, nsources)
+        else:
+            if binby == 'time':
+                # Leave out images without a start time (NaT); bin by
+                # id if none has one
+                times = summary.taustart.astype(numpy.int64)
+                valid = times != NAT
+                if not valid.any():
+                    binby = 'id'
+            if binby == 'time':
+                x = times[valid].astype(numpy.float64)
+                imageid, nsources = imageid[valid], nsources[valid]
+            else:
+                x = numpy.arange(len(imageid), dtype=numpy.float64)
+            nbins = min(maxbins, len(imageid))
+            edges = numpy.linspace(x.min(), x.max(), nbins + 1)
+            bins = numpy.minimum(numpy.digitize(x, edges) - 1, nbins - 1)
+            order = numpy.argsort(bins, kind='mergesort')
+            bins, counts, x = bins[order], nsources[order], x[order]
+            starts = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]])
+            sizes = numpy.diff(numpy.r_[starts, len(bins)])
+            low = numpy.minimum.reduceat(counts, starts)
+            high = numpy.maximum.reduceat(counts, starts)
+            mean = numpy.add.reduceat(counts, starts) / sizes.astype(float)
+            centre = numpy.add.reduceat(x, starts) / sizes
+            if binby == 'time':
+                centre = date2num(centre.astype(numpy.int64).astype(
+                    'datetime64[us]').astype(object))
+                axes.xaxis_date()
+                locator = AutoDateLocator(maxticks=maxticks)
+                axes.xaxis.set_major_locator(locator)
+                axes.xaxis.set_major_formatter(AutoDateFormatter(locator))
+                self.figure.autofmt_xdate()
+                if not valid.all():
+                    axes.set_xlabel(
+                        r'Image start time (UTC; %d images without)' %
+                        (len(valid) - valid.sum()))
+                else:
+                    axes.set_xlabel(r'Image start time (UTC)')
+            else:
+                # Label the bins with image ids
+                ids = numpy.minimum.reduceat(imageid[order], starts)
+                ticks = numpy.unique(numpy.linspace(
+                    0, len(starts) - 1, min(maxticks, len(starts))).astype(int))
+                axes.set_xticks(centre[ticks])
+                axes.set_xticklabels(ids[ticks])
+                axes.set_xlabel(r'Image (first id in bin)')
+            axes.vlines(centre, low, high, color='r')
+            axes.plot(centre, mean, linestyle='none', marker='o',
+                      markersize=3, color='r')
+            axes.set_ylim(ymin=0)
+        axes.set_ylabel(r'Number of Sources')
+        axes.grid(True)
+
+    def plot_images(self, axes, imageid, taustart, nsources):
+        """A bar per image, labelled with the number of sources and the
+        start time"""
 
-        axes = self.figure.add_subplot(1, 1, 1)    
         width = 0.8
         ind = numpy.arange(len(imageid))
         rects = axes.bar(ind, nsources, width, color='r')
         axes.set_xlabel(r'Image')
-        axes.set_ylabel(r'Number of Sources')
         axes.set_xticks(ind + width/2.)
         axes.set_xticklabels(imageid)
-        autolabel(axes, rects, taustart_ts)
-        axes.grid(True)
-    
+        for rect, height, start in zip(rects, nsources, taustart.astype(object)):
+            axes.text(rect.get_x()+rect.get_width()/2., 1.05*height, int(height),
+                      rotation='horizontal', ha='center', va='bottom')
+            axes.text(rect.get_x()+rect.get_width()/2., 0.05*height,
+                      start.isoformat() if start is not None else '',
+                      rotation='vertical', ha='center', va='bottom')
+
 
 class ScatterPosAllCounterpartsPlot(Plot):
 
-    def plot(self, database, dsid):
+    version = 3
+
+    def plot(self, summary, mode='histogram', points=None, database=None,
+             dataset=None, last=None):
         """Plot positions of all counterparts for all (unique) sources for
         the given dataset.
     
@@ -122,52 +185,53 @@ class ScatterPosAllCounterpartsPlot(Plot):
         at the centre, whereas the positions of all their associated
         sources are scattered around the central point.  Axes are in
         arcsec relative to the running catalog position.
+
+        mode is one of:
+
+            'histogram': the 2D histogram of the QC summary
+
+            'scatter': the individual sources with their errors, given
+                as points (see qcengine.counterpart_offsets); if points
+                is None, they are obtained from database for the images
+                up to last of dataset, only when plotting
         """
-    
-        query = """\
-SELECT x.xtrsrcid
-      ,x.ra
-      ,x.decl
-      ,3600 * (x.ra - r.wm_ra) as ra_dist_arcsec
-      ,3600 * (x.decl - r.wm_decl) as decl_dist_arcsec
-      ,x.ra_err/2
-      ,x.decl_err/2 
-      ,r.wm_ra_err/2
-      ,r.wm_decl_err/2
-  FROM assocxtrsources a
-      ,extractedsources x 
-      ,runningcatalog r
-      ,images im1
- WHERE a.xtrsrc_id <> a.assoc_xtrsrc_id
-   AND a.xtrsrc_id = r.xtrsrc_id
-   AND a.assoc_xtrsrc_id = x.xtrsrcid
-   AND x.image_id = im1.imageid
-   AND im1.ds_id = %s
 
-"""
-        results = zip(*database.db.get(query, dsid))
-    
-        if not results:
+        stats = summary.offset_stats()
+        if stats is None:
             return None
-        xtrsrc_id = results[0]
-        ra = results[1]
-        decl = results[2]
-        ra_dist_arcsec = results[3]
-        decl_dist_arcsec = results[4]
-        ra_err = results[5]
-        decl_err = results[6]
-        wm_ra_err = results[7]
-        wm_decl_err = results[8]
-    
         axes = self.figure.add_subplot(1, 1, 1)
-        axes.errorbar(ra_dist_arcsec, decl_dist_arcsec, xerr=ra_err, yerr=decl_err,
-                      fmt='+',  color='b', label="xtr")
+        if mode == 'scatter':
+            if points is None:
+                points = qcengine.counterpart_offsets(database, dataset,
+                                                      last=last)
+            ra, dec, ra_err, dec_err = points
+            if not len(ra):
+                return None
+            axes.errorbar(ra, dec, xerr=ra_err, yerr=dec_err, fmt='+',
+                          color='b')
+            lim = 1 + int(numpy.trunc(max(numpy.abs(ra).max(),
+                                           numpy.abs(dec).max())))
+            label = ("N = %d\nRA: %.2f +/- %.2f\nDEC: %.2f +/- %.2f" % (
+                stats['n'], stats['ra_mean'], stats['ra_std'],
+                stats['dec_mean'], stats['dec_std']))
+        else:
+            counts = numpy.ma.masked_equal(summary.offsets, 0)
+            edges = qcsummary.OFFSET_EDGES
+            if counts.count():
+                mesh = axes.pcolormesh(edges, edges, counts.T,
+                                       norm=LogNorm(), cmap=cm.Blues)
+                self.figure.colorbar(mesh, ax=axes).set_label(
+                    'Number of sources')
+            lim = edges[-1]
+            label = ("N = %d (%d outside plot)\n"
+                     "RA: %.2f +/- %.2f\nDEC: %.2f +/- %.2f" % (
+                         stats['n'], stats['outside'], stats['ra_mean'],
+                         stats['ra_std'], stats['dec_mean'],
+                         stats['dec_std']))
+        axes.text(0.02, 0.98, label, transform=axes.transAxes,
+                  ha='left', va='top', size='small')
         axes.set_xlabel(r'RA (arcsec)')
         axes.set_ylabel(r'DEC (arcsec)')
-        lim = 1 + max(int(numpy.trunc(max(abs(min(ra_dist_arcsec)),
-                                          abs(max(ra_dist_arcsec))))),
-                      int(numpy.trunc(max(abs(min(decl_dist_arcsec)),
-                                          abs(max(decl_dist_arcsec))))))
         axes.set_xlim(xmin=-lim, xmax=lim)
         axes.set_ylim(ymin=-lim, ymax=lim)
         axes.grid(False)
@@ -0,0 +1,153 @@
+"""
+Per-request accounting of the queries sent to the TKP database
+
+A QueryLog is started for the current thread (normally by the
+QueryLogMiddleware, at the start of a request); all queries made
+through an instrumented tkp.database.database.DataBase are recorded in
+it, with their shape, number of rows and wall time. Queries slower than
+the DB_SLOW_QUERY_MS setting are logged to the tkpweb.sql logger.
+"""
+
+import re
+import time
+import logging
+import threading
+from collections import defaultdict
+from tkpweb import settings
+
+
+logger = logging.getLogger('tkpweb.sql')
+_local = threading.local()
+
+
+def shape(query):
+    """Reduce a query to its shape: collapsed white space, and literal
+    numbers and strings replaced by a question mark"""
+
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b", "?", query)
+    return " ".join(query.split())
+
+
+class QueryLog(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def add(self, query, args, rows, duration):
+        self.queries.append({'shape': shape(query), 'args': args,
+                             'rows': rows, 'time': duration})
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query['time'] for query in self.queries)
+
+    def duplicates(self):
+        """Queries executed more than once with the same arguments
+
+        Returns a list of (shape, args, number of executions), most
+        frequent first.
+        """
+
+        counts = defaultdict(int)
+        for query in self.queries:
+            counts[query['shape'], repr(query['args'])] += 1
+        return sorted([(key[0], key[1], n) for key, n in counts.iteritems()
+                       if n > 1], key=lambda item: -item[2])
+
+    def repeated(self, threshold=None):
+        """Query shapes executed at least threshold times (with any
+        arguments): likely N+1 patterns
+
+        Returns a list of (shape, number of executions, total time),
+        most frequent first.
+        """
+
+        if threshold is None:
+            threshold = getattr(settings, 'DB_QUERY_REPEAT_THRESHOLD', 5)
+        counts = defaultdict(lambda: [0, 0.])
+        for query in self.queries:
+            counts[query['shape']][0] += 1
+            counts[query['shape']][1] += query['time']
+        return sorted([(key, n, t) for key, (n, t) in counts.iteritems()
+                       if n >= threshold], key=lambda item: -item[1])
+
+
+def start():
+    """Start a new query log for the current thread"""
+
+    _local.log = QueryLog()
+    return _local.log
+
+
+def stop():
+    """Stop logging for the current thread; returns the QueryLog (or
+    None if logging wasn't started)"""
+
+    log = getattr(_local, 'log', None)
+    _local.log = None
+    return log
+
+
+def record(query, args, rows, duration):
+    log = getattr(_local, 'log', None)
+    if log is not None:
+        log.add(query, args, rows, duration)
+    threshold = getattr(settings, 'DB_SLOW_QUERY_MS', None)
+    if threshold is not None and duration * 1000 >= threshold:
+        logger.warning("slow query (%.1f ms, %s rows): %s %r",
+                       duration * 1000, rows, shape(query), args)
+
+
+class InstrumentedDataBase(object):
+    """Wrapper around a tkp.database.database.DataBase that records the
+    queries made through execute(), get() and getone()"""
+
+    def __init__(self, db):
+        self.__dict__['_db'] = db
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._db, name, value)
+
+    def execute(self, query, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._db.execute(query, *args, **kwargs)
+        finally:
+            try:
+                rows = self._db.cursor.rowcount
+            except Exception:
+                rows = None
+            record(query, args, rows, time.time() - start)
+
+    def get(self, query, *args, **kwargs):
+        start = time.time()
+        results = None
+        try:
+            results = self._db.get(query, *args, **kwargs)
+            return results
+        finally:
+            record(query, args, len(results) if results is not None else None,
+                   time.time() - start)
+
+    def getone(self, query, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._db.getone(query, *args, **kwargs)
+        finally:
+            record(query, args, 1, time.time() - start)
+
+
+def instrument(db):
+    """Wrap db in an InstrumentedDataBase, if not done already"""
+
+    if isinstance(db, InstrumentedDataBase):
+        return db
+    return InstrumentedDataBase(db)
@@ -0,0 +1,248 @@
+"""
+Out-of-process rendering of plots
+
+Plots are rendered by a bounded pool of worker processes, instead of
+inside the web server process that handles the request. Views submit a
+render job and get back a job handle right away; the rendered plot ends
+up in the plot cache, where the page picks it up once it's ready.
+Identical jobs (same plot cache key) are coalesced into a single job.
+
+The state of each job (pending or failed) is recorded in the plot
+cache directory, so that any web server process can report it, not
+only the process that submitted the job.
+"""
+
+import os
+import time
+import threading
+import importlib
+import multiprocessing
+from collections import OrderedDict
+from tkpweb import settings
+from . import plotcache
+
+
+class RenderQueueFull(Exception):
+    """Raised when too many render jobs are pending"""
+    pass
+
+
+class _DatabaseArgument(object):
+    """Placeholder for a plot argument that should be a database
+    connection, which can't be passed on to the worker processes"""
+
+    def __repr__(self):
+        return "DATABASE"
+
+
+# Pass this instead of a dbase.DataBase to render(); the worker process
+# replaces it by its own connection to the database
+DATABASE = _DatabaseArgument()
+
+
+def _render(module, name, size, key, format, dblogin, args, kwargs):
+    """Render a plot into the plot cache; runs in a worker process"""
+
+    from . import dbase
+    cls = getattr(importlib.import_module(module), name)
+    isdatabase = lambda arg: isinstance(arg, _DatabaseArgument)
+    database = None
+    if any(map(isdatabase, args)) or any(map(isdatabase, kwargs.values())):
+        database = dbase.DataBase(dblogin=dblogin)
+        args = [database if isdatabase(arg) else arg for arg in args]
+        kwargs = dict((k, database if isdatabase(v) else v)
+                      for k, v in kwargs.iteritems())
+    try:
+        plot = cls(size=size)
+        plot.render(*args, format=format, **kwargs)
+        plotcache.store(key, plot.data)
+    except Exception:
+        plotcache.set_state(key, 'failed')
+        raise
+    else:
+        plotcache.set_state(key, None)
+    finally:
+        if database is not None:
+            database.db.close()
+    return key
+
+
+class RenderService(object):
+    """Render plots in a pool of worker processes
+
+    Kwargs:
+
+        processes (int): number of worker processes. With 0, plots are
+            rendered in the calling process, as before.
+
+        maxqueue (int): maximum number of pending jobs; further jobs
+            raise RenderQueueFull
+
+        timeout (float): jobs not finished after this number of seconds
+            are reported as failed. A worker can't be stopped halfway a
+            job, so timed out jobs still count against maxqueue until
+            they end; once every worker is busy with a timed out job,
+            the pool is terminated and replaced.
+
+        maxtasksperchild (int): number of jobs after which a worker
+            process is replaced, to limit its memory use
+    """
+
+    def __init__(self, processes=2, maxqueue=50, timeout=120,
+                 maxtasksperchild=20):
+        self.processes = processes
+        self.maxqueue = maxqueue
+        self.timeout = timeout
+        self.maxtasksperchild = maxtasksperchild
+        self.lock = threading.Lock()
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        """Forget the worker pool and all jobs (after a fork)"""
+
+        self.pid = os.getpid()
+        self.pool = None
+        self.jobs = OrderedDict()   # key: (async result, submission time)
+        self.hung = {}               # timed out jobs, key: async result
+        self.failed = OrderedDict()  # recently failed keys
+        self.counters = {'submitted': 0, 'coalesced': 0, 'cached': 0,
+                         'completed': 0, 'failed': 0, 'timeouts': 0,
+                         'rejected': 0, 'recycled': 0}
+
+    def get_pool(self):
+        # Should be called with the lock held
+        if self.pid != os.getpid():
+            self.reset()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.processes, maxtasksperchild=self.maxtasksperchild)
+        return self.pool
+
+    def reap(self):
+        """Move finished and timed out jobs out of the queue, and
+        replace the pool if all its workers are stuck"""
+
+        # Should be called with the lock held
+        now = time.time()
+        for key, (result, start) in self.jobs.items():
+            if result.ready():
+                del self.jobs[key]
+                if result.successful():
+                    self.counters['completed'] += 1
+                else:
+                    self.fail(key)
+            elif now - start > self.timeout:
+                del self.jobs[key]
+                self.hung[key] = result
+                self.counters['timeouts'] += 1
+                self.fail(key)
+        for key, result in self.hung.items():
+            if result.ready():
+                del self.hung[key]
+        if self.pool is not None and len(self.hung) >= self.processes:
+            # No worker is left for the queued jobs
+            self.pool.terminate()
+            self.pool = None
+            for key in self.jobs:
+                self.fail(key)
+            self.jobs.clear()
+            self.hung.clear()
+            self.counters['recycled'] += 1
+
+    def fail(self, key):
+        # Should be called with the lock held
+        self.counters['failed'] += 1
+        self.failed[key] = True
+        while len(self.failed) > 1000:
+            self.failed.popitem(last=False)
+        plotcache.set_state(key, 'failed')
+
+    def submit(self, plot, identity, *args, **kwargs):
+        """Submit a render job for plot, and return its plot cache key
+
+        identity, args and kwargs are as for Plot.cached(); args and
+        kwargs should be picklable, with DATABASE in place of a database
+        connection (opened in the worker from the dblogin keyword
+        argument). The job is skipped if the plot is already cached, or
+        coalesced with a pending job for the same plot.
+
+        Returns the key and whether the plot is ready.
+        """
+
+        format = kwargs.get('format', 'png')
+        dblogin = kwargs.pop('dblogin', None)
+        key = plotcache.key(plot, identity, format)
+        if plotcache.exists(key):
+            with self.lock:
+                self.counters['cached'] += 1
+            return key, True
+        if not self.processes:
+            kwargs.pop('format', None)
+            _render(plot.__class__.__module__, plot.__class__.__name__,
+                    plot.size, key, format, dblogin, args, kwargs)
+            return key, True
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            self.reap()
+            pool = self.get_pool()
+            if key in self.jobs:
+                self.counters['coalesced'] += 1
+                return key, False
+            if len(self.jobs) + len(self.hung) >= self.maxqueue:
+                self.counters['rejected'] += 1
+                raise RenderQueueFull()
+            kwargs.pop('format', None)
+            self.failed.pop(key, None)
+            plotcache.set_state(key, 'pending')
+            result = pool.apply_async(_render, (
+                plot.__class__.__module__, plot.__class__.__name__,
+                plot.size, key, format, dblogin, args, kwargs))
+            self.jobs[key] = (result, time.time())
+            self.counters['submitted'] += 1
+        return key, False
+
+    def status(self, key):
+        """Return the status of the plot for key: 'done', 'pending',
+        'failed', or 'unknown' for keys never submitted
+
+        Jobs submitted by other processes are reported from their
+        recorded state; pending jobs older than the timeout count as
+        failed.
+        """
+
+        if plotcache.exists(key):
+            return 'done'
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            self.reap()
+            if key in self.jobs:
+                return 'pending'
+            if key in self.failed:
+                return 'failed'
+        state, age = plotcache.get_state(key)
+        if state == 'pending' and age > self.timeout:
+            return 'failed'
+        return state or 'unknown'
+
+    def stats(self):
+        """Return the job counters and the queue depth"""
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            self.reap()
+            stats = dict(self.counters)
+            stats['queued'] = len(self.jobs)
+            stats['hung'] = len(self.hung)
+            stats['maxqueue'] = self.maxqueue
+            stats['processes'] = self.processes
+            stats['oldest'] = (time.time() - self.jobs.values()[0][1]
+                               if self.jobs else None)
+            stats['pid'] = self.pid
+        return stats
+
+
+service = RenderService(**getattr(settings, 'RENDER_SERVICE', {}))
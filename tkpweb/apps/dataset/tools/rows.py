@@ -0,0 +1,146 @@
+"""
+Compact row objects for database query results
+
+A row wraps the value tuple returned by the database cursor. The
+mapping from column name to tuple index is built only once per query,
+in a row class shared by all rows of that query. Rows behave like
+(read-mostly) dicts, so they can be used in templates as before.
+
+Aliases (nicer names for some of the columns) resolve to the same
+tuple item, instead of storing a copy of the value. Values assigned
+after creation (extra information, or changed values) are kept in a
+small per-row dict.
+"""
+
+
+_classes = {}
+
+
+def _rebuild(columns, aliases, values, extra):
+    row = row_class(columns, aliases)(values)
+    row._extra = extra
+    return row
+
+
+class Row(object):
+    __slots__ = ('_values', '_extra')
+    _columns = ()
+    _aliases = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return self._values[self._index[key]]
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+        # Keep a column and its aliases in sync
+        if key in self._index:
+            index = self._index[key]
+            for name, i in self._index.iteritems():
+                if i == index:
+                    self._extra[name] = value
+
+    def __contains__(self, key):
+        return key in self._index or (
+            self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, dict(self.items()))
+
+    def __reduce__(self):
+        return _rebuild, (self._columns, self._aliases, self._values,
+                          self._extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = list(self._index)
+        if self._extra is not None:
+            keys.extend(key for key in self._extra if key not in self._index)
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+def _property(key):
+    return property(lambda self: self[key])
+
+
+def row_class(columns, aliases=()):
+    """Obtain the row class for a query result
+
+    Args:
+
+        columns (sequence of strings): the column names, in the order of
+            the row values
+
+    Kwargs:
+
+        aliases (sequence of (string, string) pairs): (column name,
+            alias) pairs. The alias resolves to the value of the column
+            with the given name.
+
+    Classes are cached, so subsequent queries with the same columns
+    share the same class.
+    """
+
+    columns, aliases = tuple(columns), tuple(aliases)
+    try:
+        return _classes[columns, aliases]
+    except KeyError:
+        pass
+    # For duplicate column names, the last one wins, as it would in a
+    # dict built from the row
+    index = dict((name, i) for i, name in enumerate(columns))
+    for column, alias in aliases:
+        index[alias] = index[column]
+    attributes = {'__slots__': (), '_columns': columns,
+                  '_aliases': aliases, '_index': index}
+    for name in index:
+        if not hasattr(Row, name) and not name.startswith('_'):
+            attributes[name] = _property(name)
+    cls = type('Row', (Row,), attributes)
+    _classes[columns, aliases] = cls
+    return cls
+
+
+def rows(cursor, aliases=(), chunksize=None):
+    """Iterate over the remaining rows of cursor as Row objects
+
+    If chunksize is given, rows are fetched in chunks of that size
+    instead of all at once.
+    """
+
+    cls = row_class([d[0] for d in cursor.description], aliases)
+    while True:
+        results = (cursor.fetchmany(chunksize) if chunksize
+                   else cursor.fetchall())
+        for values in results:
+            yield cls(values)
+        if not chunksize or not results:
+            break
@@ -0,0 +1,269 @@
+"""
+Multi-resolution tile pyramid for large FITS images
+
+The pyramid is built once per image file: the full resolution image is
+downsampled by factors of two until it fits in a single tile, and the
+display scaling (the grayscale limits) is determined once. Tiles are
+rendered on request and kept on disk.
+
+Levels are numbered from 0 (the whole image in a single tile) to
+nlevels - 1 (full resolution). Tiles are numbered (x, y) from the top
+left corner of the image, with north up.
+"""
+
+import os
+import json
+import errno
+import shutil
+import tempfile
+import StringIO
+import numpy
+import pyfits
+import pywcs
+import matplotlib.image
+from tkpweb import settings
+from . import plotcache
+
+
+TILE_SIZE = 256
+
+# Number of full-resolution rows read at once when building the pyramid
+CHUNK_ROWS = 1024
+
+# Percentiles for the grayscale limits (as aplpy.show_grayscale)
+PMIN, PMAX = 0.25, 99.75
+
+# Maximum number of pixels used to determine the grayscale limits
+SCALE_SAMPLES = 1000000
+
+# Increase when a change alters the pyramid or its tiles
+VERSION = 1
+
+
+class TileError(Exception):
+    """Raised for images that can't be tiled, or invalid tiles"""
+    pass
+
+
+def tile_dir():
+    return getattr(settings, 'TILE_CACHE_DIR',
+                   os.path.join(settings.BASE_DIR, 'cache', 'tiles'))
+
+
+def _image_data(hdulist):
+    data = hdulist[0].data
+    if data is None:
+        raise TileError("no image data")
+    # Reduce any degenerate frequency/Stokes axes
+    while data.ndim > 2:
+        data = data[0]
+    return data
+
+
+def _downsample(data, out, chunk_rows=CHUNK_ROWS):
+    """Downsample data by a factor 2 into out, as the mean of each 2x2
+    block of finite pixels; the data is read chunk_rows rows at a time"""
+
+    height, width = data.shape
+    for start in range(0, height, chunk_rows):
+        block = numpy.array(data[start:start+chunk_rows], dtype=numpy.float64)
+        rows, cols = block.shape
+        if rows % 2 or cols % 2:
+            padded = numpy.empty((rows + rows % 2, cols + cols % 2))
+            padded.fill(numpy.nan)
+            padded[:rows, :cols] = block
+            block = padded
+        finite = numpy.isfinite(block)
+        block[~finite] = 0
+        shape = (block.shape[0] // 2, 2, block.shape[1] // 2, 2)
+        total = block.reshape(shape).sum(axis=3).sum(axis=1)
+        count = finite.reshape(shape).sum(axis=3).sum(axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            out[start//2:start//2 + total.shape[0]] = total / count
+
+
+def _scaling(data):
+    """Grayscale limits from a regular subsample of the data"""
+
+    step = max(1, int(numpy.sqrt(data.size / float(SCALE_SAMPLES))))
+    sample = numpy.asarray(data[::step, ::step], dtype=numpy.float64)
+    sample = sample[numpy.isfinite(sample)]
+    if not sample.size:
+        return 0., 1.
+    vmin, vmax = numpy.percentile(sample, [PMIN, PMAX])
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return float(vmin), float(vmax)
+
+
+class Pyramid(object):
+    """Tile pyramid for a FITS image file
+
+    The pyramid is stored in its own directory in the TILE_CACHE_DIR,
+    named after the file name, modification time and size of the image,
+    so a changed image gets a new pyramid.
+    """
+
+    def __init__(self, filename):
+        if not filename or not filename.lower().endswith(".fits"):
+            raise TileError("only FITS images can be tiled")
+        if not os.path.exists(filename):
+            raise TileError("image file does not exist")
+        self.filename = filename
+        self.path = os.path.join(tile_dir(), plotcache.digest(
+            VERSION, TILE_SIZE, plotcache.file_identity(filename)))
+        self._meta = None
+
+    @property
+    def meta(self):
+        """Pyramid properties: image width and height, number of levels,
+        tile size and grayscale limits. Builds the pyramid if needed."""
+
+        if self._meta is None:
+            try:
+                with open(os.path.join(self.path, "meta.json")) as infile:
+                    self._meta = json.load(infile)
+            except IOError:
+                self.build()
+                with open(os.path.join(self.path, "meta.json")) as infile:
+                    self._meta = json.load(infile)
+        return self._meta
+
+    def build(self):
+        """Build the downsampled levels and the display scaling
+
+        The pyramid is built in a temporary directory, which is moved
+        into place when complete, so concurrent requests never see a
+        partial pyramid.
+        """
+
+        parent = tile_dir()
+        try:
+            os.makedirs(parent)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        tmppath = tempfile.mkdtemp(dir=parent, suffix=".tmp")
+        try:
+            hdulist = pyfits.open(self.filename, memmap=True)
+            try:
+                data = _image_data(hdulist)
+                height, width = data.shape
+                vmin, vmax = _scaling(data)
+                # Downsample until the image fits in a single tile;
+                # the full resolution level is read from the image itself
+                nlevels = 1
+                level = data
+                while max(level.shape) > TILE_SIZE:
+                    shape = ((level.shape[0] + 1) // 2,
+                             (level.shape[1] + 1) // 2)
+                    filename = os.path.join(tmppath, "level%d.npy" % nlevels)
+                    out = numpy.lib.format.open_memmap(
+                        filename, mode='w+', dtype=numpy.float32, shape=shape)
+                    _downsample(level, out)
+                    out.flush()
+                    level = out
+                    nlevels += 1
+            finally:
+                hdulist.close()
+            # The level files were numbered from fine to coarse; number
+            # them from coarse (0) to fine
+            for i in range(1, nlevels):
+                os.rename(os.path.join(tmppath, "level%d.npy" % i),
+                          os.path.join(tmppath, "z%d.npy" % (nlevels - 1 - i)))
+            with open(os.path.join(tmppath, "meta.json"), 'w') as outfile:
+                json.dump({'width': width, 'height': height,
+                           'levels': nlevels, 'tilesize': TILE_SIZE,
+                           'vmin': vmin, 'vmax': vmax}, outfile)
+            try:
+                os.rename(tmppath, self.path)
+            except OSError:
+                # Built concurrently by another request
+                shutil.rmtree(tmppath, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmppath, ignore_errors=True)
+            raise
+
+    def tile(self, z, x, y):
+        """Return the PNG data of tile (x, y) at level z"""
+
+        meta = self.meta
+        if not 0 <= z < meta['levels']:
+            raise TileError("invalid level")
+        filename = os.path.join(self.path, str(z), "%d_%d.png" % (x, y))
+        try:
+            with open(filename, 'rb') as infile:
+                return infile.read()
+        except IOError:
+            pass
+        hdulist = None
+        if z == meta['levels'] - 1:
+            hdulist = pyfits.open(self.filename, memmap=True)
+            level = _image_data(hdulist)
+        else:
+            level = numpy.load(os.path.join(self.path, "z%d.npy" % z),
+                               mmap_mode='r')
+        try:
+            # Flip vertically, so that tile rows run from the top (north)
+            level = level[::-1]
+            size = meta['tilesize']
+            if not (0 <= y * size < level.shape[0] and
+                    0 <= x * size < level.shape[1]):
+                raise TileError("invalid tile")
+            region = numpy.array(
+                level[y*size:(y+1)*size, x*size:(x+1)*size],
+                dtype=numpy.float64)
+        finally:
+            if hdulist is not None:
+                hdulist.close()
+        finite = numpy.isfinite(region)
+        scaled = numpy.clip(
+            (numpy.where(finite, region, meta['vmin']) - meta['vmin']) /
+            (meta['vmax'] - meta['vmin']), 0, 1)
+        rgba = numpy.empty(region.shape + (4,), dtype=numpy.float32)
+        rgba[..., 0] = rgba[..., 1] = rgba[..., 2] = scaled
+        rgba[..., 3] = finite
+        output = StringIO.StringIO()
+        matplotlib.image.imsave(output, rgba, format='png')
+        data = output.getvalue()
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                       suffix=".tmp")
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.rename(tmpname, filename)
+        return data
+
+    def overlay(self, sources):
+        """Source ellipses in full-resolution pixel coordinates
+
+        Returns a list of [x, y, width, height, angle] lists: the centre
+        (from the top left corner of the image), full axes (in pixels)
+        and position angle (in degrees, counter-clockwise from the x
+        axis), for the ra, decl, semimajor, semiminor and pa of each
+        source, plotted as ImagePlot does.
+        """
+
+        if not sources:
+            return []
+        header = pyfits.getheader(self.filename)
+        wcs = pywcs.WCS(header, naxis=2)
+        ra = numpy.array([source['ra'] for source in sources])
+        dec = numpy.array([source['decl'] for source in sources])
+        x, y = wcs.wcs_sky2pix(ra, dec, 0)
+        # Local pixel scale (pixels per degree) at each source, from the
+        # offset of a point 1 arcsec towards the equator; this works
+        # for CDELT as well as CD matrix headers
+        delta = numpy.where(dec > 0, -1., 1.) / 3600.
+        xn, yn = wcs.wcs_sky2pix(ra, dec + delta, 0)
+        scale = numpy.hypot(xn - x, yn - y) / numpy.abs(delta)
+        y = self.meta['height'] - 1 - y
+        return [[float(xx), float(yy),
+                 source['semimajor'] / 900. * ss,
+                 source['semiminor'] / 900. * ss,
+                 source['pa'] + 90]
+                for xx, yy, ss, source in zip(x, y, scale, sources)]
@@ -4,31 +4,57 @@ from .views import DatasetView
 from .views import ImagesView
 from .views import ImageView
 from .views import ImagePlotView
+from .views import ImageTilesView
+from .views import ImageTileMetaView
+from .views import ImageTileView
+from .views import ImageOverlayView
 from .views import ExtractedSourcesView
 from .views import ExtractedSourceView
 from .views import SourceLightcurveView
+from .views import SourceLightcurveDataView
+from .views import LightcurvesDataView
 from .views import SourcesView
 from .views import SourceView
 from .views import TransientLightcurveView
+from .views import TransientLightcurveDataView
 from .views import TransientsView
 from .views import TransientView
 from .views import MonitoringListView
+from .views import ExportView
+from .views import ConeSearchView
+from .views import PoolStatsView
+from .views import PlotView
+from .views import RenderStatusView
+from .views import RenderStatsView
 
 
 urlpatterns = patterns(
    'tkpweb.apps.dataset.views',
    url(r'^(?P<dataset>\d+)/monitoringlist/$', view=MonitoringListView.as_view(), name='monitoringlist'),
    url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/image$', view=ImagePlotView.as_view(), name='image-single'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/tiles/$', view=ImageTilesView.as_view(), name='image-tiles'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/tiles/meta\.json$', view=ImageTileMetaView.as_view(), name='image-tiles-meta'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$', view=ImageTileView.as_view(), name='image-tile'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/sources\.json$', view=ImageOverlayView.as_view(), name='image-overlay'),
    url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/$', view=ImageView.as_view(), name='image'),
    url(r'^(?P<dataset>\d+)/image/$', view=ImagesView.as_view(), name='images'),
    url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/lightcurve/$', view=TransientLightcurveView.as_view(), name='transient-lightcurve'),
+   url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/lightcurve\.(?P<format>json|bin)$', view=TransientLightcurveDataView.as_view(), name='transient-lightcurve-data'),
    url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/$', view=TransientView.as_view(), name='transient'),
    url(r'^(?P<dataset>\d+)/transient/$', view=TransientsView.as_view(), name='transients'),
    url(r'^(?P<dataset>\d+)/source/(?P<id>\d+)/lightcurve/$', view=SourceLightcurveView.as_view(), name='source-lightcurve'),
+   url(r'^(?P<dataset>\d+)/source/(?P<id>\d+)/lightcurve\.(?P<format>json|bin)$', view=SourceLightcurveDataView.as_view(), name='source-lightcurve-data'),
    url(r'^(?P<dataset>\d+)/source/(?P<id>\d+)/$', view=SourceView.as_view(), name='source'),
    url(r'^(?P<dataset>\d+)/source/$', view=SourcesView.as_view(), name='sources'),
    url(r'^(?P<dataset>\d+)/extractedsource/(?P<id>\d+)/$', view=ExtractedSourceView.as_view(), name='extractedsource'),
    url(r'^(?P<dataset>\d+)/extractedsource/$', view=ExtractedSourcesView.as_view(), name='extractedsources'),
+   url(r'^(?P<dataset>\d+)/lightcurves\.(?P<format>json|bin)$', view=LightcurvesDataView.as_view(), name='lightcurves-data'),
+   url(r'^(?P<dataset>\d+)/(?P<table>source|extractedsource|transient|image)/export\.(?P<format>csv|fits|npy)$', view=ExportView.as_view(), name='export'),
+   url(r'^(?P<dataset>\d+)/conesearch/$', view=ConeSearchView.as_view(), name='conesearch'),
    url(r'^(?P<id>\d+)/$', view=DatasetView.as_view(), name='dataset'),
+   url(r'^plot/(?P<key>[0-9a-f]{40})\.(?P<format>png|svg|pdf)$', view=PlotView.as_view(), name='plot'),
+   url(r'^render/(?P<key>[0-9a-f]{40})\.(?P<format>png|svg|pdf)$', view=RenderStatusView.as_view(), name='render-status'),
+   url(r'^render/$', view=RenderStatsView.as_view(), name='render-stats'),
+   url(r'^pool/$', view=PoolStatsView.as_view(), name='pool-stats'),
    url(r'^$', view=DatasetsView.as_view(), name='datasets'),
    )
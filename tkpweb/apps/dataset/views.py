@@ -4,13 +4,26 @@ from django.views.generic.edit import FormMixin
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseForbidden
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
 from .tools import dbase
 from .tools import plot
 from .tools import quality
+from .tools import qcsummary
+from .tools import pool as dbpool
+from .tools import plotcache
+from .tools import cutout
+from .tools import tiles
+from .tools import render
+from .tools import export
+from .tools import conesearch
 from .forms import MonitoringListForm
+from .forms import MonitoringListUploadForm
+from .forms import ConeSearchForm
+from tkpweb import settings
 from tkp.database.database import DataBase
 import tkp.database.dataset as dbset
 import tkp.database.utils as tkpdbutils
@@ -19,20 +32,207 @@ from tkp.classification.transient import Position
 from scipy.stats import chisqprob
 import numpy
 import datetime
+import time
+import json
+from collections import OrderedDict
+
+
+def sources_digest(sources):
+    """Identify a set of (extracted) sources for the plot cache"""
+
+    return plotcache.digest([
+        (source['id'], source['ra'], source['decl'], source['semimajor'],
+         source['semiminor'], source['pa']) for source in sources])
+
+
+def json_list(array):
+    """array.tolist(), with None for the non-finite values (NULLs),
+    which JSON can't represent"""
+
+    values = array.tolist()
+    if array.dtype.kind == 'f':
+        finite = numpy.isfinite(array)
+        if not finite.all():
+            values = [value if ok else None
+                      for value, ok in zip(values, finite.tolist())]
+    return values
+
+
+class StreamingContent(object):
+    """Iterable response content over chunks, that calls release once
+    it is closed
+
+    The WSGI server closes the response (and with it the content) when
+    done, whether or not the content was iterated over. Content that
+    is never closed (a response discarded by a middleware, or whose
+    content is replaced, as for HEAD requests) is released when it is
+    garbage collected.
+    """
+
+    def __init__(self, chunks, release):
+        self.chunks = iter(chunks)
+        self.release = release
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        release, self.release = self.release, None
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            if release is not None:
+                release()
+
+    def __del__(self):
+        self.close()
 
 
 class BaseView(TemplateView):
 
+    def dispatch(self, request, *args, **kwargs):
+        self.streaming = False
+        try:
+            return super(BaseView, self).dispatch(request, *args, **kwargs)
+        finally:
+            if not self.streaming:
+                self.release_database()
+
     def get_context_data(self, **kwargs):
         context = super(BaseView, self).get_context_data(**kwargs)
         self.database = self.get_database(self.request.session.get('dblogin', None))
         return context
 
     def get_database(self, dblogin=None):
+        """Obtain a database connection from the pool
+
+        The connection is kept for the rest of the request, and given
+        back to the pool at the end of it.
+        """
+
         try:
             return self.database
         except AttributeError:
-            return dbase.DataBase(dblogin=dblogin)
+            self.database = dbase.DataBase(
+                dblogin=dblogin, db=dbpool.pool.acquire(dblogin))
+            return self.database
+
+    def release_database(self):
+        try:
+            database = self.database
+        except AttributeError:
+            return
+        del self.database
+        dbpool.pool.release(database.dblogin, database.db)
+
+    def dataset_etag(self, dataset, *parts):
+        """Return an ETag for a response that only changes when dataset
+        is (re)processed, identified further by parts; None for
+        datasets that are still being processed"""
+
+        version = self.database.dataset_version(dataset)
+        if version is None:
+            return None
+        return '"%s"' % plotcache.digest(
+            self.__class__.__name__, self.database.login_key(), dataset,
+            version, parts)
+
+    def not_modified(self, etag):
+        """Return a 304 response if the client has the version given by
+        etag, or None"""
+
+        if etag is None or self.request.META.get('HTTP_IF_NONE_MATCH') != etag:
+            return None
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    def set_cache_headers(self, response, etag, max_age=3600):
+        """Let clients reuse the response for max_age seconds, and
+        revalidate it by etag; no caching without etag"""
+
+        if etag is None:
+            patch_cache_control(response, no_cache=True)
+        else:
+            response['ETag'] = etag
+            patch_cache_control(response, private=True, max_age=max_age)
+        return response
+
+    def stream(self, chunks):
+        """Return streaming response content for chunks, that keeps the
+        database connection until the server closes the response (see
+        StreamingContent)"""
+
+        self.streaming = True
+        return StreamingContent(chunks, self.release_database)
+
+    def get_page(self, fetch, keys=('id',), **kwargs):
+        """Obtain a single page of rows through fetch
+
+        fetch should accept after and limit keyword arguments, and
+        return a list of rows ordered by keys, which together identify
+        a row. The page starts after the row given by the 'after' GET
+        parameter (the comma separated key values), and has a size
+        given by the 'pagesize' GET parameter (or the DATASET_PAGE_SIZE
+        setting). For more than one key, after is passed to fetch as a
+        tuple.
+
+        Returns the rows and a dict with the page information for the
+        templates.
+        """
+
+        maxsize = getattr(settings, 'DATASET_MAX_PAGE_SIZE', 1000)
+        try:
+            size = int(self.request.GET['pagesize'])
+        except (KeyError, ValueError):
+            size = getattr(settings, 'DATASET_PAGE_SIZE', 100)
+        size = max(1, min(size, maxsize))
+        try:
+            after = tuple(int(value) for value in
+                          self.request.GET['after'].split(','))
+        except (KeyError, ValueError):
+            after = None
+        if after is not None and len(after) != len(keys):
+            after = None
+        elif after is not None and len(keys) == 1:
+            after = after[0]
+        # Fetch one row extra to find out if there is a next page
+        rows = fetch(after=after, limit=size+1, **kwargs)
+        page = {'size': size, 'first': after is None,
+                'has_next': len(rows) > size}
+        rows = rows[:size]
+        if page['has_next']:
+            page['next'] = ",".join(str(rows[-1][key]) for key in keys)
+        return rows, page
+
+    def render_plot(self, plot, identity, *args, **kwargs):
+        """Render a plot through the render service
+
+        Arguments are as for Plot.cached(), with render.DATABASE in
+        place of the database. When the render queue is full, the plot
+        is rendered in this process instead.
+
+        Returns a dict with the plot URL, whether it's ready, and the
+        URL to poll for its status.
+        """
+
+        format = kwargs.get('format', 'png')
+        try:
+            key, ready = render.service.submit(
+                plot, identity, dblogin=self.database.dblogin,
+                *args, **kwargs)
+        except render.RenderQueueFull:
+            args = [self.database if arg is render.DATABASE else arg
+                    for arg in args]
+            kwargs = dict(
+                (name, self.database if value is render.DATABASE else value)
+                for name, value in kwargs.iteritems())
+            plot.cached(identity, *args, **kwargs)
+            key, ready = plotcache.key(plot, identity, format), True
+        return {'url': plotcache.url(key, format), 'ready': ready,
+                'status': reverse('dataset:render-status',
+                                  kwargs={'key': key, 'format': format})}
 
 
 class DatasetsView(BaseView):
@@ -61,12 +261,35 @@ class DatasetView(BaseView):
         else:
             dataset = dataset[0]
         context['dataset'] = dataset
-        context['rmsplot'] = quality.plot_rms_distance_from_fieldcentre(
-            self.database, dsid)
-        context['histimageplot'] = quality.HistSourcesPerImagePlot().render(
-            self.database, dsid)
-        context['scattallplot'] = quality.ScatterPosAllCounterpartsPlot().render(
-            self.database, dsid)
+        summary = qcsummary.get(self.database, dsid)
+        if len(summary.imageid):
+            identity = (dsid, summary.digest())
+            last = int(summary.imageid[-1])
+            modes = ('histogram', 'profile', 'scatter')
+            mode = self.request.GET.get('rms', modes[0])
+            if mode not in modes:
+                mode = modes[0]
+            # The scatter plots read all sources (or associations) of
+            # the dataset; this is only done when the plot isn't cached
+            # yet
+            context['rmsplot'] = self.render_plot(
+                quality.RmsDistancePlot(), identity + (mode,), summary,
+                mode=mode, database=render.DATABASE, dataset=dsid,
+                last=last)
+            context['rmsmode'] = mode
+            context['rmsmodes'] = modes
+            context['histimageplot'] = self.render_plot(
+                quality.HistSourcesPerImagePlot(), identity, summary)
+            modes = ('histogram', 'scatter')
+            mode = self.request.GET.get('offsets', modes[0])
+            if mode not in modes:
+                mode = modes[0]
+            context['scattallplot'] = self.render_plot(
+                quality.ScatterPosAllCounterpartsPlot(), identity + (mode,),
+                summary, mode=mode, database=render.DATABASE, dataset=dsid,
+                last=last)
+            context['offsetmode'] = mode
+            context['offsetmodes'] = modes
 
         return context
 
@@ -91,12 +314,13 @@ class ImageView(BaseView):
             raise Http404
         else:
             image = image[0]
-        image['png'] = plot.ImagePlot().render(image, database=self.database)
+        identity = plotcache.file_identity(image['url'])
+        image['png'] = self.render_plot(plot.ImagePlot(), identity, image)
         dataset = self.database.dataset(id=kwargs['dataset'])[0]
         extractedsources = self.database.extractedsource(image=image['id'])
-
-
-        image['extractedsources'] = plot.ImagePlot().render(image, plotsources=extractedsources)
+        image['extractedsources'] = self.render_plot(
+            plot.ImagePlot(), (identity, sources_digest(extractedsources)),
+            image, plotsources=extractedsources)
         context['image'] = image
         context['extractedsources'] = extractedsources
         context['dataset'] = dataset
@@ -132,26 +356,58 @@ class TransientView(BaseView):
         trigger_index = [i for i, lc in enumerate(lightcurve)
                          if lc[4] == transient['trigger_xtrsrc_id']][0]
         context['lightcurve'] = {
-            'plot': plot.LightcurvePlot().render(
-                lightcurve, images=images, trigger_index=trigger_index),
+            'plot': self.render_plot(
+                plot.LightcurvePlot(),
+                plotcache.digest(lightcurve, images, trigger_index, True),
+                lightcurve, images=images, trigger_index=trigger_index,
+                decimate=True),
             'data': lightcurve
             }
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         context['transient'] = transient
-        context['lightcurve']['thumbnails'] = []
-        for point in context['lightcurve']['data']:
-            ra, dec, filename = self.database.thumbnail(point[4])
-            context['lightcurve']['thumbnails'].append(
-                plot.ThumbnailPlot(size=(4, 4)).render(filename, (ra, dec)))
+        context['lightcurve']['thumbnails'] = self.get_thumbnails(
+            [point[4] for point in lightcurve])
         return context
 
+    def get_thumbnails(self, srcids, boxsize=(40, 40)):
+        """Obtain the thumbnails for the lightcurve points
+
+        All thumbnails are cut out in one go, and combined into a single
+        (cached) sprite sheet. Returns a list with, for each thumbnail,
+        the CSS style to show it from the sprite sheet.
+        """
+
+        if not srcids:
+            return []
+        positions = self.database.thumbnails(srcids)
+        key = plotcache.digest(
+            'thumbnails', cutout.VERSION, boxsize,
+            [(ra, dec, plotcache.file_identity(filename))
+             for ra, dec, filename in positions])
+        if not plotcache.exists(key):
+            plotcache.store(key, cutout.sprite(
+                cutout.cutouts(positions, boxsize=boxsize)))
+        ncols, nrows = cutout.sprite_layout(len(srcids))
+        url = plotcache.url(key, 'png')
+        thumbnails = []
+        for i in range(len(srcids)):
+            row, col = divmod(i, ncols)
+            thumbnails.append(
+                "background-image: url(%s); background-size: %d%% %d%%; "
+                "background-position: %.4f%% %.4f%%;" % (
+                    url, ncols * 100, nrows * 100,
+                    100. * col / (ncols - 1) if ncols > 1 else 0,
+                    100. * row / (nrows - 1) if nrows > 1 else 0))
+        return thumbnails
+
 
 class SourcesView(BaseView):
     template_name = "dataset/sources.html"
 
     def get_context_data(self, **kwargs):
         context = super(SourcesView, self).get_context_data(**kwargs)
-        context['sources'] = self.database.source(dataset=kwargs['dataset'])
+        context['sources'], context['page'] = self.get_page(
+            self.database.source, dataset=kwargs['dataset'])
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         return context
 
@@ -169,7 +425,10 @@ class SourceView(BaseView):
         images = self.database.image_times(dataset=kwargs['dataset'])
         lightcurve = self.database.lightcurve(int(source['xtrsrc_id']))
         context['lightcurve'] = {
-            'plot': plot.LightcurvePlot().render(lightcurve, images=images),
+            'plot': self.render_plot(
+                plot.LightcurvePlot(),
+                plotcache.digest(lightcurve, images, True),
+                lightcurve, images=images, decimate=True),
             'data': lightcurve
             }
         context['source'] = source
@@ -182,7 +441,9 @@ class ExtractedSourcesView(BaseView):
 
     def get_context_data(self, **kwargs):
         context = super(ExtractedSourcesView, self).get_context_data(**kwargs)
-        context['extractedsources'] = self.database.extractedsource(dataset=kwargs['dataset'])
+        context['extractedsources'], context['page'] = self.get_page(
+            self.database.extractedsource, keys=('id', 'assoc_id'),
+            dataset=kwargs['dataset'])
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         return context
 
@@ -225,7 +486,8 @@ class MonitoringListView(BaseView, FormMixin):
         form_class = self.get_form_class()
         form = self.get_form(form_class)
         return self.render_to_response(
-            self.get_context_data(form=form, **kwargs))
+            self.get_context_data(form=form, uploadform=MonitoringListUploadForm(),
+                                  **kwargs))
 
     def post(self, request, *args, **kwargs):
         if not self.request.user.has_perm('monitoringlist.change_monitoringlist'):
@@ -235,8 +497,19 @@ class MonitoringListView(BaseView, FormMixin):
         if request.POST['action'] == 'Delete selected':
             sources = [int(source) for source in
                        request.POST.getlist('sources', [])]
-            self.database.delete_monitoringlist(sources)
+            self.database.delete_monitoringlist(
+                sources, dataset=self.dataset_id)
             return HttpResponseRedirect(self.get_succes_url())
+        if request.POST['action'] == 'Upload':
+            uploadform = MonitoringListUploadForm(
+                data=request.POST, files=request.FILES)
+            if uploadform.is_valid():
+                self.database.bulk_update_monitoringlist(
+                    uploadform.cleaned_data['positions'], self.dataset_id)
+                return HttpResponseRedirect(self.get_succes_url())
+            # Show the errors
+            return self.render_to_response(self.get_context_data(
+                form=MonitoringListForm(), uploadform=uploadform, **kwargs))
         form_class = self.get_form_class()
         form = self.get_form(form_class)
         if form.is_valid():
@@ -249,6 +522,7 @@ class MonitoringListView(BaseView, FormMixin):
         context['sources'] = self.database.monitoringlist(dataset=kwargs['dataset'])
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         context['form'] = kwargs['form']
+        context['uploadform'] = kwargs['uploadform']
         return context
 
 
@@ -286,6 +560,248 @@ class SourceLightcurveView(BaseView):
         return response
 
 
+class LightcurveDataView(BaseView):
+    """Base class for the lightcurve data of a source, as JSON or as
+    binary arrays, for plotting in the browser
+
+    The JSON response has the lightcurve points and the image times as
+    columns. Times are in seconds since 1970-01-01 UTC. The binary
+    response has the same columns as consecutive little-endian float64
+    arrays: time, inttime, flux, flux_err and xtrsrcid of the points,
+    then time and inttime of the images; the X-Lightcurve-Points and
+    X-Lightcurve-Images headers give the lengths. Missing (NULL) values
+    are null in JSON, and NaN in the binary response.
+    """
+
+    # Seconds that browsers may reuse the data of processed datasets
+    max_age = 3600
+
+    def get_srcid(self):
+        """Return the extracted source id of the lightcurve, and the
+        extracted source id of the trigger point (or None)"""
+
+        raise NotImplementedError
+
+    def render_to_response(self, context, **kwargs):
+        dataset = int(self.kwargs['dataset'])
+        srcid, trigger = self.get_srcid()
+        # Lightcurves only change when a dataset is (re)processed
+        etag = self.dataset_etag(dataset, self.kwargs['id'],
+                                 self.kwargs['format'])
+        response = self.not_modified(etag)
+        if response is not None:
+            return response
+        lightcurve = self.database.lightcurve(srcid)
+        images = self.database.image_times(dataset)
+        columns = zip(*lightcurve) if lightcurve else [()] * 5
+        points = OrderedDict((
+            ('time', self.seconds(columns[0])),
+            ('inttime', numpy.array(columns[1], dtype=numpy.float64)),
+            ('flux', numpy.array(columns[2], dtype=numpy.float64)),
+            ('flux_err', numpy.array(columns[3], dtype=numpy.float64)),
+            ('xtrsrcid', numpy.array(columns[4], dtype=numpy.int64))))
+        columns = zip(*images) if images else [()] * 2
+        imagetimes = OrderedDict((
+            ('time', self.seconds(columns[0])),
+            ('inttime', numpy.array(columns[1], dtype=numpy.float64))))
+        trigger_index = None
+        if trigger is not None:
+            indices = numpy.flatnonzero(points['xtrsrcid'] == trigger)
+            if len(indices):
+                trigger_index = int(indices[0])
+        if self.kwargs['format'] == 'json':
+            response = HttpResponse(json.dumps({
+                'id': int(self.kwargs['id']),
+                'dataset': dataset,
+                'points': dict((key, json_list(value))
+                               for key, value in points.iteritems()),
+                'images': dict((key, json_list(value))
+                               for key, value in imagetimes.iteritems()),
+                'trigger': trigger_index,
+                }, separators=(',', ':')), mimetype="application/json")
+        else:
+            data = numpy.concatenate(
+                [value.astype('<f8') for value in points.values()] +
+                [value.astype('<f8') for value in imagetimes.values()])
+            response = HttpResponse(data.tostring(),
+                                    mimetype="application/octet-stream")
+            response['X-Lightcurve-Points'] = str(len(points['time']))
+            response['X-Lightcurve-Images'] = str(len(imagetimes['time']))
+            if trigger_index is not None:
+                response['X-Lightcurve-Trigger'] = str(trigger_index)
+        return self.set_cache_headers(response, etag, self.max_age)
+
+    @staticmethod
+    def seconds(timestamps):
+        """Convert datetimes to seconds since 1970-01-01; None (NaT)
+        becomes NaN"""
+
+        times = numpy.array(timestamps, dtype='datetime64[us]').astype(
+            numpy.int64)
+        seconds = times / 1e6
+        seconds[times == numpy.iinfo(numpy.int64).min] = numpy.nan
+        return seconds
+
+
+class SourceLightcurveDataView(LightcurveDataView):
+
+    def get_srcid(self):
+        source = self.database.source(
+            id=self.kwargs['id'], dataset=self.kwargs['dataset'])
+        if not source:
+            raise Http404
+        return int(source[0]['xtrsrc_id']), None
+
+
+class TransientLightcurveDataView(LightcurveDataView):
+
+    def get_srcid(self):
+        transient = self.database.transient(
+            id=self.kwargs['id'], dataset=self.kwargs['dataset'])
+        if not transient:
+            raise Http404
+        transient = transient[0]
+        return int(transient['xtrsrc_id']), transient['trigger_xtrsrc_id']
+
+
+class ExportView(BaseView):
+    """Stream a table of a dataset as CSV, FITS binary table or NumPy
+    .npy file
+
+    The columns to export can be given as a comma-separated 'columns'
+    GET parameter.
+    """
+
+    def render_to_response(self, context, **kwargs):
+        dataset = int(self.kwargs['dataset'])
+        if not self.database.dataset(id=dataset):
+            raise Http404
+        columns = [column for column in
+                   self.request.GET.get('columns', '').split(',') if column]
+        try:
+            exported = export.Export(self.database, self.kwargs['table'],
+                                     dataset, columns=columns)
+        except export.ExportError as exc:
+            return HttpResponseBadRequest(str(exc), mimetype="text/plain")
+        format = self.kwargs['format']
+        response = HttpResponse(
+            self.stream(getattr(exported, format)()),
+            mimetype=export.FORMATS[format])
+        response['Content-Disposition'] = (
+            'attachment; filename="dataset%d_%s.%s"' % (
+                dataset, self.kwargs['table'], format))
+        return response
+
+
+class ConeSearchView(BaseView):
+    """Search the sources or monitoring list of a dataset for those
+    within a radius of a position
+
+    With the 'format=json' GET parameter, the results are returned as
+    JSON: the id, ra, decl and distance (arcsec) of each source, nearest
+    first.
+    """
+
+    template_name = 'dataset/conesearch.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(ConeSearchView, self).get_context_data(**kwargs)
+        dataset = self.database.dataset(id=int(kwargs['dataset']))
+        if not dataset:
+            raise Http404
+        context['dataset'] = dataset[0]
+        form = ConeSearchForm(self.request.GET or None)
+        context['form'] = form
+        if form.is_valid():
+            data = form.cleaned_data
+            limit = getattr(settings, 'CONE_SEARCH_MAX_RESULTS', 1000)
+            start = time.time()
+            results, method = conesearch.search(
+                self.database, int(kwargs['dataset']), data['ra'],
+                data['dec'], data['radius'] / 3600., table=data['table'],
+                limit=limit)
+            context['search'] = {
+                'table': data['table'], 'method': method,
+                'time': (time.time() - start) * 1e3,
+                'truncated': len(results['id']) >= limit}
+            context['results'] = results
+            context['rows'] = zip(*[array.tolist()
+                                    for array in results.values()])
+        return context
+
+    def render_to_response(self, context, **kwargs):
+        if self.request.GET.get('format') != 'json':
+            return super(ConeSearchView, self).render_to_response(
+                context, **kwargs)
+        form = context['form']
+        if not form.is_bound or not form.is_valid():
+            return HttpResponseBadRequest(
+                json.dumps(form.errors), mimetype="application/json")
+        result = OrderedDict([('dataset', context['dataset']['id'])])
+        result.update(context['search'])
+        result.update((name, array.tolist())
+                      for name, array in context['results'].iteritems())
+        return HttpResponse(json.dumps(result, separators=(',', ':')),
+                            mimetype="application/json")
+
+
+class LightcurvesDataView(BaseView):
+    """The lightcurves of all sources of a dataset, or of those given
+    by the comma-separated 'sources' GET parameter, from
+    DataBase.lightcurves()
+
+    The JSON response has the source ids, the offsets of each
+    lightcurve in the point arrays, and the point arrays (times in
+    seconds since 1970-01-01 UTC). The binary response has the same
+    arrays consecutively: srcid and offsets as little-endian int64,
+    time, inttime, flux and flux_err as little-endian float64, and
+    xtrsrcid as little-endian int64; the X-Lightcurves-Sources and
+    X-Lightcurves-Points headers give the number of sources and points.
+    Missing (NULL) values are null in JSON, and NaN in the binary
+    response.
+    """
+
+    max_age = 3600
+
+    def render_to_response(self, context, **kwargs):
+        dataset = int(self.kwargs['dataset'])
+        try:
+            srcids = [int(srcid) for srcid in
+                      self.request.GET['sources'].split(',') if srcid]
+        except KeyError:
+            srcids = None
+        except ValueError:
+            return HttpResponseBadRequest("Source ids should be integers",
+                                          mimetype="text/plain")
+        etag = self.dataset_etag(dataset, srcids, self.kwargs['format'])
+        response = self.not_modified(etag)
+        if response is not None:
+            return response
+        lightcurves = self.database.lightcurves(dataset, srcids=srcids)
+        arrays = OrderedDict((
+            ('srcid', lightcurves['srcid']),
+            ('offsets', lightcurves['offsets']),
+            ('time', LightcurveDataView.seconds(lightcurves['taustart_ts'])),
+            ('inttime', lightcurves['tau_time'].astype(numpy.float64)),
+            ('flux', lightcurves['i_peak'].astype(numpy.float64)),
+            ('flux_err', lightcurves['i_peak_err'].astype(numpy.float64)),
+            ('xtrsrcid', lightcurves['xtrsrcid'].astype(numpy.int64))))
+        if self.kwargs['format'] == 'json':
+            result = OrderedDict([('dataset', dataset)])
+            result.update((name, json_list(array))
+                          for name, array in arrays.iteritems())
+            response = HttpResponse(json.dumps(result, separators=(',', ':')),
+                                    mimetype="application/json")
+        else:
+            response = HttpResponse(
+                "".join(array.astype('<' + array.dtype.str[1:]).tostring()
+                        for array in arrays.values()),
+                mimetype="application/octet-stream")
+            response['X-Lightcurves-Sources'] = str(len(arrays['srcid']))
+            response['X-Lightcurves-Points'] = str(len(arrays['time']))
+        return self.set_cache_headers(response, etag, self.max_age)
+
+
 class ImagePlotView(BaseView):
 
     def get_context_data(self, **kwargs):
@@ -293,7 +809,6 @@ class ImagePlotView(BaseView):
         context['id'] = kwargs['id']
 
     def render_to_response(self, context, **kwargs):
-        response = HttpResponse(mimetype="image/png")
         image = self.database.image(
             id=self.kwargs['id'], dataset=self.kwargs['dataset'],
             extra_info=['ntotalsources'])
@@ -302,6 +817,127 @@ class ImagePlotView(BaseView):
         else:
             image = image[0]
         sources = self.database.extractedsource(image=image['id'])
-        plot.ImagePlot(response=response, size=(12, 12)).render(
+        data = plot.ImagePlot(size=(12, 12)).cached_data(
+            (plotcache.file_identity(image['url']), sources_digest(sources)),
             image, plotsources=sources)
+        return HttpResponse(data, mimetype="image/png")
+
+
+class ImageTilesView(BaseView):
+    """Pan and zoom viewer for an image, using the tile pyramid"""
+
+    template_name = "dataset/imagetiles.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(ImageTilesView, self).get_context_data(**kwargs)
+        image = self.database.image(id=kwargs['id'], dataset=kwargs['dataset'])
+        if not image:
+            raise Http404
+        context['image'] = image[0]
+        context['dataset'] = kwargs['dataset']
+        return context
+
+
+class ImageTileBaseView(BaseView):
+    """Base class for views that serve (part of) an image pyramid"""
+
+    def get_pyramid(self):
+        image = self.database.image(
+            id=self.kwargs['id'], dataset=self.kwargs['dataset'])
+        if not image:
+            raise Http404
+        try:
+            return image[0], tiles.Pyramid(image[0]['url'])
+        except tiles.TileError:
+            raise Http404
+
+    def cached_response(self, data, mimetype):
+        response = HttpResponse(data, mimetype=mimetype)
+        # Pyramids are keyed on the image file, so tiles only change
+        # when the image is replaced
+        patch_cache_control(response, public=True, max_age=24*3600)
+        return response
+
+
+class ImageTileMetaView(ImageTileBaseView):
+    """Properties of the tile pyramid of an image, as JSON"""
+
+    def render_to_response(self, context, **kwargs):
+        image, pyramid = self.get_pyramid()
+        return self.cached_response(json.dumps(pyramid.meta),
+                                    "application/json")
+
+
+class ImageTileView(ImageTileBaseView):
+    """A single tile of an image pyramid"""
+
+    def render_to_response(self, context, **kwargs):
+        image, pyramid = self.get_pyramid()
+        try:
+            data = pyramid.tile(int(self.kwargs['z']), int(self.kwargs['x']),
+                                int(self.kwargs['y']))
+        except tiles.TileError:
+            raise Http404
+        return self.cached_response(data, "image/png")
+
+
+class ImageOverlayView(ImageTileBaseView):
+    """Ellipses of the sources extracted from an image, as JSON, in
+    the pixel coordinates of the tile pyramid"""
+
+    def render_to_response(self, context, **kwargs):
+        image, pyramid = self.get_pyramid()
+        sources = self.database.extractedsource(image=image['id'])
+        ellipses = pyramid.overlay(sources)
+        return HttpResponse(json.dumps({
+            'ids': [source['id'] for source in sources],
+            'ellipses': ellipses}), mimetype="application/json")
+
+
+class PlotView(View):
+    """Serve a plot from the plot cache"""
+
+    def get(self, request, *args, **kwargs):
+        data = plotcache.get(kwargs['key'])
+        if data is None:
+            raise Http404
+        response = HttpResponse(
+            data, mimetype=plotcache.MIMETYPES[kwargs['format']])
+        # Cached plots are content addressed, so they never change
+        patch_cache_control(response, public=True, max_age=365*24*3600)
+        return response
+
+
+class RenderStatusView(View):
+    """Report whether a plot submitted to the render service is ready"""
+
+    def get(self, request, *args, **kwargs):
+        status = render.service.status(kwargs['key'])
+        result = {'status': status}
+        if status == 'done':
+            result['url'] = plotcache.url(kwargs['key'], kwargs['format'])
+        response = HttpResponse(json.dumps(result),
+                                mimetype="application/json")
+        patch_cache_control(response, no_cache=True)
         return response
+
+
+class RenderStatsView(View):
+    """Report the render service counters and queue depth of this
+    process"""
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        return HttpResponse(json.dumps(render.service.stats()),
+                            mimetype="application/json")
+
+
+class PoolStatsView(View):
+    """Report the database connection pool counters of this process"""
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        return HttpResponse(json.dumps(dbpool.pool.stats()),
+                            mimetype="application/json")